@@ -2,4 +2,6 @@ import multiprocessing
 
 bind = "0.0.0.0:80"
 workers = multiprocessing.cpu_count() * 2 + 1
-wsgi_app = "main:app"
\ No newline at end of file
+wsgi_app = "main:app"
+# one playlist run per request, long playlists page many Spotify sources within a Cloud Tasks request deadline
+timeout = 600
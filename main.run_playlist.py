@@ -9,7 +9,12 @@ def run_user_playlist(event: CloudEvent):
     logger = logging.getLogger('music')
 
     attr = event.get_data()['message']['attributes']
-    if 'username' in attr and 'name' in attr:
+    if 'username' in attr and 'job_id' in attr and 'playlist_id' in attr:
+
+        from music.cloud import run_job_playlist
+        run_job_playlist(username=attr['username'], job_id=attr['job_id'], playlist_id=attr['playlist_id'])
+
+    elif 'username' in attr and 'name' in attr:
 
         from music.tasks.run_user_playlist import run_user_playlist as do_run_user_playlist
         do_run_user_playlist(user=attr['username'], playlist=attr["name"])
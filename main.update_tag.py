@@ -15,5 +15,10 @@ def update_tag(event: CloudEvent):
         from music.tasks.update_tag import update_tag as do_update_tag
         do_update_tag(user=attr['username'], tag=attr["tag_id"])
 
+    elif 'username' in attr:
+
+        from music.tasks.update_tag import update_user_tags as do_update_user_tags
+        do_update_user_tags(user=attr['username'])
+
     else:
         logger.error('no parameters in event attributes')
@@ -8,17 +8,25 @@ import logging
 from datetime import datetime
 
 from music.api.decorators import login_or_jwt, login_required, \
-    admin_required, cloud_task, validate_json, validate_args, spotify_link_required, no_locked_users
-from music.cloud import queue_run_user_playlist, offload_or_run_user_playlist
-from music.cloud.tasks import update_all_user_playlists, update_playlists
+    admin_required, cloud_task, validate_json, validate_args, spotify_link_required, no_locked_users, \
+    conditional_etag
+from music.cloud import queue_run_user_playlist, offload_or_run_user_playlist, start_run_job, \
+    queue_user_playlists, run_job_playlist
+from music.cloud.tasks import update_all_user_playlists, update_playlists, update_playlists_task
 
 from music.tasks.create_playlist import create_playlist
 from music.tasks.run_user_playlist import run_user_playlist
+from music.tasks.run_playlists import run_job
 
-from music.model.user import User
-from music.model.playlist import Playlist
+from music.model.data_version import bump_data_version
+from music.model.user import User, get_user, invalidate_user, index_all_user_playlists
+from music.model.playlist import Playlist, get_reference_names
 
 import music.db.database as database
+from music.db.run_job import create_run_job, get_run_job, is_finished, QUEUED
+from music.db.listing import list_documents, parse_fields, get_public_fields
+from music.db.playlist_graph import get_playlist_graph, build_playlist_graph, update_playlist_node, \
+    remove_playlist_node, creates_cycle
 
 from spotframework.net.network import SpotifyNetworkException
 
@@ -30,6 +38,7 @@ logger = logging.getLogger(__name__)
 @blueprint.route('/playlists', methods=['GET'])
 @login_or_jwt
 @no_locked_users
+@conditional_etag
 def all_playlists_route(auth: dict = None, user: User = None):
     """Retrieve all playlists for a given user
 
@@ -41,14 +50,41 @@ def all_playlists_route(auth: dict = None, user: User = None):
     """
 
     assert user is not None
+
+    if is_listing_request():
+        try:
+            documents, next_cursor = list_request_documents(db.collection(f'{user.key}/playlists'), 'name', Playlist)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        playlists = [i.to_dict() for i in documents]
+
+        references = [ref for playlist in playlists for ref in playlist.get('playlist_references') or []]
+        if len(references) > 0:
+            reference_names = get_reference_names(list({i.path: i for i in references}.values()))
+            for playlist in playlists:
+                if 'playlist_references' in playlist:
+                    playlist['playlist_references'] = [reference_names[i.id] for i in playlist['playlist_references']
+                                                       if i.id in reference_names]
+
+        return jsonify({
+            'playlists': playlists,
+            'next_cursor': next_cursor
+        }), 200
+
+    playlists = list(Playlist.collection.parent(user.key).fetch())
+    # references are to the user's own playlists, resolve them from the same fetch
+    reference_names = {i.id: i.name for i in playlists}
+
     return jsonify({
-        'playlists': [i.to_dict() for i in Playlist.collection.parent(user.key).fetch()]
+        'playlists': [i.to_dict(reference_names=reference_names) for i in playlists]
     }), 200
 
 
 @blueprint.route('/playlist', methods=['GET', 'DELETE'])
 @login_or_jwt
 @no_locked_users
+@conditional_etag
 @validate_args(('name', str))
 def playlist_get_delete_route(auth: dict = None, user: User = None):
 
@@ -62,6 +98,8 @@ def playlist_get_delete_route(auth: dict = None, user: User = None):
 
     elif request.method == 'DELETE':
         Playlist.collection.parent(user.key).delete(key=playlist.key)
+        bump_data_version(user.key)
+        remove_playlist_node(user, playlist.id)
         return jsonify({"message": 'playlist deleted', "status": "success"}), 200
 
 
@@ -76,11 +114,21 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
     playlist_name = request_json['name']
     playlist_references = []
 
-    if request_refs := request_json.get('playlist_references', None):
+    request_refs = request_json.get('playlist_references', None)
+    request_ref_addition = request_json.get('add_ref')
+    request_ref_deletion = request_json.get('remove_ref')
+
+    # resolve every referenced name in one batch
+    lookup_names = [playlist_name] + [i for i in [request_ref_addition, request_ref_deletion] if i]
+    if request_refs and request_refs != -1:
+        lookup_names += request_refs
+    found_playlists = user.get_playlists_by_name(lookup_names)
+
+    if request_refs:
         if request_refs != -1:
             for i in request_refs:
 
-                playlist = user.get_playlist(i, raise_error=False)
+                playlist = found_playlists[i]
                 if playlist is not None:
                     playlist_references.append(db.document(playlist.key))
                 else:
@@ -89,7 +137,7 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
     if len(playlist_references) == 0 and request_refs != -1:
         playlist_references = None
 
-    searched_playlist = user.get_playlist(playlist_name, raise_error=False)
+    searched_playlist = found_playlists[playlist_name]
 
     # CREATE
     if request.method == 'PUT':
@@ -122,6 +170,7 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
             playlist.uri = str(new_playlist.uri)
 
         playlist.save()
+        update_playlist_node(user, playlist)
         logger.info(f'added {user.username} / {playlist_name}')
 
         return jsonify({"message": 'playlist added', "status": "success"}), 201
@@ -132,6 +181,8 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
         if searched_playlist is None:
             return jsonify({'error': "playlist doesn't exist"}), 400
 
+        original_references = {i.id for i in searched_playlist.playlist_references or []}
+
         # ATTRIBUTES
         for rec_key, rec_item in request_json.items():
             # type and parts require extra validation
@@ -159,15 +210,15 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
             else:
                 searched_playlist.playlist_references = playlist_references
 
-        if request_ref_addition := request_json.get('add_ref'):
-            playlist = user.get_playlist(request_ref_addition, raise_error=False)
+        if request_ref_addition:
+            playlist = found_playlists[request_ref_addition]
             if playlist is not None and playlist.id not in [x.id for x in searched_playlist.playlist_references]:
                 searched_playlist.playlist_references = searched_playlist.playlist_references + [db.document(playlist.key)]
             else:
                 return jsonify({"message": f'managed playlist {request_ref_addition} not found', "status": "error"}), 400
 
-        if request_ref_deletion := request_json.get('remove_ref'):
-            playlist = user.get_playlist(request_ref_deletion, raise_error=False)
+        if request_ref_deletion:
+            playlist = found_playlists[request_ref_deletion]
             if playlist is not None and playlist.id in [x.id for x in searched_playlist.playlist_references]:
                 searched_playlist.playlist_references = [i for i in searched_playlist.playlist_references if i.id != playlist.id]
             else:
@@ -179,7 +230,15 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
             if playlist_type in ['default', 'recents', 'fmchart']:
                 searched_playlist.type = playlist_type
 
+        # DEPENDENCY INDEX
+        # only added references can close a cycle, edits to playlists already in one aren't blocked
+        if added_references := {i.id for i in searched_playlist.playlist_references or []} - original_references:
+            graph = get_playlist_graph(user) or build_playlist_graph(user)
+            if creates_cycle(graph, searched_playlist.id, added_references):
+                return jsonify({"message": 'playlist references would create a cycle', "status": "error"}), 400
+
         searched_playlist.update()
+        update_playlist_node(user, searched_playlist)
         logger.info(f'updated {user.username} / {playlist_name}')
 
         return jsonify({"message": 'playlist updated', "status": "success"}), 200
@@ -188,10 +247,13 @@ def playlist_post_put_route(auth: dict = None, user: User = None):
 @blueprint.route('/user', methods=['GET', 'POST'])
 @login_or_jwt
 @no_locked_users
+@conditional_etag
 def user_route(auth: dict = None, user: User = None):
     assert user is not None
 
     if request.method == 'GET':
+        # cached copies can predate the data version the ETag is built from
+        user = get_user(user.username, cached=False)
         return jsonify(user.to_dict()), 200
 
     else:  # POST
@@ -201,7 +263,7 @@ def user_route(auth: dict = None, user: User = None):
             if user.type != "admin":
                 return jsonify({'status': 'error', 'message': 'unauthorized'}), 401
 
-            user = User.collection.filter('username', '==', request_json['username'].strip().lower()).get()
+            user = get_user(request_json['username'])
 
         if (locked := request_json.get('locked')) and user.type == "admin":
             logger.info(f'updating lock {user.username} / {locked}')
@@ -212,6 +274,7 @@ def user_route(auth: dict = None, user: User = None):
 
             user.access_token = None
             user.refresh_token = None
+            user.spotify_display_name = None
             user.spotify_linked = False
 
         if 'lastfm_username' in request_json:
@@ -268,9 +331,10 @@ def user_delete_route(auth: dict = None, user: User = None):
     assert user is not None
 
     if user.type == 'admin' and (username_override := request.args.get('username')) is not None:
-        user = User.collection.filter('username', '==', username_override.strip().lower()).get()
+        user = get_user(username_override)
 
     User.collection.delete(user.key, child=True)
+    invalidate_user(user.username)
 
     logger.info(f'user {user.username} deleted')
 
@@ -282,11 +346,54 @@ def user_delete_route(auth: dict = None, user: User = None):
 @admin_required
 @no_locked_users
 def all_users_route(auth: dict = None, user: User = None):
+    if is_listing_request():
+        try:
+            documents, next_cursor = list_request_documents(db.collection('spotify_users'), 'username', User)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({
+            'accounts': [i.to_dict() for i in documents],
+            'next_cursor': next_cursor
+        }), 200
+
     return jsonify({
         'accounts': [i.to_dict() for i in User.collection.fetch()]
     }), 200
 
 
+def is_listing_request() -> bool:
+    """Whether a list request asks for a projection or a page rather than every field of every document"""
+    return any(i in request.args for i in ['fields', 'limit', 'cursor'])
+
+
+def list_request_documents(collection, order_field: str, model):
+    """List documents using the request's fields, limit and cursor args
+
+    Args:
+        collection (CollectionReference): Subject collection
+        order_field (str): Field to order and paginate by
+        model: fireo Model class of the collection, restricts the fields that can be requested
+
+    Raises:
+        ValueError: Invalid fields, limit or cursor
+
+    Returns:
+        Tuple[List[DocumentSnapshot], Optional[str]]: Page of documents and the next page's cursor
+    """
+
+    public_fields = get_public_fields(model)
+    fields = parse_fields(request.args.get('fields'), public_fields) or public_fields
+
+    limit = request.args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+
+    return list_documents(collection, order_field, fields=fields, limit=limit, cursor=request.args.get('cursor'))
+
+
 @blueprint.route('/user/password', methods=['POST'])
 @login_required
 @no_locked_users
@@ -333,6 +440,13 @@ def run_playlist_task():  # receives cloud tasks request for update
     if payload:
         payload = json.loads(payload)
 
+        if 'job_id' in payload:
+            logger.info(f'running {payload["username"]} / {payload["playlist_id"]} for job {payload["job_id"]}')
+
+            run_job_playlist(payload['username'], payload['job_id'], payload['playlist_id'])
+
+            return jsonify({'message': 'executed playlist', 'status': 'success'}), 200
+
         logger.info(f'running {payload["username"]} / {payload["name"]}')
 
         offload_or_run_user_playlist(payload['username'], payload['name'])  # check whether offloading to cloud function
@@ -342,6 +456,57 @@ def run_playlist_task():  # receives cloud tasks request for update
     logger.critical('no payload provided')
 
 
+@blueprint.route('/playlists/run', methods=['POST'])
+@login_or_jwt
+@no_locked_users
+@validate_json('names')
+def run_playlists(auth: dict = None, user: User = None):
+    """Run many of a user's playlists as one job, names are either a list or "all"
+    """
+
+    names = request.get_json()['names']
+
+    if names == 'all':
+        playlists = list(user.get_playlists())
+
+    elif isinstance(names, list) and len(names) > 0 and all(isinstance(i, str) for i in names):
+        found = user.get_playlists_by_name(names)
+
+        if missing := [name for name, playlist in found.items() if playlist is None]:
+            return jsonify({'error': f'playlists not found: {", ".join(missing)}', 'missing': missing}), 404
+
+        playlists = list({i.id: i for i in found.values()}.values())
+
+    else:
+        return jsonify({'error': 'names must be a list of playlist names or "all"'}), 400
+
+    job = create_run_job(user, playlists)
+
+    if any(i['status'] == QUEUED for i in job.playlists.values()):
+        if os.environ.get('DEPLOY_DESTINATION', None) == 'PROD':
+            try:
+                start_run_job(user, job)  # one execution per playlist on either cloud tasks or functions
+            except Exception:
+                return jsonify({'error': 'failed to queue runs', 'job_id': job.id}), 500
+        else:
+            run_job(user.username, job.id)  # run synchronously
+
+    return jsonify({'message': 'execution requested', 'status': 'success', 'job_id': job.id}), 202
+
+
+@blueprint.route('/playlists/run/<job_id>', methods=['GET'])
+@login_or_jwt
+@no_locked_users
+def run_playlists_job(job_id, auth: dict = None, user: User = None):
+
+    job = get_run_job(user, job_id)
+
+    if job is None:
+        return jsonify({'error': f'job {job_id} not found'}), 404
+
+    return jsonify({'job': job.to_dict(), 'finished': is_finished(job)}), 200
+
+
 @blueprint.route('/playlist/run/user', methods=['GET'])
 @login_or_jwt
 @no_locked_users
@@ -352,7 +517,10 @@ def run_user(auth: dict = None, user: User = None):
     else:
         user_name = user.username
 
-    update_playlists(user_name)
+    if os.environ.get('DEPLOY_DESTINATION', None) == 'PROD':
+        update_playlists_task(user_name)  # queues each playlist once the playlists it references have run
+    else:
+        update_playlists(user_name)
 
     return jsonify({'message': 'executed user', 'status': 'success'}), 200
 
@@ -363,8 +531,8 @@ def run_user_task():
 
     payload = request.get_data(as_text=True)
     if payload:
-        update_playlists(payload)
-        return jsonify({'message': 'executed user', 'status': 'success'}), 200
+        queue_user_playlists(payload)
+        return jsonify({'message': 'queued user', 'status': 'success'}), 200
 
 
 @blueprint.route('/playlist/run/users', methods=['GET'])
@@ -377,6 +545,16 @@ def run_users(auth: dict = None, user: User = None):
     return jsonify({'message': 'executed all users', 'status': 'success'}), 200
 
 
+@blueprint.route('/playlist/index/users', methods=['POST'])
+@login_or_jwt
+@admin_required
+@no_locked_users
+def index_users(auth: dict = None, user: User = None):
+
+    indexed = index_all_user_playlists()
+    return jsonify({'message': f'indexed {indexed} users', 'status': 'success'}), 200
+
+
 @blueprint.route('/playlist/image', methods=['GET'])
 @login_or_jwt
 @spotify_link_required
@@ -1,9 +1,11 @@
 import functools
+import hashlib
 import logging
 
 from flask import session, request, jsonify, make_response
 
-from music.model.user import User
+from music.model.data_version import get_data_version
+from music.model.user import get_user
 from music.auth.jwt_keys import validate_key
 
 logger = logging.getLogger(__name__)
@@ -19,7 +21,7 @@ def is_logged_in():
 def is_basic_authed():
     if request.authorization:
         if request.authorization.get('username', None) and request.authorization.get('password', None):
-            user = User.collection.filter('username', '==', request.authorization.username.strip().lower()).get()
+            user = get_user(request.authorization.username)
             if user is None:
                 return False, None
 
@@ -48,7 +50,7 @@ def login_required(func):
     @functools.wraps(func)
     def login_required_wrapper(*args, **kwargs):
         if is_logged_in():
-            user = User.collection.filter('username', '==', session['username'].strip().lower()).get()
+            user = get_user(session['username'])
             return func(*args, user=user, **kwargs)
         else:
             logger.warning('user not logged in')
@@ -60,12 +62,12 @@ def login_or_jwt(func):
     @functools.wraps(func)
     def login_or_jwt_wrapper(*args, **kwargs):
         if is_logged_in():
-            user = User.collection.filter('username', '==', session['username'].strip().lower()).get()
+            user = get_user(session['username'])
             return func(*args, user=user, **kwargs)
         else:
             token = is_jwt_authed()
             if token is not None:
-                user = User.collection.filter('username', '==', token['sub'].strip().lower()).get()
+                user = get_user(token['sub'])
                 
                 if user is not None:
                     return func(*args, auth=token, user=user, **kwargs)
@@ -85,7 +87,7 @@ def jwt_required(func):
         
         token = is_jwt_authed()
         if token is not None:
-            user = User.collection.filter('username', '==', token['sub'].strip().lower()).get()
+            user = get_user(token['sub'])
 
             if user is not None:
                 return func(*args, auth=token, user=user, **kwargs)
@@ -103,7 +105,7 @@ def login_or_basic_auth(func):
     @functools.wraps(func)
     def login_or_basic_auth_wrapper(*args, **kwargs):
         if is_logged_in():
-            user = User.collection.filter('username', '==', session['username'].strip().lower()).get()
+            user = get_user(session['username'])
             return func(*args, user=user, **kwargs)
         else:
             check, user = is_basic_authed()
@@ -252,6 +254,35 @@ def check_dict(request_params, expected_args, func, args, kwargs):
 
     return func(*args, **kwargs)
 
+def conditional_etag(func):
+    """Tag GET responses with an ETag of the user's data version and answer matching If-None-Match with 304
+
+    The version is read before the handler runs, so a write during the request can only cause a later miss
+    """
+    @functools.wraps(func)
+    def conditional_etag_wrapper(*args, **kwargs):
+        db_user = kwargs.get('user')
+
+        if request.method != 'GET' or db_user is None:
+            return func(*args, **kwargs)
+
+        version = get_data_version(db_user.key)
+        etag = hashlib.sha256(f'{db_user.username}:{version}:{request.full_path}'.encode()).hexdigest()[:32]
+
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return conditional_etag_wrapper
+
+
 def no_cache(func):
     @functools.wraps(func)
     def no_cache_wrapper(*args, **kwargs):
@@ -4,6 +4,7 @@ import logging
 
 from music.api.decorators import login_or_jwt, spotify_link_required, validate_json, no_locked_users
 import music.db.database as database
+from music.tasks.playlist_index import get_playlist_index
 
 from spotframework.net.network import SpotifyNetworkException
 from spotframework.model.track import Context
@@ -42,8 +43,7 @@ def play(auth=None, user=None):
     elif 'playlist_name' in request_json:
         net = database.get_authed_spotify_network(user)
         try:
-            playlists = net.playlists()
-            playlist_to_play = next((i for i in playlists if i.name == request_json['playlist_name']), None)
+            playlist_to_play = get_playlist_index(net, user.username).get(request_json['playlist_name'])
 
             if playlist_to_play is not None:
                 player = Player(net)
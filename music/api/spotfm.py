@@ -7,6 +7,7 @@ from music.api.decorators import admin_required, login_or_jwt, lastfm_username_r
     spotify_link_required, cloud_task, validate_args, no_locked_users
 import music.db.database as database
 from music.cloud.tasks import refresh_all_user_playlist_stats, refresh_user_playlist_stats, refresh_playlist_task
+from music.tasks.playlist_index import get_playlist_index
 from music.tasks.refresh_lastfm_stats import refresh_lastfm_track_stats, \
     refresh_lastfm_album_stats, \
     refresh_lastfm_artist_stats
@@ -51,11 +52,10 @@ def count(auth=None, user=None):
         }), 200
     elif playlist_name:
         try:
-            playlists = spotnet.playlists()
-            playlist = next((i for i in playlists if i.name == playlist_name), None)
+            playlist = get_playlist_index(spotnet, user.username).get(playlist_name)
 
             if playlist is not None:
-                playlist_count = counter.count_playlist(playlist=playlist)
+                playlist_count = counter.count_playlist(uri=playlist.uri)
                 return jsonify({
                     "count": playlist_count,
                     'playlist_name': playlist_name,
@@ -3,9 +3,11 @@ import logging
 
 from music.api.decorators import login_or_jwt, spotify_link_required, no_locked_users
 import music.db.database as database
+from music.tasks.playlist_index import get_playlist_index
 
 from spotframework.engine.playlistengine import PlaylistEngine
 from spotframework.model.uri import Uri
+from spotframework.net.network import SpotifyNetworkException
 
 blueprint = Blueprint('spotify_api', __name__)
 logger = logging.getLogger(__name__)
@@ -30,7 +32,16 @@ def sort(auth=None, user=None):
         except ValueError:
             return jsonify({'error': "malformed uri provided"}), 400
     elif 'playlist_name' in request_json:
-        engine.reorder_playlist_by_added_date(name=request_json.get('playlist_name'), reverse=reverse)
+        try:
+            playlist = get_playlist_index(net, user.username).get(request_json['playlist_name'])
+        except SpotifyNetworkException:
+            logger.exception(f'error occured during {user.username} playlists retrieval')
+            return jsonify({'error': "playlists not returned"}), 400
+
+        if playlist is None:
+            return jsonify({'error': f"playlist {request_json['playlist_name']} not found"}), 404
+
+        engine.reorder_playlist_by_added_date(uri=playlist.uri, reverse=reverse)
     else:
         return jsonify({'error': "no uris provided"}), 400
 
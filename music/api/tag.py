@@ -4,10 +4,12 @@ import logging
 import os
 import json
 
-from music.api.decorators import login_or_jwt, cloud_task, no_locked_users
-from music.cloud.function import update_tag as serverless_update_tag
-from music.tasks.update_tag import update_tag
+from music.api.decorators import login_or_jwt, cloud_task, no_locked_users, conditional_etag
+from music.cloud.function import update_tag as serverless_update_tag, \
+    update_user_tags as serverless_update_user_tags
+from music.tasks.update_tag import update_tag, update_user_tags
 
+from music.model.data_version import bump_data_version
 from music.model.tag import Tag
 
 blueprint = Blueprint('task', __name__)
@@ -17,6 +19,7 @@ logger = logging.getLogger(__name__)
 @blueprint.route('/tag', methods=['GET'])
 @login_or_jwt
 @no_locked_users
+@conditional_etag
 def tags(auth=None, user=None):
     logger.info(f'retrieving tags for {user.username}')
     return jsonify({
@@ -27,6 +30,7 @@ def tags(auth=None, user=None):
 @blueprint.route('/tag/<tag_id>', methods=['GET', 'PUT', 'POST', "DELETE"])
 @login_or_jwt
 @no_locked_users
+@conditional_etag
 def tag_route(tag_id, auth=None, user=None):
     if request.method == 'GET':
         return get_tag(tag_id, user)
@@ -123,6 +127,7 @@ def delete_tag(tag_id, user):
 
     db_tag = Tag.collection.parent(user.key).filter('tag_id', '==', tag_id).get()
     Tag.collection.parent(user.key).delete(key=db_tag.key)
+    bump_data_version(user.key)
 
     return jsonify({"message": 'tag deleted', "status": "success"}), 201
 
@@ -154,3 +159,34 @@ def run_tag_task():
         serverless_update_tag(username=payload['username'], tag_id=payload['tag_id'])
 
         return jsonify({'message': 'executed playlist', 'status': 'success'}), 200
+
+
+@blueprint.route('/tags/update', methods=['GET'])
+@login_or_jwt
+@no_locked_users
+def tags_refresh(auth=None, user=None):
+    logger.info(f'updating all tags for {user.username}')
+
+    if os.environ.get('DEPLOY_DESTINATION', None) == 'PROD':
+        serverless_update_user_tags(username=user.username)
+    else:
+        update_user_tags(user=user)
+
+    return jsonify({"message": 'tags updated', "status": "success"}), 200
+
+
+@blueprint.route('/tag/update/user/task', methods=['POST'])
+@cloud_task
+def run_user_tags_task():
+
+    payload = request.get_data(as_text=True)
+    if payload:
+        payload = json.loads(payload)
+
+        logger.info(f'running tags for {payload["username"]}')
+
+        serverless_update_user_tags(username=payload['username'])
+
+        return jsonify({'message': 'executed tags', 'status': 'success'}), 200
+
+    logger.critical('no payload provided')
@@ -1,11 +1,12 @@
 from flask import Blueprint, session, flash, request, redirect, url_for, render_template, jsonify
 from werkzeug.security import generate_password_hash
-from music.model.user import User, get_admins
+from music.model.user import User, get_admins, get_user
 from music.model.config import Config
 from music.auth.jwt_keys import generate_key
 from music.api.decorators import no_cache
 from music.notif.notifier import notify_admin_new_user
 from music.magic_strings import SPOT_CLIENT_URI, SPOT_SECRET_URI, STATIC_BUCKET
+from music.secrets import get_secret
 
 from urllib.parse import urlencode, urlunparse
 import datetime
@@ -14,13 +15,11 @@ from numbers import Number
 import logging
 from base64 import b64encode
 
-from google.cloud import secretmanager
 import requests
 
 blueprint = Blueprint('authapi', __name__)
 
 logger = logging.getLogger(__name__)
-secret_client = secretmanager.SecretManagerServiceClient()
 
 
 @blueprint.route('/login', methods=['GET', 'POST'])
@@ -182,6 +181,7 @@ def register():
         user.username = username
         user.password = generate_password_hash(password)
         user.last_login = datetime.datetime.utcnow()
+        user.playlists_indexed = True  # no playlists to backfill
 
         user.save()
 
@@ -205,10 +205,9 @@ def auth():
 
         config = Config.collection.get("config/music-tools")
 
-        spot_client = secret_client.access_secret_version(request={"name": SPOT_CLIENT_URI})
         params = urlencode(
             {
-                'client_id': spot_client.payload.data.decode("UTF-8"),
+                'client_id': get_secret(SPOT_CLIENT_URI),
                 'response_type': 'code',
                 'scope': 'playlist-modify-public playlist-modify-private playlist-read-private '
                          'user-read-playback-state user-modify-playback-state user-library-read',
@@ -232,13 +231,10 @@ def token():
             flash('authorization failed')
             return redirect('app_route')
         else:
-            spot_client = secret_client.access_secret_version(request={"name": SPOT_CLIENT_URI})
-            spot_secret = secret_client.access_secret_version(request={"name": SPOT_SECRET_URI})
-
             config = Config.collection.get("config/music-tools")
 
             idsecret = b64encode(
-                bytes(spot_client.payload.data.decode("UTF-8") + ':' + spot_secret.payload.data.decode("UTF-8"), "utf-8")
+                bytes(get_secret(SPOT_CLIENT_URI) + ':' + get_secret(SPOT_SECRET_URI), "utf-8")
             ).decode("ascii")
             headers = {'Authorization': 'Basic %s' % idsecret}
 
@@ -254,7 +250,7 @@ def token():
 
                 resp = req.json()
 
-                user = User.collection.filter('username', '==', session['username'].strip().lower()).get()
+                user = get_user(session['username'])
 
                 user.access_token = resp['access_token']
                 user.refresh_token = resp['refresh_token']
@@ -279,10 +275,11 @@ def deauth():
 
     if 'username' in session:
 
-        user = User.collection.filter('username', '==', session['username'].strip().lower()).get()
+        user = get_user(session['username'])
 
         user.access_token = None
         user.refresh_token = None
+        user.spotify_display_name = None
         user.last_refreshed = datetime.datetime.now(datetime.timezone.utc)
         user.token_expiry = None
         user.spotify_linked = False
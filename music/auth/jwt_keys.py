@@ -2,14 +2,11 @@ from datetime import timedelta, datetime, timezone
 import jwt
 from music.magic_strings import JWT_SECRET_URI
 from music.model.user import User
-
-from google.cloud import secretmanager
-
-secret_client = secretmanager.SecretManagerServiceClient()
+from music.secrets import get_secret
 
 
 def get_jwt_secret_key() -> str:
-    return secret_client.access_secret_version(request={"name": JWT_SECRET_URI}).payload.data.decode("UTF-8")
+    return get_secret(JWT_SECRET_URI)
 
 
 def generate_key(user: User, timeout: datetime | timedelta = timedelta(minutes=60)) -> str:
@@ -0,0 +1,209 @@
+"""Key-value caches with LRU and TTL eviction for reusing expensive results between operations
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Cache(ABC):
+    """Base cache interface, entries expire after ttl seconds and the least recently used are evicted past max_size
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600):
+        """Initialise cache limits
+
+        Args:
+            max_size (int, optional): Maximum number of entries held. Defaults to 256.
+            ttl (float, optional): Seconds an entry remains valid for. Defaults to 3600.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Retrieve a live entry
+
+        Args:
+            key (Hashable): Entry key
+            default (Any, optional): Value returned on a miss. Defaults to None.
+
+        Returns:
+            Any: Cached value or default
+        """
+
+    @abstractmethod
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store an entry, evicting the least recently used entries if full
+
+        Args:
+            key (Hashable): Entry key
+            value (Any): Value to store
+        """
+
+    @abstractmethod
+    def delete(self, key: Hashable) -> None:
+        """Remove an entry if present
+
+        Args:
+            key (Hashable): Entry key
+        """
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Remove all entries
+        """
+
+
+class MemoryCache(Cache):
+    """Thread-safe in-process cache
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expiry, value = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class FileCache(Cache):
+    """Local file cache of pickled entries, persists across invocations on warm Cloud Function instances
+
+    Recency is tracked with file modification times
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600, directory: str = None):
+        super().__init__(max_size=max_size, ttl=ttl)
+
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), 'mixonomer-cache')
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, key: Hashable) -> Path:
+        return self.directory / hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        path = self._path(key)
+
+        with self._lock:
+            try:
+                if path.stat().st_mtime + self.ttl < time.time():
+                    path.unlink(missing_ok=True)
+                    return default
+
+                with open(path, 'rb') as f:
+                    stored_key, value = pickle.load(f)
+            except FileNotFoundError:
+                return default
+            except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+                logger.exception(f'error reading cache entry {path.name}')
+                path.unlink(missing_ok=True)
+                return default
+
+            if stored_key != key:  # hash collision
+                return default
+
+            # refresh recency without extending expiry beyond the original write
+            os.utime(path, (time.time(), path.stat().st_mtime))
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        path = self._path(key)
+
+        with self._lock:
+            try:
+                temp_path = path.with_suffix('.tmp')
+                with open(temp_path, 'wb') as f:
+                    pickle.dump((key, value), f)
+                temp_path.replace(path)
+            except (OSError, pickle.PicklingError):
+                logger.exception(f'error writing cache entry {path.name}')
+                return
+
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = [i for i in self.directory.iterdir() if i.suffix != '.tmp']
+        if len(entries) <= self.max_size:
+            return
+
+        # least recently accessed first
+        entries.sort(key=lambda i: i.stat().st_atime)
+        for entry in entries[:len(entries) - self.max_size]:
+            entry.unlink(missing_ok=True)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._path(key).unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry in self.directory.iterdir():
+                entry.unlink(missing_ok=True)
+
+
+def create_cache(backend: Optional[str] = None, max_size: int = 256, ttl: float = 3600, **kwargs) -> Cache:
+    """Create a cache for the given backend name
+
+    Args:
+        backend (Optional[str], optional): Either 'memory' or 'file'. Defaults to memory.
+        max_size (int, optional): Maximum number of entries held. Defaults to 256.
+        ttl (float, optional): Seconds an entry remains valid for. Defaults to 3600.
+
+    Returns:
+        Cache: New cache object
+    """
+
+    if backend == 'file':
+        return FileCache(max_size=max_size, ttl=ttl, **kwargs)
+
+    if backend not in (None, 'memory'):
+        logger.warning(f'unknown cache backend {backend}, defaulting to memory')
+
+    return MemoryCache(max_size=max_size, ttl=ttl)
@@ -2,11 +2,18 @@
 """
 
 import logging
+from typing import List
+
+import fireo
 
 from music.model.config import Config
+from music.model.user import User
+from music.model.playlist import Playlist
+from music.model.run_job import RunJob
+from music.db.run_job import create_run_job, claim_ready_playlists, fail_run_job, QUEUED, SUCCEEDED, FAILED
 from music.tasks.run_user_playlist import run_user_playlist as run_now
-from .function import run_user_playlist_function
-from .tasks import run_user_playlist_task
+from .function import run_user_playlist_function, run_job_playlist_function
+from .tasks import run_user_playlist_task, run_job_playlist_task
 
 logger = logging.getLogger(__name__)
 
@@ -50,3 +57,118 @@ def offload_or_run_user_playlist(username: str, playlist_name: str):
         logger.critical(f'invalid operating mode {username} / {playlist_name}, '
                         f'{config.playlist_cloud_operating_mode}, passing to cloud function')
         run_user_playlist_function(username=username, playlist_name=playlist_name)
+
+
+def queue_user_playlists(username: str):
+    """Queue a refresh of all of a user's playlists as a run job, each playlist runs in its own execution once the
+    playlists it references have finished
+
+    Args:
+        username (str): Subject user's username
+    """
+
+    user = User.collection.filter('username', '==', username.strip().lower()).get()
+
+    if user is None:
+        logger.error(f'user {username} not found')
+        return
+
+    job = create_run_job(user, [i for i in Playlist.collection.parent(user.key).fetch() if i.uri is not None])
+    start_run_job(user, job)
+
+
+def start_run_job(user: User, job: RunJob):
+    """Queue the playlists of a job that reference none of its other playlists, the rest are queued as they
+    become ready
+
+    If the job can't be started its playlists are marked as failed
+
+    Args:
+        user (User): Subject user
+        job (RunJob): Subject job
+
+    Raises:
+        Exception: Starting failed
+    """
+
+    try:
+        ready = claim_ready_playlists(fireo.transaction(), user, job.id)
+    except Exception:
+        logger.exception(f'error starting job {job.id} for {user.username}')
+        fail_run_job(user, job.id, [i for i, status in job.playlists.items() if status['status'] == QUEUED])
+        raise
+
+    dispatch_job_playlists(user, job.id, ready)
+
+
+def dispatch_job_playlists(user: User, job_id: str, playlist_ids: List[str]):
+    """Hand claimed playlists of a job to cloud tasks or functions, reading the config once
+
+    Playlists that can't be handed off are finished as failed, which may leave their dependents ready in turn
+
+    Args:
+        user (User): Subject user
+        job_id (str): Subject job ID
+        playlist_ids (List[str]): Claimed playlist IDs
+    """
+
+    if len(playlist_ids) == 0:
+        return
+
+    config = Config.collection.get("config/music-tools")
+    mode = getattr(config, 'playlist_cloud_operating_mode', None)
+
+    pending = list(playlist_ids)
+    while pending:
+        playlist_id = pending.pop(0)
+
+        try:
+            if mode == 'task':
+                logger.debug(f'passing {playlist_id} of job {job_id} to cloud tasks {user.username}')
+                run_job_playlist_task(username=user.username, job_id=job_id, playlist_id=playlist_id)
+
+            else:
+                if mode != 'function':
+                    logger.critical(f'invalid operating mode for job {job_id} {user.username}, {mode}, '
+                                    f'passing to cloud function')
+
+                run_job_playlist_function(username=user.username, job_id=job_id, playlist_id=playlist_id)
+
+        except Exception:
+            logger.exception(f'error queuing {playlist_id} of job {job_id} for {user.username}')
+            pending += claim_ready_playlists(fireo.transaction(), user, job_id, finished_id=playlist_id,
+                                             status=FAILED)
+
+
+def run_job_playlist(username: str, job_id: str, playlist_id: str):
+    """Run one playlist of a job, then queue the job's playlists it leaves ready
+
+    A failed run is recorded and its dependents still run, as they would after a failed run outside of a job
+
+    Args:
+        username (str): Subject user's username
+        job_id (str): Subject job ID
+        playlist_id (str): Subject playlist ID
+    """
+
+    user = User.collection.filter('username', '==', username.strip().lower()).get()
+
+    if user is None:
+        logger.error(f'user {username} not found')
+        return
+
+    playlist = Playlist.collection.get(f'{user.key}/playlists/{playlist_id}')
+    status = SUCCEEDED
+
+    if playlist is None:
+        logger.error(f'playlist {playlist_id} of job {job_id} not found for {username}')
+        status = FAILED
+    else:
+        try:
+            run_now(user=user, playlist=playlist)
+        except Exception:
+            logger.exception(f'error running {username} / {playlist.name} for job {job_id}')
+            status = FAILED
+
+    ready = claim_ready_playlists(fireo.transaction(), user, job_id, finished_id=playlist_id, status=status)
+    dispatch_job_playlists(user, job_id, ready)
@@ -27,6 +27,22 @@ def update_tag(username: str, tag_id: str) -> None:
     publisher.publish(f'projects/{os.environ["GOOGLE_CLOUD_PROJECT"]}/topics/update_tag', b'', tag_id=tag_id, username=username)
 
 
+def update_user_tags(username: str) -> None:
+    """Queue serverless update of all of a user's tags in one execution
+
+    Args:
+        username (str): Subject username
+    """
+
+    logger.info(f'queuing tag updates for {username}')
+
+    if not isinstance(username, str):
+        logger.error(f'username not a string, {type(username)}')
+        return
+
+    publisher.publish(f'projects/{os.environ["GOOGLE_CLOUD_PROJECT"]}/topics/update_tag', b'', username=username)
+
+
 def run_user_playlist_function(username: str, playlist_name: str) -> None:
     """Queue serverless playlist update for user
 
@@ -46,3 +62,21 @@ def run_user_playlist_function(username: str, playlist_name: str) -> None:
         return
 
     publisher.publish(f'projects/{os.environ["GOOGLE_CLOUD_PROJECT"]}/topics/run_user_playlist', b'', name=playlist_name, username=username)
+
+
+def run_job_playlist_function(username: str, job_id: str, playlist_id: str) -> None:
+    """Queue serverless run of one playlist of a run job, the run queues the job's playlists it leaves ready
+
+    Args:
+        username (str): Subject username
+        job_id (str): Subject job ID
+        playlist_id (str): Subject playlist ID
+
+    Raises:
+        Exception: Publishing failed
+    """
+
+    logger.info(f'queuing {playlist_id} of job {job_id} for {username}')
+
+    publisher.publish(f'projects/{os.environ["GOOGLE_CLOUD_PROJECT"]}/topics/run_user_playlist', b'',
+                      job_id=job_id, playlist_id=playlist_id, username=username).result()
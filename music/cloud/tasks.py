@@ -9,9 +9,10 @@ import logging
 from google.cloud import tasks_v2
 from google.protobuf import timestamp_pb2
 
-from music.tasks.run_user_playlist import run_user_playlist
+from music.tasks.run_playlists import run_playlists
 from music.tasks.refresh_lastfm_stats import refresh_lastfm_track_stats
 
+
 from music.model.user import User
 from music.model.playlist import Playlist
 from music.model.tag import Tag
@@ -32,27 +33,43 @@ def update_all_user_playlists():
 
         if iter_user.spotify_linked and not iter_user.locked:
 
-            task = {
-                'app_engine_http_request': {  # Specify the type of request.
-                    'http_method': 'POST',
-                    'relative_uri': '/api/playlist/run/user/task',
-                    'body': iter_user.username.encode()
-                }
-            }
+            update_playlists_task(iter_user.username, delay=seconds_delay)
+            seconds_delay += 30
 
-            d = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds_delay)
 
-            timestamp = timestamp_pb2.Timestamp()
-            timestamp.FromDatetime(d)
+def update_playlists_task(username: str, delay: int = 0):
+    """Create a task queuing a refresh of all of a user's playlists, each playlist runs in its own execution
 
-            task['schedule_time'] = timestamp
+    Args:
+        username (str): Subject user's username
+        delay (int, optional): Seconds to delay execution by. Defaults to 0.
+    """
 
-            tasker.create_task(parent=task_path, task=task)
-            seconds_delay += 30
+    task = {
+        'app_engine_http_request': {  # Specify the type of request.
+            'http_method': 'POST',
+            'relative_uri': '/api/playlist/run/user/task',
+            'body': username.encode()
+        }
+    }
+
+    if delay > 0:
+        d = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+        timestamp = timestamp_pb2.Timestamp()
+        timestamp.FromDatetime(d)
+
+        task['schedule_time'] = timestamp
+
+    tasker.create_task(parent=task_path, task=task)
 
 
 def update_playlists(username: str):
-    """Refresh all playlists for given user, environment dependent
+    """Refresh all playlists for given user in dependency order
+
+    Playlists only run after the playlists they reference and independent playlists run concurrently up to the
+    configured limit, all within this execution. Used when not deployed, deployed refreshes are split into one
+    execution per playlist by music.cloud.queue_user_playlists
 
     Args:
         username (str): Subject user's username
@@ -64,20 +81,13 @@ def update_playlists(username: str):
         logger.error(f'user {username} not found')
         return
 
-    playlists = Playlist.collection.parent(user.key).fetch()
+    playlists = {i.id: i for i in Playlist.collection.parent(user.key).fetch() if i.uri is not None}
+    references = {playlist_id: [i.id for i in playlist.playlist_references or []]
+                  for playlist_id, playlist in playlists.items()}
 
-    seconds_delay = 0
     logger.info(f'running {username}')
 
-    for iterate_playlist in playlists:
-        if iterate_playlist.uri is not None:
-
-            if os.environ.get('DEPLOY_DESTINATION', None) == 'PROD':
-                run_user_playlist_task(username, iterate_playlist.name, seconds_delay)
-            else:
-                run_user_playlist(user, iterate_playlist)
-
-            seconds_delay += 6
+    run_playlists(user, playlists, references)
 
 
 def run_user_playlist_task(username: str, playlist_name: str, delay: int = 0):
@@ -114,6 +124,30 @@ def run_user_playlist_task(username: str, playlist_name: str, delay: int = 0):
     tasker.create_task(parent=task_path, task=task)
 
 
+def run_job_playlist_task(username: str, job_id: str, playlist_id: str):
+    """Create a task running one playlist of a run job, the run queues the job's playlists it leaves ready
+
+    Args:
+        username (str): Subject user's username
+        job_id (str): Subject job ID
+        playlist_id (str): Subject playlist ID
+    """
+
+    task = {
+        'app_engine_http_request': {  # Specify the type of request.
+            'http_method': 'POST',
+            'relative_uri': '/api/playlist/run/task',
+            'body': json.dumps({
+                'username': username,
+                'job_id': job_id,
+                'playlist_id': playlist_id
+            }).encode()
+        }
+    }
+
+    tasker.create_task(parent=task_path, task=task)
+
+
 def refresh_all_user_playlist_stats():
     """"Create user playlist stats refresh task for all users"""
 
@@ -258,7 +292,7 @@ def refresh_playlist_task(username: str, playlist_name: str, delay: int = 0):
 
 
 def update_all_user_tags():
-    """Create user tag refresh task for all users"""
+    """Create a tag refresh task for each user, each refreshes all of the user's tags at once"""
 
     seconds_delay = 0
     logger.info('running')
@@ -267,25 +301,25 @@ def update_all_user_tags():
 
         if iter_user.lastfm_username and len(iter_user.lastfm_username) > 0 and not iter_user.locked:
 
-            for tag in Tag.collection.parent(iter_user.key).fetch():
-
-                task = {
-                    'app_engine_http_request': {  # Specify the type of request.
-                        'http_method': 'POST',
-                        'relative_uri': '/api/tag/update/task',
-                        'body': json.dumps({
-                                    'username': iter_user.username,
-                                    'tag_id': tag.tag_id
-                                }).encode()
-                    }
+            if next(iter(Tag.collection.parent(iter_user.key).fetch(limit=1)), None) is None:  # no tags to refresh
+                continue
+
+            task = {
+                'app_engine_http_request': {  # Specify the type of request.
+                    'http_method': 'POST',
+                    'relative_uri': '/api/tag/update/user/task',
+                    'body': json.dumps({
+                                'username': iter_user.username
+                            }).encode()
                 }
+            }
 
-                d = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds_delay)
+            d = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds_delay)
 
-                timestamp = timestamp_pb2.Timestamp()
-                timestamp.FromDatetime(d)
+            timestamp = timestamp_pb2.Timestamp()
+            timestamp.FromDatetime(d)
 
-                task['schedule_time'] = timestamp
+            task['schedule_time'] = timestamp
 
-                tasker.create_task(parent=task_path, task=task)
-                seconds_delay += 10
+            tasker.create_task(parent=task_path, task=task)
+            seconds_delay += 10
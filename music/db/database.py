@@ -1,19 +1,37 @@
 from dataclasses import dataclass
 import logging
+import os
+import threading
 from datetime import timedelta, datetime, timezone
 from typing import Optional
 
 from spotframework.net.network import Network as SpotifyNetwork, SpotifyNetworkException
 from spotframework.net.user import NetworkUser
 from fmframework.net.network import Network as FmNetwork
-from music.model.user import User
+from music.cache import MemoryCache
+from music.model.user import User, get_user
+from music.secrets import get_secret
 
 from music.magic_strings import SPOT_CLIENT_URI, SPOT_SECRET_URI, LASTFM_CLIENT_URI
 
-from google.cloud import secretmanager
-
 logger = logging.getLogger(__name__)
-secret_client = secretmanager.SecretManagerServiceClient()
+network_pool = MemoryCache(max_size=int(os.environ.get('NETWORK_POOL_SIZE', 64)),
+                           ttl=int(os.environ.get('NETWORK_POOL_TTL', 3600)))
+"""Authenticated Spotify networks keyed by username, reused with their HTTP sessions between requests
+"""
+USER_INFO_STALE_AFTER = timedelta(days=7)
+"""Age after which cached Spotify profile info is refetched
+"""
+
+network_locks = {}
+network_locks_lock = threading.Lock()
+
+
+def get_network_lock(username: str) -> threading.Lock:
+    """Get the lock serialising network construction and token refreshes for a user"""
+
+    with network_locks_lock:
+        return network_locks.setdefault(username, threading.Lock())
 
 
 def refresh_token_database_callback(user: User) -> None:
@@ -26,7 +44,7 @@ def refresh_token_database_callback(user: User) -> None:
     """
 
     if isinstance(user, DatabaseUser):
-        user_obj = User.collection.filter('username', '==', user.user_id.strip().lower()).get()
+        user_obj = get_user(user.user_id)
         if user_obj is None:
             logger.error(f'user {user} not found')
 
@@ -45,6 +63,9 @@ def refresh_token_database_callback(user: User) -> None:
 def get_authed_spotify_network(user: User) -> Optional[SpotifyNetwork]:
     """Get an authenticated spotframework network for a given user
 
+    Networks are pooled per username and reused while the user's refresh token is unchanged, expired access tokens
+    are refreshed on the pooled network
+
     Args:
         user (User): Subject user to retrieve a network for
 
@@ -54,37 +75,104 @@ def get_authed_spotify_network(user: User) -> Optional[SpotifyNetwork]:
 
     if user is not None:
         if user.spotify_linked:
-            spot_client = secret_client.access_secret_version(request={"name": SPOT_CLIENT_URI})
-            spot_secret = secret_client.access_secret_version(request={"name": SPOT_SECRET_URI})
+            with get_network_lock(user.username):
+                net = network_pool.get(user.username)
 
-            user_obj = DatabaseUser(client_id=spot_client.payload.data.decode("UTF-8"),
-                                    client_secret=spot_secret.payload.data.decode("UTF-8"),
-                                    refresh_token=user.refresh_token,
-                                    user_id=user.username,
-                                    access_token=user.access_token)
-            user_obj.on_refresh.append(refresh_token_database_callback)
+                # relinked or unlinked elsewhere
+                if net is not None and net.user.refresh_token != user.refresh_token:
+                    logger.debug(f'refresh token changed, discarding pooled network for {user.username}')
+                    net = None
 
-            net = SpotifyNetwork(user_obj)
+                if net is None:
+                    net = create_spotify_network(user)
+                    network_pool.set(user.username, net)
 
-            if user.last_refreshed is not None and user.token_expiry is not None:
-                if user.last_refreshed + timedelta(seconds=user.token_expiry - 1) \
-                        < datetime.now(timezone.utc):
+                elif token_expired(net.user.last_refreshed, net.user.token_expiry):
                     net.refresh_access_token()
-            else:
-                net.refresh_access_token()
-
-            try:
-                net.refresh_user_info()
-            except SpotifyNetworkException:
-                logger.exception(f'error refreshing user info for {user.username}')
 
             return net
         else:
             logger.error('user spotify not linked')
+            network_pool.delete(user.username)
     else:
         logger.error(f'no user provided')
 
 
+def create_spotify_network(user: User) -> SpotifyNetwork:
+    """Create and authenticate a new spotframework network for a given user
+
+    Args:
+        user (User): Subject user
+
+    Returns:
+        SpotifyNetwork: Authenticated spotframework network
+    """
+
+    user_obj = DatabaseUser(client_id=get_secret(SPOT_CLIENT_URI),
+                            client_secret=get_secret(SPOT_SECRET_URI),
+                            refresh_token=user.refresh_token,
+                            user_id=user.username,
+                            access_token=user.access_token)
+    user_obj.last_refreshed = user.last_refreshed
+    user_obj.token_expiry = user.token_expiry
+    user_obj.on_refresh.append(refresh_token_database_callback)
+
+    net = SpotifyNetwork(user_obj)
+
+    if token_expired(user.last_refreshed, user.token_expiry):
+        net.refresh_access_token()
+
+    return net
+
+
+def get_spotify_display_name(user: User, net: SpotifyNetwork = None) -> Optional[str]:
+    """Get a user's Spotify display name, only requesting their profile when the cached value is stale
+
+    Args:
+        user (User): Subject user
+        net (SpotifyNetwork, optional): User's authenticated network if already retrieved. Defaults to None.
+
+    Returns:
+        Optional[str]: Spotify display name
+    """
+
+    if user.spotify_display_name is not None and user.spotify_info_refreshed is not None \
+            and user.spotify_info_refreshed + USER_INFO_STALE_AFTER > datetime.now(timezone.utc):
+        return user.spotify_display_name
+
+    if net is None:
+        net = get_authed_spotify_network(user)
+
+    try:
+        net.refresh_user_info()
+    except SpotifyNetworkException:
+        logger.exception(f'error refreshing user info for {user.username}')
+        return user.spotify_display_name
+
+    user.spotify_display_name = net.user.user.display_name
+    user.spotify_info_refreshed = datetime.now(timezone.utc)
+    user.update()
+
+    return user.spotify_display_name
+
+
+def token_expired(last_refreshed: Optional[datetime], token_expiry: Optional[int]) -> bool:
+    """Check whether an access token needs refreshing
+
+    Args:
+        last_refreshed (Optional[datetime]): Time the token was issued
+        token_expiry (Optional[int]): Token lifetime in seconds
+
+    Returns:
+        bool: True if expired or unknown
+    """
+
+    if last_refreshed is None or token_expiry is None:
+        return True
+
+    return last_refreshed + timedelta(seconds=token_expiry - 1) < datetime.now(timezone.utc)
+
+
 def get_authed_lastfm_network(user: User) -> Optional[FmNetwork]:
     """Get an authenticated fmframework network for a given user
 
@@ -97,9 +185,7 @@ def get_authed_lastfm_network(user: User) -> Optional[FmNetwork]:
 
     if user is not None:
         if user.lastfm_username:
-            lastfm_client = secret_client.access_secret_version(request={"name": LASTFM_CLIENT_URI})
-
-            return FmNetwork(username=user.lastfm_username, api_key=lastfm_client.payload.data.decode("UTF-8"))
+            return FmNetwork(username=user.lastfm_username, api_key=get_secret(LASTFM_CLIENT_URI))
         else:
             logger.error(f'{user.username} has no last.fm username')
     else:
@@ -0,0 +1,290 @@
+"""Persisted per-user index of Spotify saved tracks, synced incrementally instead of paging the whole library
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+import fireo
+from fireo.database import db
+from google.api_core.exceptions import GoogleAPICallError
+from spotframework.net.network import Network as SpotNetwork
+
+from music.model.user import User
+from music.model.library import LibraryIndex, LibraryChunk
+from music.tasks.track_record import TrackRecord, to_records
+
+logger = logging.getLogger(__name__)
+
+INDEX_ID = 'library'
+
+LIBRARY_CHUNK_SIZE = 1000
+"""Tracks stored per chunk document
+"""
+LIBRARY_DELTA_PAGE = 50
+"""Tracks requested by the first delta sync call, grown until a known track is reached
+"""
+LIBRARY_DELTA_LIMIT = 2000
+"""Newest tracks requested before giving up on a delta and fully syncing
+"""
+LIBRARY_FULL_SYNC_INTERVAL = timedelta(days=1)
+"""Maximum time between full reconciliations, picks up removed tracks
+"""
+LIBRARY_SYNC_LEASE = timedelta(minutes=5)
+"""Time one sync may hold a user's index before another is allowed to take over
+"""
+LIBRARY_SYNC_REUSE = timedelta(minutes=1)
+"""Syncs finished this recently are served from the index instead of paging Spotify again
+"""
+LIBRARY_LEASE_POLL_SECONDS = 2
+
+_sync_locks = defaultdict(threading.Lock)
+_sync_locks_lock = threading.Lock()
+
+
+def get_library_index(user: User, transaction=None) -> Optional[LibraryIndex]:
+    """Get a user's stored library index metadata
+
+    Args:
+        user (User): Subject user
+        transaction (optional): Firestore transaction to read in. Defaults to None.
+
+    Returns:
+        Optional[LibraryIndex]: Stored index if one exists
+    """
+
+    return LibraryIndex.collection.get(f'{user.key}/library_indexes/{INDEX_ID}', transaction=transaction)
+
+
+@fireo.transactional
+def take_sync_lease(transaction, user: User) -> Optional[LibraryIndex]:
+    """Lease a user's index for one sync if no other sync holds it
+
+    Args:
+        transaction: Firestore transaction
+        user (User): Subject user
+
+    Returns:
+        Optional[LibraryIndex]: Leased index, created if none is stored, None if another sync holds it
+    """
+
+    index = get_library_index(user, transaction=transaction)
+    now = datetime.now(timezone.utc)
+
+    if index is None:
+        index = LibraryIndex(parent=user.key)
+        index.id = INDEX_ID
+    elif index.sync_lease_until is not None and index.sync_lease_until > now:
+        return None
+
+    index.sync_lease_until = now + LIBRARY_SYNC_LEASE
+    index.save(transaction=transaction)
+
+    return index
+
+
+def acquire_sync_lease(user: User) -> LibraryIndex:
+    """Lease a user's index, waiting for any sync already running elsewhere to finish
+
+    Args:
+        user (User): Subject user
+
+    Returns:
+        LibraryIndex: Leased index
+    """
+
+    deadline = time.monotonic() + LIBRARY_SYNC_LEASE.total_seconds()
+
+    while (index := take_sync_lease(fireo.transaction(), user)) is None:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'library index of {user.username} still leased')
+
+        logger.debug(f'waiting for library sync lease for {user.username}')
+        time.sleep(LIBRARY_LEASE_POLL_SECONDS)
+
+    return index
+
+
+def release_sync_lease(user: User) -> None:
+    """Release a user's index for the next sync
+
+    Errors are logged rather than raised, an unreleased lease expires by itself
+
+    Args:
+        user (User): Subject user
+    """
+
+    try:
+        db.conn.document(f'{user.key}/library_indexes/{INDEX_ID}').update({'sync_lease_until': None})
+    except GoogleAPICallError:
+        logger.exception(f'error releasing library sync lease for {user.username}')
+
+
+def load_library_records(user: User, index: LibraryIndex) -> List[TrackRecord]:
+    """Load a user's stored saved tracks
+
+    Args:
+        user (User): Subject user
+        index (LibraryIndex): User's index metadata
+
+    Returns:
+        List[TrackRecord]: Saved tracks, oldest first
+    """
+
+    chunks = sorted(LibraryChunk.collection.parent(user.key).fetch(), key=lambda i: i.index)
+
+    if len(chunks) != index.chunk_count:
+        logger.warning(f'expected {index.chunk_count} library chunks, found {len(chunks)} for {user.username}')
+
+    return [TrackRecord.from_dict(i) for chunk in chunks for i in chunk.tracks]
+
+
+def store_library_records(user: User, records: List[TrackRecord], index: LibraryIndex,
+                          from_chunk: int = 0, full_sync: bool = False) -> None:
+    """Write a user's saved tracks and index metadata
+
+    Args:
+        user (User): Subject user
+        records (List[TrackRecord]): All saved tracks, oldest first
+        index (LibraryIndex): User's index metadata to update
+        from_chunk (int, optional): First chunk that changed, earlier chunks are left as is. Defaults to 0.
+        full_sync (bool, optional): Records come from a full library read. Defaults to False.
+    """
+
+    chunk_count = -(-len(records) // LIBRARY_CHUNK_SIZE)
+
+    for chunk_index in range(from_chunk, chunk_count):
+        chunk = LibraryChunk(parent=user.key)
+        chunk.id = f'chunk_{chunk_index}'
+        chunk.index = chunk_index
+        chunk.tracks = [i.to_dict() for i in
+                        records[chunk_index * LIBRARY_CHUNK_SIZE:(chunk_index + 1) * LIBRARY_CHUNK_SIZE]]
+        chunk.save()
+
+    for chunk_index in range(chunk_count, index.chunk_count or 0):
+        LibraryChunk.collection.delete(f'{user.key}/library_chunks/chunk_{chunk_index}')
+
+    now = datetime.now(timezone.utc)
+
+    index.track_count = len(records)
+    index.chunk_count = chunk_count
+    index.newest_added_at = max((i.added_at for i in records if i.added_at is not None), default=None)
+    index.last_synced = now
+    if full_sync:
+        index.last_full_sync = now
+    index.save()
+
+
+def full_sync(spotnet: SpotNetwork, user: User, index: LibraryIndex) -> List[TrackRecord]:
+    """Page the whole library and store it
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        user (User): Subject user
+        index (LibraryIndex): User's index metadata to update
+
+    Returns:
+        List[TrackRecord]: Saved tracks, oldest first
+    """
+
+    logger.info(f'full library sync for {user.username}')
+
+    records = to_records(spotnet.saved_tracks() or [])
+    records.sort(key=lambda i: i.added_at or datetime.min.replace(tzinfo=timezone.utc))
+
+    store_library_records(user, records, index, full_sync=True)
+
+    return records
+
+
+def sync_library(spotnet: SpotNetwork, user: User) -> List[TrackRecord]:
+    """Get a user's saved tracks, only paging Spotify for tracks saved since the last sync
+
+    The newest tracks are requested with a growing limit until one already in the index is reached. The library is
+    fully re-read periodically to reconcile removed tracks. One sync runs per user at a time, threads of this process
+    queue on a lock and other processes on a lease stored on the index. A sync that waited is served from the index
+    if the one before it has just finished
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        user (User): Subject user
+
+    Raises:
+        SpotifyNetworkException: Error retrieving tracks from Spotify
+        TimeoutError: Another sync held the user's index for longer than its lease
+
+    Returns:
+        List[TrackRecord]: Saved tracks, newest first
+    """
+
+    with _sync_locks_lock:
+        lock = _sync_locks[user.username]
+
+    with lock:
+        index = acquire_sync_lease(user)
+        try:
+            return sync_index(spotnet, user, index)
+        finally:
+            release_sync_lease(user)
+
+
+def sync_index(spotnet: SpotNetwork, user: User, index: LibraryIndex) -> List[TrackRecord]:
+    """Bring a user's leased index up to date with their saved tracks
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        user (User): Subject user
+        index (LibraryIndex): User's leased index metadata
+
+    Returns:
+        List[TrackRecord]: Saved tracks, newest first
+    """
+
+    now = datetime.now(timezone.utc)
+
+    if index.newest_added_at is None or index.last_full_sync is None \
+            or index.last_full_sync + LIBRARY_FULL_SYNC_INTERVAL < now:
+        return list(reversed(full_sync(spotnet, user, index)))
+
+    if index.last_synced is not None and now - index.last_synced < LIBRARY_SYNC_REUSE:
+        logger.debug(f'library synced recently, serving index for {user.username}')
+        return list(reversed(load_library_records(user, index)))
+
+    limit = LIBRARY_DELTA_PAGE
+    while True:
+        newest = to_records(spotnet.saved_tracks(response_limit=limit) or [])
+
+        if len(newest) < limit or any(i.added_at is not None and i.added_at <= index.newest_added_at
+                                      for i in newest):
+            break
+
+        limit *= 4
+        if limit > LIBRARY_DELTA_LIMIT:
+            logger.info(f'library delta too large for {user.username}')
+            return list(reversed(full_sync(spotnet, user, index)))
+
+    added = [i for i in newest if i.added_at is not None and i.added_at > index.newest_added_at]
+    added.sort(key=lambda i: i.added_at)
+
+    records = load_library_records(user, index)
+
+    if len(added) > 0:
+        added_uris = {i.uri for i in added}
+
+        if any(i.uri in added_uris for i in records):  # re-saved tracks move, rewrite everything
+            records = [i for i in records if i.uri not in added_uris] + added
+            store_library_records(user, records, index)
+        else:
+            from_chunk = len(records) // LIBRARY_CHUNK_SIZE
+            records += added
+            store_library_records(user, records, index, from_chunk=from_chunk)
+
+        logger.info(f'{len(added)} new library tracks for {user.username}')
+    else:
+        index.last_synced = datetime.now(timezone.utc)
+        index.save()
+
+    return list(reversed(records))
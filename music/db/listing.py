@@ -0,0 +1,129 @@
+"""Projected, cursor paginated listing of Firestore collections for API list views
+"""
+
+import base64
+import json
+from typing import Iterable, List, Optional, Tuple
+
+from google.cloud.firestore_v1 import CollectionReference, DocumentSnapshot
+
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(values: list) -> str:
+    """Encode the order values of the last returned document as an opaque cursor
+
+    Args:
+        values (list): Order field value and document ID
+
+    Returns:
+        str: URL safe cursor
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """Decode a cursor produced by encode_cursor
+
+    Args:
+        cursor (str): URL safe cursor
+
+    Raises:
+        ValueError: Malformed cursor
+
+    Returns:
+        list: Order field value and document ID
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError('malformed cursor') from e
+
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('malformed cursor')
+    return values
+
+
+def get_public_fields(model) -> List[str]:
+    """Get the stored fields of a model that may be returned by the API
+
+    Args:
+        model: fireo Model class, fields listed in its hidden_fields are excluded
+
+    Returns:
+        List[str]: Field names
+    """
+
+    hidden = getattr(model, 'hidden_fields', [])
+    return [i for i in model._meta.field_list if i != model._meta.id[0] and i not in hidden]
+
+
+def parse_fields(fields: Optional[str], allowed: Iterable[str]) -> Optional[List[str]]:
+    """Parse a comma separated field projection
+
+    Args:
+        fields (Optional[str]): Requested fields, e.g. name,type,last_updated
+        allowed (Iterable[str]): Fields that may be requested
+
+    Raises:
+        ValueError: A requested field is not allowed
+
+    Returns:
+        Optional[List[str]]: Requested fields, None if all were requested
+    """
+
+    if fields is None or len(fields.strip()) == 0:
+        return None
+
+    requested = list(dict.fromkeys(i.strip() for i in fields.split(',') if i.strip()))
+    if disallowed := [i for i in requested if i not in allowed]:
+        raise ValueError(f'unknown fields {", ".join(disallowed)}')
+    return requested
+
+
+def list_documents(collection: CollectionReference,
+                   order_field: str,
+                   fields: Optional[List[str]] = None,
+                   limit: Optional[int] = None,
+                   cursor: Optional[str] = None) -> Tuple[List[DocumentSnapshot], Optional[str]]:
+    """List a collection ordered by a field, reading only the projected fields
+
+    Args:
+        collection (CollectionReference): Subject collection
+        order_field (str): Field to order by, documents without it are not returned
+        fields (Optional[List[str]], optional): Fields to read, all if None. Defaults to None.
+        limit (Optional[int], optional): Page size, unbounded if None. Defaults to None.
+        cursor (Optional[str], optional): Cursor returned with the previous page. Defaults to None.
+
+    Raises:
+        ValueError: Malformed cursor
+
+    Returns:
+        Tuple[List[DocumentSnapshot], Optional[str]]: Page of documents and the cursor of the next page if any
+    """
+
+    if limit is not None:
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    query = collection.order_by(order_field).order_by('__name__')
+
+    if fields is not None:
+        query = query.select(list(dict.fromkeys(fields + [order_field])))
+
+    if cursor is not None:
+        value, document_id = decode_cursor(cursor)
+        query = query.start_after({order_field: value, '__name__': document_id})
+
+    if limit is not None:
+        query = query.limit(limit + 1)  # one extra shows whether there's another page
+
+    documents = list(query.stream())
+
+    next_cursor = None
+    if limit is not None and len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor([documents[-1].get(order_field), documents[-1].id])
+
+    return documents, next_cursor
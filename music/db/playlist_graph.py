@@ -0,0 +1,305 @@
+"""Maintain the materialised playlist dependency index used in place of walking references on each run
+"""
+
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+import fireo
+from google.api_core.exceptions import GoogleAPICallError
+
+from music.model.user import User
+from music.model.playlist import Playlist
+from music.model.playlist_graph import PlaylistGraph
+
+logger = logging.getLogger(__name__)
+
+GRAPH_ID = 'graph'
+
+
+def get_playlist_graph(user: User, transaction=None) -> Optional[PlaylistGraph]:
+    """Get a user's stored playlist dependency index
+
+    Args:
+        user (User): Subject user
+        transaction (optional): Firestore transaction to read in. Defaults to None.
+
+    Returns:
+        Optional[PlaylistGraph]: Stored index if one exists
+    """
+
+    return PlaylistGraph.collection.get(f'{user.key}/playlist_graphs/{GRAPH_ID}', transaction=transaction)
+
+
+def build_playlist_graph(user: User, playlists: Iterable[Playlist] = None) -> PlaylistGraph:
+    """Build and store a user's playlist dependency index from scratch
+
+    Args:
+        user (User): Subject user
+        playlists (Iterable[Playlist], optional): User's playlists if already loaded. Defaults to None.
+
+    Returns:
+        PlaylistGraph: Stored index
+    """
+
+    logger.info(f'building playlist graph for {user.username}')
+
+    if playlists is None:
+        playlists = Playlist.collection.parent(user.key).fetch()
+
+    graph = PlaylistGraph(parent=user.key)
+    graph.id = GRAPH_ID
+    graph.names, graph.parts, graph.references = {}, {}, {}
+
+    for playlist in playlists:
+        set_node(graph, playlist)
+
+    graph.dependents = {i: [] for i in graph.names}
+    for playlist_id, references in graph.references.items():
+        for reference in references:
+            if reference in graph.dependents:
+                graph.dependents[reference].append(playlist_id)
+
+    graph.flattened_parts = {i: flatten_parts(graph, i) for i in graph.names}
+    graph.last_updated = datetime.utcnow()
+    graph.save()
+
+    return graph
+
+
+def set_node(graph: PlaylistGraph, playlist: Playlist) -> None:
+    """Set a playlist's own fields in the index without updating reverse edges or flattened parts
+
+    Args:
+        graph (PlaylistGraph): Subject index
+        playlist (Playlist): Playlist to write
+    """
+
+    graph.names[playlist.id] = playlist.name
+    graph.parts[playlist.id] = list(playlist.parts or [])
+    graph.references[playlist.id] = [i.id for i in playlist.playlist_references or []]
+
+
+def flatten_parts(graph: PlaylistGraph, playlist_id: str) -> List[str]:
+    """Resolve the transitive set of parts for a playlist by walking references breadth-first
+
+    Args:
+        graph (PlaylistGraph): Subject index
+        playlist_id (str): Subject playlist ID
+
+    Returns:
+        List[str]: Sorted component Spotify playlist names
+    """
+
+    parts = set()
+    visited = set()
+    queue = deque([playlist_id])
+
+    while queue:
+        current = queue.popleft()
+        if current in visited:
+            continue
+        visited.add(current)
+
+        parts.update(graph.parts.get(current, []))
+        queue.extend(graph.references.get(current, []))
+
+    return sorted(parts)
+
+
+def get_dependents(graph: PlaylistGraph, playlist_id: str) -> List[str]:
+    """Get the IDs of all playlists transitively referencing a playlist
+
+    Args:
+        graph (PlaylistGraph): Subject index
+        playlist_id (str): Subject playlist ID
+
+    Returns:
+        List[str]: Dependent playlist IDs, nearest first
+    """
+
+    dependents = []
+    visited = {playlist_id}
+    queue = deque(graph.dependents.get(playlist_id, []))
+
+    while queue:
+        current = queue.popleft()
+        if current in visited:
+            continue
+        visited.add(current)
+        dependents.append(current)
+
+        queue.extend(graph.dependents.get(current, []))
+
+    return dependents
+
+
+def creates_cycle(graph: PlaylistGraph, playlist_id: str, reference_ids: Iterable[str]) -> bool:
+    """Check whether pointing a playlist at the given references would create a reference cycle
+
+    Args:
+        graph (PlaylistGraph): Subject index
+        playlist_id (str): Subject playlist ID
+        reference_ids (Iterable[str]): Proposed referenced playlist IDs
+
+    Returns:
+        bool: True if the playlist would be reachable from its own references
+    """
+
+    visited = set()
+    queue = deque(reference_ids)
+
+    while queue:
+        current = queue.popleft()
+        if current == playlist_id:
+            return True
+        if current in visited:
+            continue
+        visited.add(current)
+
+        queue.extend(graph.references.get(current, []))
+
+    return False
+
+
+def update_playlist_node(user: User, playlist: Playlist) -> List[str]:
+    """Incrementally update the index after a playlist's parts or references change
+
+    The index is read and written in one transaction so concurrent edits of a user's playlists aren't lost. The
+    playlist itself is already written, if the transaction fails the index is rebuilt from the stored playlists
+    instead of being left stale
+
+    Args:
+        user (User): Subject user
+        playlist (Playlist): Created or updated playlist
+
+    Returns:
+        List[str]: Names of dependent playlists affected by the change
+    """
+
+    try:
+        dependent_names = write_playlist_node(fireo.transaction(), user, playlist)
+    except (GoogleAPICallError, ValueError):  # ValueError when contended commits run out of attempts
+        logger.exception(f'error updating index for {user.username} / {playlist.name}, rebuilding')
+        dependent_names = None
+
+    if dependent_names is None:
+        build_playlist_graph(user)
+        return []
+
+    if len(dependent_names) > 0:
+        logger.info(f'{user.username} / {playlist.name} change affects {", ".join(dependent_names)}')
+
+    return dependent_names
+
+
+@fireo.transactional
+def write_playlist_node(transaction, user: User, playlist: Playlist) -> Optional[List[str]]:
+    """Write a playlist to the stored index
+
+    Reverse edges are adjusted for added and removed references and flattened parts are recomputed for the
+    playlist and its dependents only
+
+    Args:
+        transaction: Firestore transaction
+        user (User): Subject user
+        playlist (Playlist): Created or updated playlist
+
+    Returns:
+        Optional[List[str]]: Names of dependent playlists affected by the change, None if no index is stored
+    """
+
+    graph = get_playlist_graph(user, transaction=transaction)
+    if graph is None:
+        return None
+
+    old_references = set(graph.references.get(playlist.id, []))
+    set_node(graph, playlist)
+    new_references = set(graph.references[playlist.id])
+
+    graph.dependents.setdefault(playlist.id, [])
+    for removed in old_references - new_references:
+        if removed in graph.dependents:
+            graph.dependents[removed] = [i for i in graph.dependents[removed] if i != playlist.id]
+    for added in new_references - old_references:
+        graph.dependents.setdefault(added, [])
+        if playlist.id not in graph.dependents[added]:
+            graph.dependents[added].append(playlist.id)
+
+    dependents = get_dependents(graph, playlist.id)
+    for playlist_id in [playlist.id] + dependents:
+        graph.flattened_parts[playlist_id] = flatten_parts(graph, playlist_id)
+
+    graph.last_updated = datetime.utcnow()
+    graph.save(transaction=transaction)  # full overwrite so removed map keys are dropped
+
+    return [graph.names[i] for i in dependents if i in graph.names]
+
+
+def remove_playlist_node(user: User, playlist_id: str) -> None:
+    """Remove a deleted playlist from the index, rebuilt from the stored playlists if the transaction fails
+
+    Args:
+        user (User): Subject user
+        playlist_id (str): Deleted playlist ID
+    """
+
+    try:
+        delete_playlist_node(fireo.transaction(), user, playlist_id)
+    except (GoogleAPICallError, ValueError):  # ValueError when contended commits run out of attempts
+        logger.exception(f'error removing {playlist_id} from index for {user.username}, rebuilding')
+        build_playlist_graph(user)
+
+
+@fireo.transactional
+def delete_playlist_node(transaction, user: User, playlist_id: str) -> None:
+    """Delete a playlist from the stored index, read and written in one transaction
+
+    Args:
+        transaction: Firestore transaction
+        user (User): Subject user
+        playlist_id (str): Deleted playlist ID
+    """
+
+    graph = get_playlist_graph(user, transaction=transaction)
+    if graph is None:
+        return
+
+    for reference in graph.references.get(playlist_id, []):
+        if reference in graph.dependents:
+            graph.dependents[reference] = [i for i in graph.dependents[reference] if i != playlist_id]
+
+    dependents = get_dependents(graph, playlist_id)
+    for dependent in graph.dependents.get(playlist_id, []):
+        if dependent in graph.references:
+            graph.references[dependent] = [i for i in graph.references[dependent] if i != playlist_id]
+
+    for field in (graph.names, graph.parts, graph.references, graph.dependents, graph.flattened_parts):
+        field.pop(playlist_id, None)
+
+    for dependent in dependents:
+        if dependent in graph.names:
+            graph.flattened_parts[dependent] = flatten_parts(graph, dependent)
+
+    graph.last_updated = datetime.utcnow()
+    graph.save(transaction=transaction)  # full overwrite so removed map keys are dropped
+
+
+def get_flattened_parts(user: User, playlist: Playlist) -> List[str]:
+    """Get a playlist's resolved component Spotify playlists from the index, building the index if needed
+
+    Args:
+        user (User): Subject user
+        playlist (Playlist): Subject playlist
+
+    Returns:
+        List[str]: Resolved component Spotify playlist names
+    """
+
+    graph = get_playlist_graph(user)
+
+    if graph is None or playlist.id not in graph.flattened_parts:
+        graph = build_playlist_graph(user)
+
+    return list(graph.flattened_parts.get(playlist.id, []))
@@ -0,0 +1,215 @@
+"""Track the progress of bulk playlist runs so clients can poll one job instead of running playlists one by one
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+import fireo
+from fireo.database import db
+from google.api_core.exceptions import GoogleAPICallError
+
+from music.model.user import User
+from music.model.playlist import Playlist
+from music.model.run_job import RunJob
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+FINISHED = (SUCCEEDED, FAILED, SKIPPED)
+
+RUN_JOB_RETENTION = timedelta(days=7)
+RUN_JOB_STALE_AFTER = timedelta(minutes=15)
+"""Unfinished jobs without progress for this long are failed, their executions were lost. Longer than one
+playlist's run can take
+"""
+
+
+def create_run_job(user: User, playlists: Iterable[Playlist]) -> RunJob:
+    """Create a job for a bulk run, playlists without a Spotify URI are marked as skipped
+
+    Args:
+        user (User): Subject user
+        playlists (Iterable[Playlist]): Playlists to be run
+
+    Returns:
+        RunJob: Stored job
+    """
+
+    playlists = list(playlists)
+
+    job = RunJob(parent=user.key)
+    job.playlists = {i.id: {'name': i.name, 'status': QUEUED if i.uri is not None else SKIPPED}
+                     for i in playlists}
+    job.references = {i.id: [j.id for j in i.playlist_references or [] if j.id in job.playlists and j.id != i.id]
+                      for i in playlists}
+    job.created = job.last_updated = datetime.utcnow()
+    job.expire_at = job.created + RUN_JOB_RETENTION
+    job.save()
+
+    logger.info(f'created run job {job.id} of {len(job.playlists)} playlists for {user.username}')
+
+    return job
+
+
+def get_ready_playlists(job: RunJob) -> List[str]:
+    """Get the queued playlists of a job whose referenced playlists in the job have all finished
+
+    Playlists caught in a reference cycle are all returned once nothing else is queued or running
+
+    Args:
+        job (RunJob): Subject job
+
+    Returns:
+        List[str]: Playlist IDs ready to run
+    """
+
+    statuses = {playlist_id: i['status'] for playlist_id, i in job.playlists.items()}
+    queued = [i for i, status in statuses.items() if status == QUEUED]
+
+    ready = [i for i in queued
+             if all(statuses.get(j, SUCCEEDED) in FINISHED for j in (job.references or {}).get(i, []))]
+
+    if len(ready) == 0 and len(queued) > 0 and RUNNING not in statuses.values():
+        logger.warning(f'reference cycle found between {len(queued)} playlists of job {job.id}, running anyway')
+        ready = queued
+
+    return ready
+
+
+@fireo.transactional
+def claim_ready_playlists(transaction, user: User, job_id: str, finished_id: Optional[str] = None,
+                          status: Optional[str] = None) -> List[str]:
+    """Record a finished playlist and mark the playlists it leaves ready as running in one transaction
+
+    Concurrently finishing playlists can't both claim the same dependent
+
+    Args:
+        transaction: Firestore transaction
+        user (User): Subject user
+        job_id (str): Subject job ID
+        finished_id (Optional[str], optional): Playlist that has finished. Defaults to None.
+        status (Optional[str], optional): Final status of the finished playlist. Defaults to None.
+
+    Returns:
+        List[str]: Claimed playlist IDs, the caller must run each
+    """
+
+    job = RunJob.collection.get(f'{user.key}/run_jobs/{job_id}', transaction=transaction)
+    if job is None:
+        logger.error(f'run job {job_id} not found for {user.username}')
+        return []
+
+    if finished_id is not None and finished_id in job.playlists:
+        job.playlists[finished_id]['status'] = status
+
+    ready = get_ready_playlists(job)
+    for playlist_id in ready:
+        job.playlists[playlist_id]['status'] = RUNNING
+
+    job.last_updated = datetime.utcnow()
+    job.update(transaction=transaction)
+
+    return ready
+
+
+def get_run_job(user: User, job_id: str) -> Optional[RunJob]:
+    """Get one of a user's bulk run jobs
+
+    Args:
+        user (User): Subject user
+        job_id (str): Subject job ID
+
+    Returns:
+        Optional[RunJob]: Found job
+    """
+
+    job = RunJob.collection.get(f'{user.key}/run_jobs/{job_id}')
+
+    if job is not None and is_stale(job):
+        unfinished = [i for i, status in job.playlists.items() if status['status'] not in FINISHED]
+
+        logger.warning(f'failing {len(unfinished)} playlists of stale run job {job_id} for {user.username}')
+
+        fail_run_job(user, job_id, unfinished)
+        for playlist_id in unfinished:
+            job.playlists[playlist_id]['status'] = FAILED
+
+    return job
+
+
+def set_run_job_status(user: User, job_id: str, playlist_id: str, status: str) -> None:
+    """Record the status of one playlist of a job without reading or rewriting the others
+
+    Errors are logged rather than raised, reporting progress shouldn't fail the run itself
+
+    Args:
+        user (User): Subject user
+        job_id (str): Subject job ID
+        playlist_id (str): Subject playlist ID
+        status (str): New status
+    """
+
+    try:
+        db.conn.document(f'{user.key}/run_jobs/{job_id}').update({
+            f'playlists.{playlist_id}.status': status,
+            'last_updated': datetime.utcnow()
+        })
+    except GoogleAPICallError:
+        logger.exception(f'error setting run job status {user.username} / {job_id} / {playlist_id}')
+
+
+def fail_run_job(user: User, job_id: str, playlist_ids: Iterable[str]) -> None:
+    """Mark playlists of a job as failed when their runs couldn't be started
+
+    Args:
+        user (User): Subject user
+        job_id (str): Subject job ID
+        playlist_ids (Iterable[str]): Playlists that won't be run
+    """
+
+    updates = {f'playlists.{i}.status': FAILED for i in playlist_ids}
+    if len(updates) == 0:
+        return
+
+    try:
+        db.conn.document(f'{user.key}/run_jobs/{job_id}').update({**updates, 'last_updated': datetime.utcnow()})
+    except GoogleAPICallError:
+        logger.exception(f'error failing run job {user.username} / {job_id}')
+
+
+def is_finished(job: RunJob) -> bool:
+    """Check whether every playlist of a job has finished
+
+    Args:
+        job (RunJob): Subject job
+
+    Returns:
+        bool: No playlists left queued or running, or the job has stalled
+    """
+
+    return all(i['status'] in FINISHED for i in job.playlists.values()) or is_stale(job)
+
+
+def is_stale(job: RunJob) -> bool:
+    """Check whether an unfinished job has made no progress within RUN_JOB_STALE_AFTER
+
+    Args:
+        job (RunJob): Subject job
+
+    Returns:
+        bool: Job has playlists left queued or running that won't finish
+    """
+
+    if job.last_updated is None or all(i['status'] in FINISHED for i in job.playlists.values()):
+        return False
+
+    last_updated = job.last_updated
+    if last_updated.tzinfo is not None:  # stored times are read back timezone aware
+        last_updated = last_updated.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return datetime.utcnow() - last_updated > RUN_JOB_STALE_AFTER
@@ -19,5 +19,8 @@ class Config(Model):
     playlist_cloud_operating_mode = TextField()  # task, function
     """Determines whether playlist and tag update operations are done by Cloud Tasks or Functions
     """
+    playlist_run_concurrency = NumberField(default=4)
+    """Maximum number of a user's playlist runs in flight at once
+    """
     jwt_max_length = NumberField()
     jwt_default_length = NumberField()
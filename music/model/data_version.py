@@ -0,0 +1,53 @@
+"""Per-user counter of writes to a user's data, used to validate cached API responses
+"""
+
+import logging
+
+from fireo.database import db
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+
+def get_version_path(key: str) -> str:
+    """Get the path of the version document for the user owning a document
+
+    Args:
+        key (str): Key of a user or a document under a user, e.g. spotify_users/<id>/playlists/<id>
+
+    Returns:
+        str: Version document path
+    """
+
+    return '/'.join(key.split('/')[:2]) + '/versions/data'
+
+
+def get_data_version(key: str) -> int:
+    """Get the current data version of a user
+
+    Args:
+        key (str): Key of a user or a document under a user
+
+    Returns:
+        int: Version, 0 if never written
+    """
+
+    snapshot = db.conn.document(get_version_path(key)).get(field_paths=['version'])
+    return snapshot.get('version') if snapshot.exists else 0
+
+
+def bump_data_version(key: str) -> None:
+    """Increment a user's data version after a write
+
+    Args:
+        key (str): Key of a user or a document under a user
+    """
+
+    if key is None:
+        return
+
+    try:
+        db.conn.document(get_version_path(key)).set({'version': firestore.Increment(1)}, merge=True)
+    except GoogleAPICallError:
+        logger.exception(f'error bumping data version for {key}')
@@ -0,0 +1,38 @@
+from fireo.models import Model
+from fireo.fields import NumberField, ListField, IDField, DateTime
+
+
+class LibraryIndex(Model):
+    """Metadata of a user's persisted Spotify saved track index, stored as a single document under the user
+    """
+    class Meta:
+        collection_name = 'library_indexes'
+
+    id = IDField()
+
+    track_count = NumberField(default=0)
+    chunk_count = NumberField(default=0)
+    newest_added_at = DateTime()
+    """Added time of the most recently saved track, delta syncs page until reaching it
+    """
+
+    last_synced = DateTime()
+    last_full_sync = DateTime()
+
+    sync_lease_until = DateTime()
+    """Time until which a running sync holds the index, other syncs wait for it to pass or be released
+    """
+
+
+class LibraryChunk(Model):
+    """Slice of a user's saved track index, oldest first, kept under the Firestore document size limit
+    """
+    class Meta:
+        collection_name = 'library_chunks'
+
+    id = IDField()
+
+    index = NumberField(required=True)
+    tracks = ListField(default=[])
+    """Serialised TrackRecord dicts
+    """
@@ -1,8 +1,12 @@
 from enum import Enum
+from typing import Dict, List
 
+from fireo.database import db
 from fireo.models import Model
 from fireo.fields import TextField, BooleanField, DateTime, NumberField, ListField, IDField
 
+from music.model.data_version import bump_data_version
+
 
 class Sort(Enum):
     default = 1
@@ -26,6 +30,9 @@ class Playlist(Model):
 
     uri = TextField()
     name = TextField(required=True)
+    name_lower = TextField()
+    """Lower-cased name for case-insensitive lookups, set on save
+    """
     type = TextField(required=True)
 
     include_recommendations = BooleanField(default=False)
@@ -41,6 +48,12 @@ class Playlist(Model):
     description_suffix = TextField()
 
     last_updated = DateTime()
+    source_fingerprint = TextField()
+    """Hash of the sources and config used for the last run, an unchanged fingerprint skips the next run
+    """
+    output_fingerprint = TextField()
+    """Hash of the track list and description last written to Spotify
+    """
 
     lastfm_stat_count = NumberField(default=0)
     lastfm_stat_album_count = NumberField(default=0)
@@ -86,13 +99,66 @@ class Playlist(Model):
         'chart_limit'
     ]
 
-    def to_dict(self):
+    hidden_fields = ['source_fingerprint', 'output_fingerprint', 'name_lower']
+    """Internal fields never returned by the API
+    """
+
+    def save(self, transaction=None, batch=None, merge=None, no_return=False):
+        self.set_name_lower()
+        result = super().save(transaction=transaction, batch=batch, merge=merge, no_return=no_return)
+        if batch is None:  # batched writes are bumped once by whoever commits
+            bump_data_version(self.key)
+        return result
+
+    def update(self, key=None, transaction=None, batch=None):
+        self.set_name_lower()
+        result = super().update(key=key, transaction=transaction, batch=batch)
+        if batch is None:
+            bump_data_version(self.key)
+        return result
+
+    def set_name_lower(self):
+        if self.name is not None:
+            self.name_lower = self.name.lower()
+
+    def to_dict(self, reference_names: Dict[str, str] = None):
+        """Serialise for API responses with referenced playlists as names
+
+        Args:
+            reference_names (Dict[str, str], optional): Names of the user's playlists by ID, referenced playlists are
+                read in one batch if not provided. Defaults to None.
+
+        Returns:
+            dict: Serialised playlist
+        """
         to_return = super().to_dict()
 
-        to_return["playlist_references"] = [i.get().to_dict().get('name') for i in to_return['playlist_references']]
+        references = to_return['playlist_references'] or []
+        if reference_names is None:
+            reference_names = get_reference_names(references)
+
+        to_return["playlist_references"] = [reference_names[i.id] for i in references if i.id in reference_names]
 
         # remove unnecessary and sensitive fields
         to_return.pop('id', None)
         to_return.pop('key', None)
+        for field in self.hidden_fields:
+            to_return.pop(field, None)
 
         return to_return
+
+
+def get_reference_names(references: List) -> Dict[str, str]:
+    """Read the names of referenced playlists in a single batch
+
+    Args:
+        references (List): Playlist document references
+
+    Returns:
+        Dict[str, str]: Names of existing referenced playlists by ID
+    """
+
+    if len(references) == 0:
+        return {}
+
+    return {i.id: i.get('name') for i in db.conn.get_all(references, field_paths=['name']) if i.exists}
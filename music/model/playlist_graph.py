@@ -0,0 +1,31 @@
+from fireo.models import Model
+from fireo.fields import MapField, IDField, DateTime
+
+
+class PlaylistGraph(Model):
+    """Materialised dependency index of a user's smart playlists
+
+    Stored as a single document in a subcollection of the user, all maps are keyed by playlist ID
+    """
+    class Meta:
+        collection_name = 'playlist_graphs'
+
+    id = IDField()
+
+    names = MapField(default={})
+    """Playlist name for each playlist ID
+    """
+    parts = MapField(default={})
+    """Spotify playlist parts held directly by each playlist
+    """
+    references = MapField(default={})
+    """IDs of the smart playlists directly referenced by each playlist
+    """
+    dependents = MapField(default={})
+    """IDs of the smart playlists directly referencing each playlist, reverse of references
+    """
+    flattened_parts = MapField(default={})
+    """Transitive set of Spotify playlist parts for each playlist
+    """
+
+    last_updated = DateTime()
@@ -0,0 +1,35 @@
+from fireo.models import Model
+from fireo.fields import MapField, IDField, DateTime
+
+
+class RunJob(Model):
+    """Progress of a bulk run of a user's playlists
+
+    Stored in a subcollection of the user, runs report their own status so the job can be polled
+    """
+    class Meta:
+        collection_name = 'run_jobs'
+
+    id = IDField()
+
+    playlists = MapField(default={})
+    """Name and run status for each playlist ID
+    """
+    references = MapField(default={})
+    """IDs of the job's playlists referenced by each playlist ID, a playlist runs once these have finished
+    """
+
+    created = DateTime()
+    last_updated = DateTime()
+    expire_at = DateTime()
+    """Target of a Firestore TTL policy, finished jobs aren't kept
+    """
+
+    def to_dict(self):
+        to_return = super().to_dict()
+
+        to_return.pop('key', None)
+        to_return.pop('expire_at', None)
+        to_return.pop('references', None)
+
+        return to_return
@@ -1,6 +1,8 @@
 from fireo.models import Model
 from fireo.fields import TextField, DateTime, NumberField, ListField, BooleanField, IDField
 
+from music.model.data_version import bump_data_version
+
 
 class Tag(Model):
     class Meta:
@@ -21,11 +23,26 @@ class Tag(Model):
     total_user_scrobbles = NumberField(default=0)
 
     last_updated = DateTime()
+    last_full_refresh = DateTime()
+    """Time of the last recount of every entry, refreshes since only added new scrobbles
+    """
 
     time_objects = BooleanField(default=False)
     total_time = TextField(default='00:00:00')
     total_time_ms = NumberField(default=0)
 
+    def save(self, transaction=None, batch=None, merge=None, no_return=False):
+        result = super().save(transaction=transaction, batch=batch, merge=merge, no_return=no_return)
+        if batch is None:  # batched writes are bumped once by whoever commits
+            bump_data_version(self.key)
+        return result
+
+    def update(self, key=None, transaction=None, batch=None):
+        result = super().update(key=key, transaction=transaction, batch=batch)
+        if batch is None:
+            bump_data_version(self.key)
+        return result
+
     def to_dict(self):
         to_return = super().to_dict()
 
@@ -1,14 +1,33 @@
+import copy
 import logging
+import os
+from typing import Dict, List, Optional
 
+from flask import g, has_app_context
+import fireo
 from fireo.models import Model
 from fireo.fields import TextField, BooleanField, DateTime, NumberField, ListField, IDField
 
+from music.cache import MemoryCache
+from music.model.data_version import bump_data_version
 from music.model.playlist import Playlist
 
 from werkzeug.security import check_password_hash
 
 logger = logging.getLogger(__name__)
 
+PLAYLIST_NAME_BATCH_SIZE = 30
+"""Maximum names per Firestore in query
+"""
+PLAYLIST_INDEX_BATCH_SIZE = 500
+"""Maximum writes per Firestore batch
+"""
+
+user_cache = MemoryCache(max_size=int(os.environ.get('USER_CACHE_SIZE', 512)),
+                         ttl=int(os.environ.get('USER_CACHE_TTL', 30)))
+"""Users keyed by username shared between requests, copies are handed out so requests can't see each other's edits
+"""
+
 
 class User(Model):
     class Meta:
@@ -32,14 +51,63 @@ class User(Model):
     refresh_token = TextField()
     token_expiry = NumberField()
 
+    spotify_display_name = TextField()
+    """Cached from the Spotify profile, refreshed when older than spotify_info_refreshed allows
+    """
+    spotify_info_refreshed = DateTime()
+
     lastfm_username = TextField()
 
+    playlists_indexed = BooleanField(default=False)
+    """All of the user's playlists store name_lower, name lookups can query it instead of scanning
+    """
+
     apns_tokens = ListField(default=[])
     notify = BooleanField(default=False)
     notify_playlist_updates = BooleanField(default=False)
     notify_tag_updates = BooleanField(default=False)
     notify_admins = BooleanField(default=False)
 
+    hidden_fields = ['password', 'access_token', 'refresh_token', 'token_expiry', 'playlists_indexed']
+    """Sensitive or internal fields never returned by the API
+    """
+
+    _cached_original = None
+    """Cached user this object was copied from, fields left as they were are reloaded before writing
+    """
+
+    def save(self, *args, **kwargs):
+        self.reload_unchanged_fields()
+        result = super().save(*args, **kwargs)
+        invalidate_user(self.username, updated=self)
+        bump_data_version(self.key)
+        return result
+
+    def update(self, *args, **kwargs):
+        self.reload_unchanged_fields()
+        result = super().update(*args, **kwargs)
+        invalidate_user(self.username, updated=self)
+        bump_data_version(self.key)
+        return result
+
+    def reload_unchanged_fields(self):
+        """Replace fields left unedited on a cached copy with their stored values
+
+        Lists and maps are always written whole, without this a stale copy would overwrite newer values
+        """
+
+        if self._cached_original is None:
+            return
+
+        cached, self._cached_original = self._cached_original, None
+
+        if (stored := User.collection.get(self.key)) is None:
+            return
+
+        for field in self._meta.field_list:
+            if getattr(self, field) == getattr(cached, field) != getattr(stored, field):
+                setattr(self, field, getattr(stored, field))
+
     def check_password(self, password):
         return check_password_hash(self.password, password)
 
@@ -47,10 +115,8 @@ class User(Model):
         to_return = super().to_dict()
 
         # remove unnecessary and sensitive fields
-        to_return.pop('password', None)
-        to_return.pop('access_token', None)
-        to_return.pop('refresh_token', None)
-        to_return.pop('token_expiry', None)
+        for field in self.hidden_fields:
+            to_return.pop(field, None)
         to_return.pop('id', None)
         to_return.pop('key', None)
 
@@ -73,15 +139,13 @@ class User(Model):
             Optional[Playlist] or (<exact>, <all matches>): Found user's playlists
         """
 
-        smart_playlists = Playlist.collection.parent(self.key).fetch()
+        if self.playlists_indexed:
+            matches = list(Playlist.collection.parent(self.key)
+                           .filter('name_lower', '==', playlist_name.lower()).fetch())
+        else:  # until backfilled by index_all_user_playlists, scan without writing
+            matches = [i for i in self.get_playlists() if i.name.lower() == playlist_name.lower()]
 
-        exact_match = None
-        matches = list()
-        for playlist in smart_playlists:
-            if playlist.name == playlist_name:
-                exact_match = playlist
-            if playlist.name.lower() == playlist_name.lower():
-                matches.append(playlist)
+        exact_match = next((i for i in matches if i.name == playlist_name), None)
 
         if len(matches) == 0:
             # NO PLAYLIST FOUND
@@ -99,6 +163,63 @@ class User(Model):
         else:
             return exact_match, matches
 
+    def get_playlists_by_name(self, playlist_names: List[str]) -> Dict[str, Optional[Playlist]]:
+        """Get many of a user's playlists by name with smart case sensitivity
+
+        Names are resolved with one query per PLAYLIST_NAME_BATCH_SIZE names rather than one per name
+
+        Args:
+            playlist_names (List[str]): Subject playlist names
+
+        Returns:
+            Dict[str, Optional[Playlist]]: Best match for each name, None if not found
+        """
+
+        lower_names = list(dict.fromkeys(i.lower() for i in playlist_names))
+
+        if self.playlists_indexed:
+            candidates = []
+            for idx in range(0, len(lower_names), PLAYLIST_NAME_BATCH_SIZE):
+                candidates += Playlist.collection.parent(self.key) \
+                    .filter('name_lower', 'in', lower_names[idx:idx + PLAYLIST_NAME_BATCH_SIZE]).fetch()
+        else:  # until backfilled by index_all_user_playlists, scan without writing
+            wanted = set(lower_names)
+            candidates = [i for i in self.get_playlists() if i.name.lower() in wanted]
+
+        by_lower_name = {}
+        for playlist in candidates:
+            by_lower_name.setdefault(playlist.name.lower(), []).append(playlist)
+
+        found = {}
+        for name in playlist_names:
+            matches = by_lower_name.get(name.lower(), [])
+            found[name] = next((i for i in matches if i.name == name), matches[0] if matches else None)
+
+        return found
+
+    def index_playlists(self) -> int:
+        """Store lower-cased names on any of a user's playlists without so they can be queried by name
+
+        Playlists are written in batches and the user's data version is bumped once when marked as indexed
+
+        Returns:
+            int: Number of playlists updated
+        """
+
+        to_update = [i for i in self.get_playlists() if i.name_lower != i.name.lower()]
+
+        for idx in range(0, len(to_update), PLAYLIST_INDEX_BATCH_SIZE):
+            batch = fireo.batch()
+            for playlist in to_update[idx:idx + PLAYLIST_INDEX_BATCH_SIZE]:
+                playlist.update(batch=batch)  # sets name_lower
+            batch.commit()
+
+        logger.info(f'indexed {len(to_update)} playlist names for {self.username}')
+        self.playlists_indexed = True
+        self.update()
+
+        return len(to_update)
+
     def get_playlists(self):
         """Get all playlists for a user
 
@@ -108,5 +229,92 @@ class User(Model):
         return Playlist.collection.parent(self.key).fetch()
 
 
+def get_request_users() -> Optional[dict]:
+    """Get the users already loaded by the current request
+
+    Returns:
+        Optional[dict]: Users by username, None outside of a Flask app context
+    """
+
+    if not has_app_context():
+        return None
+
+    if 'users' not in g:
+        g.users = {}
+    return g.users
+
+
+def get_user(username: str, cached: bool = True) -> Optional[User]:
+    """Get a user by username, reusing the same object within a request and a cached copy between requests
+
+    Args:
+        username (str): Subject username, case insensitive
+        cached (bool, optional): Allow a copy cached by an earlier request. Defaults to True.
+
+    Returns:
+        Optional[User]: Found user
+    """
+
+    if username is None:
+        return None
+
+    username = username.strip().lower()
+
+    request_users = get_request_users()
+    if request_users is not None and username in request_users and cached:
+        return request_users[username]
+
+    if cached and (cached_user := user_cache.get(username)) is not None:
+        user = copy.deepcopy(cached_user)
+        user._cached_original = cached_user
+    else:
+        user = User.collection.filter('username', '==', username).get()
+        if user is not None:
+            user_cache.set(username, copy.deepcopy(user))
+
+    if request_users is not None and user is not None:
+        request_users[username] = user
+
+    return user
+
+
+def invalidate_user(username: str, updated: User = None) -> None:
+    """Drop a user from the cross-request cache after a write
+
+    Args:
+        username (str): Subject username
+        updated (User, optional): Written user object, kept for the rest of the request. Defaults to None.
+    """
+
+    if username is None:
+        return
+
+    username = username.strip().lower()
+    user_cache.delete(username)
+
+    if (request_users := get_request_users()) is not None:
+        if updated is not None:
+            request_users[username] = updated
+        else:
+            request_users.pop(username, None)
+
+
+def index_all_user_playlists() -> int:
+    """Backfill lower-cased playlist names for every user not yet indexed, run once after deploying name queries
+
+    Returns:
+        int: Number of users indexed
+    """
+
+    indexed = 0
+    for iter_user in User.collection.fetch():
+        if not iter_user.playlists_indexed:
+            iter_user.index_playlists()
+            indexed += 1
+
+    logger.info(f'indexed playlist names of {indexed} users')
+    return indexed
+
+
 def get_admins():
     return User.collection.filter('type', '==', 'admin').fetch()
\ No newline at end of file
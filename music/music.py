@@ -1,5 +1,4 @@
 from flask import Flask, render_template, redirect, session, flash, url_for
-from google.cloud import secretmanager
 
 import logging
 import os
@@ -8,9 +7,9 @@ from music.auth import auth_blueprint
 from music.api import api_blueprint, player_blueprint, fm_blueprint, \
     spotfm_blueprint, spotify_blueprint, admin_blueprint, tag_blueprint
 from music.magic_strings import COOKIE_SECRET_URI, STATIC_BUCKET
+from music.secrets import get_secret
 
 logger = logging.getLogger(__name__)
-secret_client = secretmanager.SecretManagerServiceClient()
 
 
 def create_app():
@@ -22,7 +21,7 @@ def create_app():
 
     app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), '..', 'build'), template_folder="templates")
 
-    app.secret_key = secret_client.access_secret_version(request={"name": COOKIE_SECRET_URI}).payload.data.decode("UTF-8")
+    app.secret_key = get_secret(COOKIE_SECRET_URI)
 
     app.register_blueprint(auth_blueprint, url_prefix='/auth')
     app.register_blueprint(api_blueprint, url_prefix='/api')
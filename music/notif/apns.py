@@ -2,17 +2,14 @@ import json
 
 from music.magic_strings import APNS_SIGN_URI
 from music.model.config import Config
+from music.secrets import get_secret as get_cached_secret
 
 from datetime import datetime, timedelta
 
-from google.cloud import secretmanager
-
 import httpx
 import jwt
 import os
 
-secret_client = secretmanager.SecretManagerServiceClient()
-
 DEV_SERVER = "https://api.sandbox.push.apple.com"
 PROD_SERVER = "https://api.push.apple.com"
 
@@ -28,7 +25,7 @@ def get_url(device_token: str) -> str:
 
 
 def get_secret() -> str:
-    return secret_client.access_secret_version(request={"name": APNS_SIGN_URI}).payload.data.decode("UTF-8")
+    return get_cached_secret(APNS_SIGN_URI)
 
 
 def get_token():
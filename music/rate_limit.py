@@ -0,0 +1,73 @@
+"""Token bucket rate limiting for calls to external services made from many threads at once
+"""
+
+import functools
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket shared between threads, each call takes one token and tokens refill at a steady rate
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        Args:
+            rate (float): Tokens added per second, unlimited if not positive
+            burst (int, optional): Maximum stored tokens. Defaults to one second of tokens.
+        """
+
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, blocking until one is available
+        """
+
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class RateLimitedNetwork:
+    """Proxy to a service network taking a token from a limiter before each method call
+    """
+
+    def __init__(self, network, limiter: RateLimiter):
+        """
+        Args:
+            network: Wrapped spotframework or fmframework network
+            limiter (RateLimiter): Limiter of the service
+        """
+
+        self._network = network
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._network, name)
+
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def limited(*args, **kwargs):
+            self._limiter.acquire()
+            return attr(*args, **kwargs)
+
+        return limited
@@ -0,0 +1,226 @@
+"""Cached secret access shared by all modules, backed by Secret Manager or local values for testing
+"""
+
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SECRET_TTL = int(os.environ.get('SECRET_TTL', 3600))
+"""Seconds a fetched secret is served for before it must be refetched
+"""
+SECRET_REFRESH_AHEAD = 0.8
+"""Fraction of the TTL after which a secret is refetched in the background while still being served
+"""
+
+
+def get_secret_id(name: str) -> str:
+    """Get the secret ID from a secret version name
+
+    Args:
+        name (str): Version name of the form projects/<project>/secrets/<id>/versions/<version>
+
+    Returns:
+        str: Secret ID, name unchanged if not a version name
+    """
+
+    parts = name.split('/')
+    if len(parts) >= 4 and parts[2] == 'secrets':
+        return parts[3]
+    return name
+
+
+class SecretBackend(ABC):
+    """Source of secret payloads
+    """
+
+    @abstractmethod
+    def access(self, name: str) -> str:
+        """Fetch a secret payload
+
+        Args:
+            name (str): Secret version name
+
+        Returns:
+            str: Decoded payload
+        """
+
+
+class SecretManagerBackend(SecretBackend):
+    """Google Cloud Secret Manager, the client is created on first access
+    """
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import secretmanager
+                self._client = secretmanager.SecretManagerServiceClient()
+            return self._client
+
+    def access(self, name: str) -> str:
+        return self.client.access_secret_version(request={"name": name}).payload.data.decode("UTF-8")
+
+
+class LocalBackend(SecretBackend):
+    """Secrets from environment variables or files, for running without Secret Manager
+
+    A secret with ID jwt-secret is read from the MIXONOMER_SECRET_JWT_SECRET environment variable, otherwise from
+    the file jwt-secret in the secrets directory
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(directory or os.environ.get('SECRETS_DIR', 'secrets'))
+
+    def access(self, name: str) -> str:
+        secret_id = get_secret_id(name)
+
+        if (value := os.environ.get(f'MIXONOMER_SECRET_{secret_id.upper().replace("-", "_")}')) is not None:
+            return value
+
+        try:
+            return (self.directory / secret_id).read_text().strip()
+        except FileNotFoundError:
+            raise KeyError(f'secret {secret_id} not found in environment or {self.directory}')
+
+
+class SecretCache:
+    """In-memory secret cache
+
+    Concurrent misses for the same secret make a single fetch, secrets close to expiry are refetched in the
+    background so callers don't wait on the backend. An expired secret is served if refetching it fails
+    """
+
+    def __init__(self, backend: SecretBackend, ttl: float = SECRET_TTL, refresh_ahead: float = SECRET_REFRESH_AHEAD):
+        """Initialise cache
+
+        Args:
+            backend (SecretBackend): Source of secrets
+            ttl (float, optional): Seconds a secret is served for. Defaults to SECRET_TTL.
+            refresh_ahead (float, optional): Fraction of the TTL after which a secret is refreshed in the
+                background. Defaults to SECRET_REFRESH_AHEAD.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+
+        self._entries: Dict[str, Tuple[str, float]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str) -> str:
+        """Get a secret payload, fetching it if not cached or expired
+
+        Args:
+            name (str): Secret version name
+
+        Returns:
+            str: Decoded payload
+        """
+
+        entry = self._entries.get(name)
+        if entry is not None:
+            value, fetched = entry
+            age = time.monotonic() - fetched
+
+            if age < self.ttl:
+                if age > self.ttl * self.refresh_ahead:
+                    self._refresh_in_background(name)
+                return value
+
+        return self._fetch(name)
+
+    def _fetch(self, name: str) -> str:
+        with self._lock_for(name):
+            # another caller may have fetched while waiting
+            entry = self._entries.get(name)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl * self.refresh_ahead:
+                return entry[0]
+
+            try:
+                value = self.backend.access(name)
+            except Exception:
+                if entry is None:
+                    raise
+                logger.exception(f'error refreshing secret {get_secret_id(name)}, serving cached value')
+                return entry[0]
+
+            self._entries[name] = (value, time.monotonic())
+            return value
+
+    def _refresh_in_background(self, name: str) -> None:
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh():
+            try:
+                self._fetch(name)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """Remove a cached secret, or all if no name given
+
+        Args:
+            name (Optional[str], optional): Secret version name. Defaults to None.
+        """
+
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+def create_backend(backend: Optional[str] = None) -> SecretBackend:
+    """Create a secret backend by name
+
+    Args:
+        backend (Optional[str], optional): Either 'secretmanager' or 'local'. Defaults to Secret Manager.
+
+    Returns:
+        SecretBackend: New backend
+    """
+
+    if backend == 'local':
+        return LocalBackend()
+
+    if backend not in (None, 'secretmanager'):
+        logger.warning(f'unknown secret backend {backend}, defaulting to secret manager')
+
+    return SecretManagerBackend()
+
+
+secret_cache = SecretCache(create_backend(os.environ.get('SECRETS_BACKEND')))
+
+
+def get_secret(name: str) -> str:
+    """Get a secret payload from the process-wide cache
+
+    Args:
+        name (str): Secret version name
+
+    Returns:
+        str: Decoded payload
+    """
+
+    return secret_cache.get(name)
@@ -31,7 +31,7 @@ def create_playlist(user: User, name: str) -> Optional[FullPlaylist]:
     net = database.get_authed_spotify_network(user)
 
     try:
-        return net.create_playlist(net.user.user.display_name, name)
+        return net.create_playlist(database.get_spotify_display_name(user, net), name)
     except SpotifyNetworkException:
         logger.exception(f'error ocurred {user.username} / {name}')
         return
@@ -0,0 +1,75 @@
+"""Lazy filter stages for the playlist generation pipeline
+
+Each stage consumes and returns an iterator of TrackRecord so tracks flow through without intermediate lists, only
+sorting materialises the full track set
+"""
+
+from datetime import datetime
+from typing import Iterable, Iterator, List
+
+from music.tasks.track_record import TrackRecord
+
+
+def remove_local(tracks: Iterable[TrackRecord]) -> Iterator[TrackRecord]:
+    """Filter out local files
+
+    Args:
+        tracks (Iterable[TrackRecord]): Subject tracks
+
+    Returns:
+        Iterator[TrackRecord]: Tracks that aren't local files
+    """
+
+    return (i for i in tracks if not i.is_local)
+
+
+def added_after(tracks: Iterable[TrackRecord], boundary: datetime) -> Iterator[TrackRecord]:
+    """Filter to tracks added to their playlist or library after a boundary
+
+    Args:
+        tracks (Iterable[TrackRecord]): Subject tracks
+        boundary (datetime): Exclusive lower bound of added time
+
+    Returns:
+        Iterator[TrackRecord]: Tracks added after the boundary, tracks without an added time are dropped
+    """
+
+    return (i for i in tracks if i.added_at is not None and i.added_at > boundary)
+
+
+def deduplicate_by_name(tracks: Iterable[TrackRecord]) -> Iterator[TrackRecord]:
+    """Filter out tracks with the same name and artists as an earlier track
+
+    Args:
+        tracks (Iterable[TrackRecord]): Subject tracks in priority order
+
+    Returns:
+        Iterator[TrackRecord]: First occurrence of each track
+    """
+
+    seen = set()
+
+    for track in tracks:
+        key = (track.name.lower(), frozenset(i.lower() for i in track.artists))
+        if key not in seen:
+            seen.add(key)
+            yield track
+
+
+def sort_by_release_date(tracks: Iterable[TrackRecord], reverse: bool = False) -> List[TrackRecord]:
+    """Sort tracks by album release date, tracks of the same release stay grouped in album order
+
+    Args:
+        tracks (Iterable[TrackRecord]): Subject tracks
+        reverse (bool, optional): Newest first. Defaults to False.
+
+    Returns:
+        List[TrackRecord]: Sorted tracks
+    """
+
+    tracks = sorted(tracks, key=lambda i: ((i.artists[0].lower() if i.artists else ''),
+                                           (i.album or '').lower(),
+                                           i.track_number))
+    tracks.sort(key=lambda i: i.release_date, reverse=reverse)  # stable, keeps album order within a date
+
+    return tracks
@@ -0,0 +1,107 @@
+"""Plan the Spotify playlist edits that turn a playlist's current tracks into a generated track list
+"""
+
+import math
+from typing import List, Optional, Tuple
+
+WRITE_BATCH_SIZE = 100
+"""Maximum number of tracks per Spotify add, remove or replace call
+"""
+
+
+def batch_count(item_count: int) -> int:
+    """Number of API calls needed to send a number of tracks
+
+    Args:
+        item_count (int): Number of tracks
+
+    Returns:
+        int: Number of calls
+    """
+
+    return math.ceil(item_count / WRITE_BATCH_SIZE)
+
+
+def replace_cost(target: List[str]) -> int:
+    """Number of API calls taken to replace a playlist's tracks outright
+
+    Args:
+        target (List[str]): Track URIs to write
+
+    Returns:
+        int: Number of calls
+    """
+
+    return max(1, batch_count(len(target)))
+
+
+def plan_playlist_diff(current: List[str], target: List[str], max_cost: int = None) -> Optional[List[Tuple]]:
+    """Plan remove, add and move operations to turn a playlist's current tracks into the target order
+
+    Removals and additions are applied first with additions appended to the end, then blocks of consecutive tracks
+    are moved into place from the start of the playlist. Operations are returned as:
+
+    * ('remove', [uris])
+    * ('add', [uris])
+    * ('move', range_start, range_length, insert_before)
+
+    Args:
+        current (List[str]): Track URIs currently in the playlist
+        target (List[str]): Track URIs to write
+        max_cost (int, optional): Abandon the plan at this many API calls. Defaults to the cost of a full replace.
+
+    Returns:
+        Optional[List[Tuple]]: Operations, None if a full replace is cheaper or the diff is ambiguous
+    """
+
+    if max_cost is None:
+        max_cost = replace_cost(target)
+
+    current_set = set(current)
+    target_set = set(target)
+
+    # removal by URI removes every occurrence, duplicates can't be diffed
+    if len(current_set) != len(current) or len(target_set) != len(target):
+        return None
+
+    operations = []
+    cost = 0
+
+    removals = [i for i in current if i not in target_set]
+    for start in range(0, len(removals), WRITE_BATCH_SIZE):
+        operations.append(('remove', removals[start:start + WRITE_BATCH_SIZE]))
+    cost += batch_count(len(removals))
+
+    additions = [i for i in target if i not in current_set]
+    for start in range(0, len(additions), WRITE_BATCH_SIZE):
+        operations.append(('add', additions[start:start + WRITE_BATCH_SIZE]))
+    cost += batch_count(len(additions))
+
+    if cost >= max_cost:
+        return None
+
+    working = [i for i in current if i in target_set] + additions
+
+    index = 0
+    while index < len(target):
+        if working[index] == target[index]:
+            index += 1
+            continue
+
+        block_start = working.index(target[index], index)
+        block_length = 1
+        while block_start + block_length < len(working) \
+                and index + block_length < len(target) \
+                and working[block_start + block_length] == target[index + block_length]:
+            block_length += 1
+
+        operations.append(('move', block_start, block_length, index))
+        cost += 1
+        if cost >= max_cost:
+            return None
+
+        working[index:block_start + block_length] = working[block_start:block_start + block_length] \
+            + working[index:block_start]
+        index += block_length
+
+    return operations
@@ -0,0 +1,196 @@
+"""Per-user index of Spotify playlists by name, cached between playlist runs and API requests
+"""
+
+import logging
+import os
+import tempfile
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from spotframework.net.network import Network as SpotNetwork, SpotifyNetworkException
+
+from music.cache import create_cache
+
+logger = logging.getLogger(__name__)
+
+playlist_index_cache = create_cache(os.environ.get('PLAYLIST_INDEX_BACKEND', 'memory'),
+                                    max_size=int(os.environ.get('PLAYLIST_INDEX_SIZE', 256)),
+                                    ttl=int(os.environ.get('PLAYLIST_INDEX_TTL', 60)),
+                                    directory=os.path.join(tempfile.gettempdir(), 'mixonomer-playlist-index'))
+"""Playlist indexes keyed by username, snapshot IDs of playlists edited outside Mixonomer may be up to the TTL old
+"""
+
+
+class PlaylistEntry(NamedTuple):
+    """Fields of a listed Spotify playlist needed to resolve and fingerprint it
+    """
+    name: str
+    uri: object
+    owner: str
+    snapshot_id: Optional[str] = None
+
+
+class PlaylistIndex:
+    """User's Spotify playlists in listing order with name lookup
+    """
+
+    def __init__(self, entries: List[PlaylistEntry], total: int):
+        """Build name lookup
+
+        Args:
+            entries (List[PlaylistEntry]): Listed playlists
+            total (int): Size of the user's playlist list when listed, changes invalidate the index
+        """
+        self.entries = entries
+        self.total = total
+        self.by_name: Dict[str, PlaylistEntry] = {}
+
+        for entry in entries:
+            self.by_name.setdefault(entry.name, entry)  # first listed wins, as with a linear scan
+
+    def get(self, name: str, include_spotify_owned: bool = True) -> Optional[PlaylistEntry]:
+        """Find a playlist by name
+
+        Args:
+            name (str): Playlist name
+            include_spotify_owned (bool, optional): Match playlists owned by Spotify. Defaults to True.
+
+        Returns:
+            Optional[PlaylistEntry]: Matching playlist if found
+        """
+
+        entry = self.by_name.get(name)
+        if entry is not None and not include_spotify_owned and is_spotify_owned(entry):
+            return None
+        return entry
+
+    def values(self, include_spotify_owned: bool = True) -> Iterator[PlaylistEntry]:
+        """Iterate listed playlists
+
+        Args:
+            include_spotify_owned (bool, optional): Include playlists owned by Spotify. Defaults to True.
+
+        Returns:
+            Iterator[PlaylistEntry]: Playlists in listing order
+        """
+
+        return (i for i in self.entries if include_spotify_owned or not is_spotify_owned(i))
+
+
+def is_spotify_owned(entry: PlaylistEntry) -> bool:
+    return 'spotify' in entry.owner.lower()
+
+
+def get_playlist_total(spotnet: SpotNetwork) -> Optional[int]:
+    """Get the number of playlists in the user's list with a single item request
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+
+    Returns:
+        Optional[int]: Playlist count, None if it couldn't be retrieved
+    """
+
+    try:
+        response = spotnet.get_request(url='me/playlists', params={'limit': 1})
+        return response.get('total') if response is not None else None
+    except (SpotifyNetworkException, AttributeError):
+        logger.exception('error retrieving playlist total')
+        return None
+
+
+def get_playlist_snapshot_id(spotnet: SpotNetwork, uri) -> Optional[str]:
+    """Get the current snapshot ID of one playlist without its tracks
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        uri: Playlist URI
+
+    Returns:
+        Optional[str]: Snapshot ID, None if it couldn't be retrieved
+    """
+
+    try:
+        response = spotnet.get_request(url=f'playlists/{str(uri).split(":")[-1]}', params={'fields': 'snapshot_id'})
+        return response.get('snapshot_id') if response is not None else None
+    except (SpotifyNetworkException, AttributeError):
+        logger.exception(f'error retrieving snapshot id of {uri}')
+        return None
+
+
+def load_playlist_index(spotnet: SpotNetwork) -> PlaylistIndex:
+    """List a user's Spotify playlists
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+
+    Raises:
+        SpotifyNetworkException: Error listing playlists
+
+    Returns:
+        PlaylistIndex: New index
+    """
+
+    entries = [PlaylistEntry(name=i.name,
+                             uri=i.uri,
+                             owner=getattr(i.owner, 'display_name', None) or '',
+                             snapshot_id=getattr(i, 'snapshot_id', None))
+               for i in spotnet.playlists() or []]
+
+    return PlaylistIndex(entries, total=len(entries))
+
+
+def get_playlist_index(spotnet: SpotNetwork, username: str, validate: bool = True) -> PlaylistIndex:
+    """Get a user's playlist index, listing their playlists if not cached or the playlist total has changed
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        username (str): Subject user's username
+        validate (bool, optional): Check a cached index against the current playlist total. Defaults to True.
+
+    Raises:
+        SpotifyNetworkException: Error listing playlists
+
+    Returns:
+        PlaylistIndex: User's playlist index
+    """
+
+    index = playlist_index_cache.get(username)
+
+    if index is not None and validate:
+        total = get_playlist_total(spotnet)
+        if total is not None and total != index.total:
+            logger.debug(f'playlist total changed {index.total} -> {total}, relisting {username}')
+            index = None
+
+    if index is None:
+        index = load_playlist_index(spotnet)
+        playlist_index_cache.set(username, index)
+
+    return index
+
+
+def mark_playlist_changed(username: str, uri, snapshot_id: Optional[str] = None) -> None:
+    """Replace the snapshot ID of a playlist that has been written to, so snapshot keyed results aren't reused
+
+    Args:
+        username (str): Subject user's username
+        uri: URI of changed playlist
+        snapshot_id (Optional[str], optional): Snapshot ID after the write if known. Defaults to None.
+    """
+
+    index = playlist_index_cache.get(username)
+    if index is None:
+        return
+
+    entries = [i._replace(snapshot_id=snapshot_id) if str(i.uri) == str(uri) else i for i in index.entries]
+    playlist_index_cache.set(username, PlaylistIndex(entries, total=index.total))
+
+
+def invalidate_playlist_index(username: str) -> None:
+    """Remove a user's cached playlist index
+
+    Args:
+        username (str): Subject user's username
+    """
+
+    playlist_index_cache.delete(username)
@@ -0,0 +1,117 @@
+"""Run many of a user's playlists in one execution, each only after the playlists it references
+
+Used when not deployed, deployed runs are split into one execution per playlist by music.cloud.start_run_job
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional
+
+from music.model.user import User
+from music.model.playlist import Playlist
+from music.model.config import Config
+from music.db.run_job import get_run_job, fail_run_job, QUEUED
+from music.tasks.run_user_playlist import run_user_playlist_for_job
+
+logger = logging.getLogger(__name__)
+
+
+def run_job(username: str, job_id: str):
+    """Run the queued playlists of a bulk run job in dependency order
+
+    Queued playlists that no longer exist are marked as failed
+
+    Args:
+        username (str): Subject user's username
+        job_id (str): Subject job ID
+    """
+
+    user = User.collection.filter('username', '==', username.strip().lower()).get()
+
+    if user is None:
+        logger.error(f'user {username} not found')
+        return
+
+    job = get_run_job(user, job_id)
+    if job is None:
+        logger.error(f'run job {job_id} not found for {username}')
+        return
+
+    queued = {playlist_id for playlist_id, status in job.playlists.items() if status['status'] == QUEUED}
+    playlists = {i.id: i for i in Playlist.collection.parent(user.key).fetch() if i.id in queued}
+    references = {playlist_id: [i.id for i in playlist.playlist_references or []]
+                  for playlist_id, playlist in playlists.items()}
+
+    if missing := queued - playlists.keys():
+        logger.warning(f'{len(missing)} playlists of job {job_id} not found for {username}')
+        fail_run_job(user, job_id, missing)
+
+    logger.info(f'running job {job_id} of {len(playlists)} playlists for {username}')
+
+    run_playlists(user, playlists, references, job_id=job_id)
+
+
+def run_playlists(user: User, playlists: Dict[str, Playlist], references: Dict[str, List[str]],
+                  job_id: Optional[str] = None):
+    """Run a user's playlists in dependency order, independent playlists run concurrently up to the configured limit
+
+    Args:
+        user (User): Subject user
+        playlists (Dict[str, Playlist]): Playlists to run by ID
+        references (Dict[str, List[str]]): Referenced playlist IDs for each playlist ID
+        job_id (Optional[str], optional): Bulk run job to report progress to. Defaults to None.
+    """
+
+    config = Config.collection.get("config/music-tools")
+    concurrency = int(getattr(config, 'playlist_run_concurrency', None) or 4)
+
+    run_in_dependency_order(references,
+                            run=lambda playlist_id: run_user_playlist_for_job(user, playlists[playlist_id],
+                                                                              job_id=job_id),
+                            max_workers=concurrency)
+
+
+def run_in_dependency_order(references: Dict[str, List[str]], run: Callable[[str], None], max_workers: int = 4):
+    """Run each node once all of the nodes it references have finished, independent nodes run concurrently
+
+    Nodes caught in a reference cycle are run after all others
+
+    Args:
+        references (Dict[str, List[str]]): Referenced node IDs for each node ID
+        run (Callable[[str], None]): Function to run for each node ID
+        max_workers (int, optional): Maximum number of nodes running at once. Defaults to 4.
+    """
+
+    remaining = {i: {j for j in refs if j in references and j != i} for i, refs in references.items()}
+    dependents = {i: [] for i in references}
+    for node, refs in remaining.items():
+        for reference in refs:
+            dependents[reference].append(node)
+
+    started = set()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+
+        def submit(node):
+            started.add(node)
+            return executor.submit(run, node)
+
+        running = {submit(i): i for i, refs in remaining.items() if len(refs) == 0}
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                node = running.pop(future)
+                if (exception := future.exception()) is not None:
+                    logger.error(f'error running {node}', exc_info=exception)
+
+                for dependent in dependents[node]:
+                    remaining[dependent].discard(node)
+                    if len(remaining[dependent]) == 0 and dependent not in started:
+                        running[submit(dependent)] = dependent
+
+            if not running and len(started) < len(references):
+                cyclic = [i for i in references if i not in started]
+                logger.warning(f'reference cycle found between {len(cyclic)} nodes, running anyway')
+                running = {submit(i): i for i in cyclic}
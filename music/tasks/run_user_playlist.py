@@ -1,14 +1,17 @@
 import datetime
+import hashlib
+import json
 import logging
+import os
 import random
-from typing import List
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Iterable, Iterator, List, Optional
 
 import spotframework.util.monthstrings as monthstrings
 from spotframework.model.uri import Uri
-from spotframework.filter import remove_local, get_track_objects
-from spotframework.filter.added import added_after
-from spotframework.filter.sort import sort_by_release_date
-from spotframework.filter.deduplicate import deduplicate_by_name
 from spotframework.net.network import SpotifyNetworkException
 
 from spotframework.net.network import Network as SpotNetwork
@@ -16,7 +19,14 @@ from fmframework.net.network import Network
 from spotfm.chart import map_lastfm_track_chart_to_spotify
 
 import music.db.database as database
-from music.db.part_generator import PartGenerator
+from music.cache import create_cache
+from music.db.library import sync_library
+from music.db.playlist_graph import get_flattened_parts
+from music.db.run_job import set_run_job_status, RUNNING, SUCCEEDED, FAILED
+from music.tasks.playlist_diff import plan_playlist_diff
+from music.tasks.playlist_index import get_playlist_index, get_playlist_snapshot_id, mark_playlist_changed
+from music.tasks.pipeline import remove_local, added_after, deduplicate_by_name, sort_by_release_date
+from music.tasks.track_record import TrackRecord, to_records
 from music.model.user import User
 from music.model.playlist import Playlist
 
@@ -24,6 +34,25 @@ from music.notif.notifier import notify_user_playlist_update
 
 logger = logging.getLogger(__name__)
 
+PART_FETCH_WORKERS = 8
+"""Maximum number of component playlists to fetch from Spotify concurrently
+"""
+
+playlist_track_cache = create_cache(os.environ.get('TRACK_CACHE_BACKEND', 'memory'),
+                                    max_size=int(os.environ.get('TRACK_CACHE_SIZE', 128)),
+                                    ttl=int(os.environ.get('TRACK_CACHE_TTL', 3600)),
+                                    directory=os.path.join(tempfile.gettempdir(), 'mixonomer-playlist-tracks'))
+"""Spotify playlist tracks keyed by (username, playlist URI, snapshot ID), shared between runs on the same instance
+"""
+
+written_track_cache = create_cache(os.environ.get('TRACK_CACHE_BACKEND', 'memory'),
+                                   max_size=int(os.environ.get('WRITTEN_TRACK_CACHE_SIZE', 256)),
+                                   ttl=int(os.environ.get('WRITTEN_TRACK_CACHE_TTL', 86400)),
+                                   directory=os.path.join(tempfile.gettempdir(), 'mixonomer-written-tracks'))
+"""Track URIs last written to each smart playlist keyed by (username, playlist URI, snapshot ID after the write),
+lets the next write diff against them without paging the playlist
+"""
+
 
 def get_user_and_name(user):
     if isinstance(user, str):
@@ -46,14 +75,19 @@ def get_playlist_and_name(playlist, user: User):
         return playlist, playlist.name
 
 
-def run_user_playlist(user: User, playlist: Playlist, spotnet: SpotNetwork = None, fmnet: Network = None) -> None:
+def run_user_playlist(user: User, playlist: Playlist, spotnet: SpotNetwork = None, fmnet: Network = None,
+                      force: bool = False) -> None:
     """Generate and upadate a user's smart playlist
 
+    Runs are skipped when the source fingerprint matches the previous run, writes are skipped when the generated
+    tracks and description match the last write
+
     Args:
         user (User): Subject user
         playlist (Playlist): User's subject playlist
         spotnet (SpotNetwork, optional): Spotframework network for Spotify operations. Defaults to None.
         fmnet (Network, optional): Fmframework network for Last.fm operations. Defaults to None.
+        force (bool, optional): Run even if the sources are unchanged. Defaults to False.
 
     Raises:
         NameError: No user provided
@@ -91,102 +125,295 @@ def run_user_playlist(user: User, playlist: Playlist, spotnet: SpotNetwork = Non
         logger.error(f'no spotify network returned for {username} / {playlist_name}')
         raise NameError(f'No Spotify network returned ({username} / {playlist_name})')
 
-    part_generator = PartGenerator(user=user)
-    part_names = part_generator.get_recursive_parts(playlist.name)
+    part_names = get_flattened_parts(user, playlist) + get_month_parts(playlist)
+    user_playlists = load_user_playlists(spotnet, playlist, username)
+
+    source_fingerprint = get_source_fingerprint(spotnet, playlist, part_names, user_playlists, username)
+    if not force and source_fingerprint is not None and source_fingerprint == playlist.source_fingerprint:
+        logger.info(f'sources unchanged, skipping {username} / {playlist_name}')
+        return
 
-    playlist_tracks = load_playlist_tracks(spotnet, playlist, part_names, username)
+    # lazy until sorted
+    failures = []
+    playlist_tracks = load_playlist_tracks(spotnet, playlist, part_names, username, user_playlists=user_playlists,
+                                           user=user, failures=failures)
     playlist_tracks = do_playlist_type_processing(spotnet, playlist, user, playlist_tracks)
     playlist_tracks = sort_tracks(playlist, playlist_tracks)
-    playlist_tracks += get_recommendations(spotnet, playlist, username, playlist_tracks)
-    playlist_tracks = deduplicate_by_name(playlist_tracks)
-
-    execute_playlist(spotnet, playlist, part_names, username, playlist_tracks)
+    playlist_tracks = list(deduplicate_by_name(chain(playlist_tracks,
+                                                     get_recommendations(spotnet, playlist, username, playlist_tracks))))
+
+    snapshot_id = next((i.snapshot_id for i in user_playlists.values() if str(i.uri) == str(playlist.uri)), None)
+    if execute_playlist(spotnet, playlist, part_names, username, playlist_tracks, snapshot_id=snapshot_id):
+        # output built from missing sources must not stop the next run from retrying them
+        if len(failures) > 0:
+            logger.warning(f'{len(failures)} sources failed, not fingerprinting {username} / {playlist_name}')
+            playlist.source_fingerprint = None
+        else:
+            playlist.source_fingerprint = source_fingerprint
 
     playlist.last_updated = datetime.datetime.utcnow()
     playlist.update()
 
     notify_user_playlist_update(user=user, playlist=playlist)
 
-def load_user_playlists(spotnet: SpotNetwork, playlist: Playlist, username: str):
+
+def run_user_playlist_for_job(user: User, playlist: Playlist, job_id: Optional[str] = None, **kwargs) -> None:
+    """Run a user's playlist, reporting progress to a bulk run job if one is given
+
+    Args:
+        user (User): Subject user
+        playlist (Playlist): User's subject playlist
+        job_id (Optional[str], optional): ID of the bulk run job the run belongs to. Defaults to None.
+        **kwargs: Passed to run_user_playlist
+    """
+
+    if job_id is None:
+        return run_user_playlist(user, playlist, **kwargs)
+
+    set_run_job_status(user, job_id, playlist.id, RUNNING)
     try:
-        if not playlist.include_spotify_owned:
-            return {i.name: i.uri
-                    for i in spotnet.playlists()
-                    if 'spotify' not in i.owner.display_name.lower()}
-        else:
-            return {i.name: i.uri
-                    for i in spotnet.playlists()}
+        run_user_playlist(user, playlist, **kwargs)
+    except Exception:
+        set_run_job_status(user, job_id, playlist.id, FAILED)
+        raise
+    set_run_job_status(user, job_id, playlist.id, SUCCEEDED)
+
+
+def get_month_parts(playlist: Playlist) -> List[str]:
+    """Get the monthly playlist names to include for a playlist
+
+    Args:
+        playlist (Playlist): Subject playlist
+
+    Returns:
+        List[str]: Monthly playlist names, e.g. february 20
+    """
+
+    parts = []
+
+    if playlist.add_last_month:
+        parts.append(monthstrings.get_last_month())
+    if playlist.add_this_month:
+        parts.append(monthstrings.get_this_month())
+
+    return parts
+
+def get_source_fingerprint(spotnet: SpotNetwork, playlist: Playlist, part_names: List[str], user_playlists: dict,
+                           username: str) -> Optional[str]:
+    """Hash the state of everything a playlist is generated from
+
+    Covers the snapshot IDs of the source playlists, the newest saved library track and the playlist's config.
+    Playlists with random or externally sourced output can't be fingerprinted
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        playlist (Playlist): Subject playlist
+        part_names (List[str]): Resolved component playlist names or URIs
+        user_playlists (dict): User's Spotify playlists by name
+        username (str): Subject user's username
+
+    Returns:
+        Optional[str]: Fingerprint, None if the playlist must always run
+    """
+
+    if playlist.shuffle or playlist.include_recommendations or playlist.type == 'fmchart':
+        return None
+
+    snapshot_ids = {str(i.uri): getattr(i, 'snapshot_id', None) for i in user_playlists.values()}
+
+    sources = {}
+    for part_name in sorted(set(part_names)):
+        try:
+            uri = str(Uri(part_name))
+        except ValueError:
+            if (user_playlist := user_playlists.get(part_name)) is None:
+                sources[part_name] = None
+                continue
+            uri = str(user_playlist.uri)
+
+        if (snapshot_id := snapshot_ids.get(uri)) is None:
+            return None  # followed by URI without a known snapshot
+        sources[part_name] = snapshot_id
+
+    state = {
+        'sources': sources,
+        'config': {key: getattr(playlist, key, None) for key in Playlist.mutable_keys
+                   if key not in ['parts', 'playlist_references']}
+    }
+
+    if playlist.include_library_tracks or playlist.type == 'recents':
+        # daily component reconciles library removals and rolls the recents boundary
+        state['date'] = datetime.date.today().isoformat()
+
+    if playlist.include_library_tracks:
+        try:
+            newest = spotnet.saved_tracks(response_limit=1)
+        except SpotifyNetworkException:
+            logger.exception(f'error retrieving library state {username} / {playlist.name}')
+            return None
+
+        if newest:
+            state['library'] = [str(newest[0].track.uri), str(newest[0].added_at)]
+
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_user_playlists(spotnet: SpotNetwork, playlist: Playlist, username: str) -> dict:
+    """Get the user's Spotify playlists by name from their cached playlist index
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        playlist (Playlist): Subject playlist, filters Spotify owned playlists if not included
+        username (str): Subject user's username
+
+    Raises:
+        SpotifyNetworkException: Error listing playlists
+
+    Returns:
+        dict: Playlist entries by name
+    """
+
+    try:
+        index = get_playlist_index(spotnet, username)
     except SpotifyNetworkException as e:
         logger.exception(f'error occured while retrieving playlists {username} / {playlist.name}')
         raise e
 
-def load_playlist_tracks(spotnet: SpotNetwork, playlist: Playlist, part_names: List[str], username: str):
-    playlist_tracks = []
+    user_playlists = {}
+    for entry in index.values(include_spotify_owned=playlist.include_spotify_owned):
+        user_playlists.setdefault(entry.name, entry)
+    return user_playlists
 
-    if playlist.add_last_month:
-        part_names.append(monthstrings.get_last_month())
-    if playlist.add_this_month:
-        part_names.append(monthstrings.get_this_month())
+def load_playlist_tracks(spotnet: SpotNetwork, playlist: Playlist, part_names: List[str], username: str,
+                         max_workers: int = PART_FETCH_WORKERS, user_playlists: dict = None,
+                         user: User = None, failures: list = None) -> Iterator[TrackRecord]:
+    """Load the tracks of each of a playlist's component Spotify playlists
 
-    user_playlists = load_user_playlists(spotnet, playlist, username)
+    Parts are fetched concurrently with a bounded thread pool, the returned tracks are in the same order as part_names.
+    Parts whose Spotify snapshot ID is unchanged since a previous fetch are served from playlist_track_cache.
+    Parts are fetched as the returned tracks are consumed, only a bounded window of parts is held ahead of the
+    consumer and tracks are streamed from each part without copying them into one list
 
-    #  LOAD PLAYLIST TRACKS
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        playlist (Playlist): Subject smart playlist
+        part_names (List[str]): Resolved component playlist names or URIs
+        username (str): Subject user's username
+        max_workers (int, optional): Maximum number of parts to fetch at once. Defaults to PART_FETCH_WORKERS.
+        user_playlists (dict, optional): User's Spotify playlists by name if already loaded. Defaults to None.
+        user (User, optional): Subject user, library tracks are synced through their stored index if given.
+            Defaults to None.
+        failures (list, optional): Names of parts that couldn't be loaded are appended as they're consumed.
+            Defaults to None.
+
+    Returns:
+        Iterator[TrackRecord]: Loaded tracks including library tracks if requested
+    """
+
+    if user_playlists is None:
+        user_playlists = load_user_playlists(spotnet, playlist, username)
+    snapshot_ids = {str(i.uri): getattr(i, 'snapshot_id', None) for i in user_playlists.values()}
+
+    #  RESOLVE PART URIS
+    parts_to_load = []
     for part_name in part_names:
         try:  # attempt to cast to uri
             uri = Uri(part_name)
             log_name = uri
 
         except ValueError:  # is a playlist name
-            uri = user_playlists.get(part_name)
-            if uri is None:
+            user_playlist = user_playlists.get(part_name)
+            if user_playlist is None:
                 logger.warning(f'playlist {part_name} not found {username} / {playlist.name}')
                 continue
 
+            uri = user_playlist.uri
             log_name = part_name
 
+        parts_to_load.append((uri, log_name, snapshot_ids.get(str(uri))))
+
+    #  LOAD PLAYLIST TRACKS
+    def load_part(part):
+        uri, log_name, snapshot_id = part
+
+        cache_key = (username, str(uri), snapshot_id)
+        if snapshot_id is not None:
+            if (cached_tracks := playlist_track_cache.get(cache_key)) is not None:
+                logger.debug(f'serving {log_name} from cache {username} / {playlist.name}')
+                return cached_tracks
+
         try:
-            _tracks = spotnet.playlist_tracks(uri=uri, reduced_mem=True)
-            if _tracks and len(_tracks) > 0:
-                playlist_tracks += _tracks
+            _tracks = to_records(spotnet.playlist_tracks(uri=uri, reduced_mem=True) or [])
+            if len(_tracks) > 0:
+                if snapshot_id is not None:
+                    playlist_track_cache.set(cache_key, _tracks)
+                return _tracks
             else:
                 logger.warning(f'no tracks returned for {log_name} {username} / {playlist.name}')
         except SpotifyNetworkException:
             logger.exception(f'error occured while retrieving {log_name} {username} / {playlist.name}')
+            if failures is not None:
+                failures.append(log_name)
+
+        return []
 
-    playlist_tracks = list(remove_local(playlist_tracks))
+    def iter_parts():
+        if len(parts_to_load) == 0:
+            return
 
-    playlist_tracks += load_library_tracks(spotnet, playlist, username)
+        workers = max(1, min(max_workers, len(parts_to_load)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # at most one fetch per worker runs ahead of the consumer, parts are yielded in submission order
+            pending = deque()
+            for part in parts_to_load:
+                pending.append(executor.submit(load_part, part))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
 
-    return playlist_tracks
+            while pending:
+                yield pending.popleft().result()
 
-def load_library_tracks(spotnet: SpotNetwork, playlist: Playlist, username: str):
+    return chain(remove_local(chain.from_iterable(iter_parts())),
+                 load_library_tracks(spotnet, playlist, username, user=user, failures=failures))
+
+def load_library_tracks(spotnet: SpotNetwork, playlist: Playlist, username: str,
+                        user: User = None, failures: list = None) -> List[TrackRecord]:
     tracks = []
 
     if playlist.include_library_tracks:
         try:
-            library_tracks = spotnet.saved_tracks()
+            if user is not None:
+                # stored index only pages tracks saved since the last sync
+                library_tracks = sync_library(spotnet, user)
+            else:
+                library_tracks = to_records(spotnet.saved_tracks() or [])
             if library_tracks and len(library_tracks) > 0:
-                tracks += library_tracks
+                tracks = library_tracks
             else:
                 logger.error(f'error getting library tracks {username} / {playlist.name}')
+                if failures is not None:
+                    failures.append('library')
         except SpotifyNetworkException:
             logger.exception(f'error occured while retrieving library tracks {username} / {playlist.name}')
+            if failures is not None:
+                failures.append('library')
 
     return tracks
 
-def do_playlist_type_processing(spotnet: SpotNetwork, playlist: Playlist, user: User, current_tracks: List):
+def do_playlist_type_processing(spotnet: SpotNetwork, playlist: Playlist, user: User,
+                                current_tracks: Iterable) -> Iterable:
     if playlist.type == 'recents':
         return do_recents_processing(playlist, current_tracks)
     elif playlist.type == 'fmchart':
         return do_lastfm_chart_processing(spotnet, playlist, user, current_tracks)
     return current_tracks
 
-def do_recents_processing(playlist: Playlist, current_tracks: List):
+def do_recents_processing(playlist: Playlist, current_tracks: Iterable) -> Iterator:
     boundary_date = datetime.datetime.now(datetime.timezone.utc) - \
                     datetime.timedelta(days=int(playlist.day_boundary))
-    return list(added_after(current_tracks, boundary_date))
+    return added_after(current_tracks, boundary_date)
 
-def do_lastfm_chart_processing(spotnet: SpotNetwork, playlist: Playlist, user: User, current_tracks: List):
+def do_lastfm_chart_processing(spotnet: SpotNetwork, playlist: Playlist, user: User,
+                               current_tracks: Iterable) -> Iterable:
     if user.lastfm_username is None:
         logger.error(f'no associated last.fm username, chart source skipped {user.username} / {playlist.name}')
     else:
@@ -206,7 +433,7 @@ def do_lastfm_chart_processing(spotnet: SpotNetwork, playlist: Playlist, user: U
                                                              limit=playlist.chart_limit)
 
             if chart_tracks is not None and len(chart_tracks) > 0:
-                current_tracks += chart_tracks
+                current_tracks = chain(current_tracks, to_records(chart_tracks))
             else:
                 logger.error(f'no tracks returned {user.username} / {playlist.name}')
         else:
@@ -214,7 +441,9 @@ def do_lastfm_chart_processing(spotnet: SpotNetwork, playlist: Playlist, user: U
 
     return current_tracks
 
-def sort_tracks(playlist: Playlist, current_tracks: List):
+def sort_tracks(playlist: Playlist, current_tracks: Iterable[TrackRecord]) -> List[TrackRecord]:
+    current_tracks = list(current_tracks)  # only stage to materialise the pipeline
+
     if playlist.shuffle:
         random.shuffle(current_tracks)
         return current_tracks
@@ -222,22 +451,20 @@ def sort_tracks(playlist: Playlist, current_tracks: List):
         return sort_by_release_date(tracks=current_tracks, reverse=True)
     return current_tracks
 
-def get_recommendations(spotnet: SpotNetwork, playlist: Playlist, username: str, current_tracks: List):
+def get_recommendations(spotnet: SpotNetwork, playlist: Playlist, username: str,
+                        current_tracks: List[TrackRecord]) -> List[TrackRecord]:
 
     recommendations = []
 
     if playlist.include_recommendations:
         try:
-            recommendations = spotnet.recommendations(tracks=[i.uri.object_id for i, j
-                                                              in get_track_objects(
-                    random.sample(current_tracks,
-                                  k=min(5, len(current_tracks))
-                                  )
-                )
-                                                              if i.uri.object_type == Uri.ObjectType.track],
+            recommendations = spotnet.recommendations(tracks=[i.object_id for i
+                                                              in random.sample(current_tracks,
+                                                                               k=min(5, len(current_tracks)))
+                                                              if i.object_type == 'track'],
                                                       response_limit=playlist.recommendation_sample)
             if recommendations and len(recommendations.tracks) > 0:
-                recommendations = recommendations.tracks
+                recommendations = to_records(recommendations.tracks)
             else:
                 logger.error(f'error getting recommendations {username} / {playlist.name}')
         except SpotifyNetworkException:
@@ -245,26 +472,131 @@ def get_recommendations(spotnet: SpotNetwork, playlist: Playlist, username: str,
 
     return recommendations
 
-def execute_playlist(spotnet: SpotNetwork, playlist: Playlist, part_names, username: str, current_tracks: List):
-    try:
-        spotnet.replace_playlist_tracks(uri=playlist.uri, uris=[i.uri for i, j in get_track_objects(current_tracks)])
+def get_description(playlist: Playlist, part_names: List[str]) -> str:
+    """Generate a playlist's Spotify description
 
-        if playlist.description_overwrite:
-            string = playlist.description_overwrite
-        else:
-            string = ' / '.join(sorted(part_names))
+    Args:
+        playlist (Playlist): Subject playlist
+        part_names (List[str]): Resolved component playlist names
+
+    Returns:
+        str: Description override or the joined part names, with any suffix
+    """
+
+    if playlist.description_overwrite:
+        string = playlist.description_overwrite
+    else:
+        string = ' / '.join(sorted(part_names))
+
+    if playlist.description_suffix:
+        string += f' - {str(playlist.description_suffix)}'
 
-        if playlist.description_suffix:
-            string += f' - {str(playlist.description_suffix)}'
+    return string
+
+def write_playlist_tracks(spotnet: SpotNetwork, playlist: Playlist, username: str, uris: List[Uri],
+                          snapshot_id: Optional[str] = None) -> None:
+    """Write tracks to the Spotify playlist by diffing against the tracks last written to it
+
+    Paging the playlist takes as many calls as replacing it, so the diff is only planned when the playlist is unchanged
+    since a write held in written_track_cache. Falls back to replacing the whole playlist when the diff would take as
+    many calls or fails part way. Shuffled playlists are always replaced, their order changes every run
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        playlist (Playlist): Subject playlist
+        username (str): Subject user's username
+        uris (List[Uri]): Track URIs to write in order
+        snapshot_id (Optional[str], optional): Current snapshot ID of the Spotify playlist. Defaults to None.
+
+    Raises:
+        SpotifyNetworkException: Replacing the playlist failed
+    """
+
+    operations = None
+
+    current = None
+    if snapshot_id is not None and not playlist.shuffle:
+        current = written_track_cache.get((username, str(playlist.uri), snapshot_id))
+
+    if current is not None:
+        operations = plan_playlist_diff(current=current, target=[str(i) for i in uris])
+    else:
+        logger.debug(f'last write not cached, replacing tracks {username} / {playlist.name}')
+
+    if operations is not None:
+        uri_objects = {**{i: Uri(i) for i in current}, **{str(i): i for i in uris}}
+        logger.info(f'writing {len(operations)} diff operations {username} / {playlist.name}')
+
+        try:
+            for operation in operations:
+                if operation[0] == 'remove':
+                    spotnet.remove_playlist_tracks(uri=playlist.uri, uris=[uri_objects[i] for i in operation[1]])
+                elif operation[0] == 'add':
+                    spotnet.add_playlist_tracks(uri=playlist.uri, uris=[uri_objects[i] for i in operation[1]])
+                elif operation[0] == 'move':
+                    _, range_start, range_length, insert_before = operation
+                    spotnet.reorder_playlist_tracks(uri=playlist.uri, range_start=range_start,
+                                                    range_length=range_length, insert_before=insert_before)
+            return
+        except SpotifyNetworkException:
+            logger.exception(f'error writing diff, replacing tracks {username} / {playlist.name}')
+
+    spotnet.replace_playlist_tracks(uri=playlist.uri, uris=uris)
+
+def execute_playlist(spotnet: SpotNetwork, playlist: Playlist, part_names, username: str,
+                     current_tracks: List[TrackRecord], snapshot_id: Optional[str] = None) -> bool:
+    """Write generated tracks and description to the Spotify playlist, skipped if identical to the last write
+
+    The output fingerprint covers the playlist's snapshot ID after the write, so edits made in Spotify since then
+    change it and the playlist is rewritten
+
+    Args:
+        spotnet (SpotNetwork): Spotframework network for Spotify operations
+        playlist (Playlist): Subject playlist, output_fingerprint is updated on success
+        part_names ([type]): Resolved component playlist names
+        username (str): Subject user's username
+        current_tracks (List[TrackRecord]): Generated tracks
+        snapshot_id (Optional[str], optional): Current snapshot ID of the Spotify playlist, the write is never
+            skipped without one. Defaults to None.
+
+    Returns:
+        bool: Whether the Spotify playlist holds the generated tracks
+    """
+
+    uris = [Uri(i.uri) for i in current_tracks]
+    string = get_description(playlist, part_names)
+
+    def fingerprint(snapshot):
+        return hashlib.sha256(json.dumps([[str(i) for i in uris], string, snapshot]).encode()).hexdigest()
+
+    if snapshot_id is not None and fingerprint(snapshot_id) == playlist.output_fingerprint:
+        logger.info(f'output unchanged, skipping write {username} / {playlist.name}')
+        return True
+
+    try:
+        write_playlist_tracks(spotnet, playlist, username, uris, snapshot_id=snapshot_id)
 
         if string is None or len(string) == 0:
             logger.error(f'no string generated {username} / {playlist.name}')
-            return None
+            return False
 
         try:
             spotnet.change_playlist_details(uri=playlist.uri, description=string)
         except SpotifyNetworkException:
             logger.exception(f'error changing description for {username} / {playlist.name}')
+            return False
 
     except SpotifyNetworkException:
-        logger.exception(f'error executing {username} / {playlist.name}')
\ No newline at end of file
+        logger.exception(f'error executing {username} / {playlist.name}')
+        return False
+    finally:
+        # dependents run later in the same refresh must not reuse this playlist's old snapshot
+        mark_playlist_changed(username, playlist.uri)
+
+    written_snapshot_id = get_playlist_snapshot_id(spotnet, playlist.uri)
+    if written_snapshot_id is not None:
+        mark_playlist_changed(username, playlist.uri, snapshot_id=written_snapshot_id)
+        written_track_cache.set((username, str(playlist.uri), written_snapshot_id), [str(i) for i in uris])
+
+    playlist.output_fingerprint = fingerprint(written_snapshot_id) if written_snapshot_id is not None else None
+    return True
@@ -0,0 +1,126 @@
+"""Compact track representation used through playlist generation in place of full spotframework objects
+"""
+
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+
+class TrackRecord:
+    """Fields of a Spotify track needed to generate a playlist, built at ingestion so full payloads can be dropped
+    """
+
+    __slots__ = ('uri', 'name', 'artists', 'album', 'release_date', 'track_number', 'added_at', 'is_local')
+
+    def __init__(self,
+                 uri: str,
+                 name: str,
+                 artists: Tuple[str, ...] = (),
+                 album: str = None,
+                 release_date: str = '',
+                 track_number: int = 0,
+                 added_at: Optional[datetime] = None,
+                 is_local: bool = False):
+        self.uri = uri
+        self.name = name
+        self.artists = artists
+        self.album = album
+        self.release_date = release_date
+        self.track_number = track_number
+        self.added_at = added_at
+        self.is_local = is_local
+
+    @classmethod
+    def from_spotframework(cls, item) -> Optional['TrackRecord']:
+        """Build a record from a spotframework track or playlist/library track wrapper
+
+        Args:
+            item: Spotframework track object
+
+        Returns:
+            Optional[TrackRecord]: Record, None if the item holds no track
+        """
+
+        track = getattr(item, 'track', None) or item
+        if getattr(track, 'uri', None) is None or getattr(track, 'name', None) is None:
+            return None
+
+        album = getattr(track, 'album', None)
+        release_date = getattr(album, 'release_date', None)
+
+        return cls(uri=str(track.uri),
+                   name=track.name,
+                   artists=tuple(i.name for i in getattr(track, 'artists', None) or []),
+                   album=getattr(album, 'name', None),
+                   release_date=str(release_date) if release_date is not None else '',
+                   track_number=getattr(track, 'track_number', None) or 0,
+                   added_at=getattr(item, 'added_at', None),
+                   is_local=bool(getattr(item, 'is_local', False) or getattr(track, 'is_local', False)))
+
+    def to_dict(self) -> dict:
+        """Serialise for storage
+
+        Returns:
+            dict: Record fields, artists as a list
+        """
+
+        return {
+            'uri': self.uri,
+            'name': self.name,
+            'artists': list(self.artists),
+            'album': self.album,
+            'release_date': self.release_date,
+            'track_number': self.track_number,
+            'added_at': self.added_at,
+            'is_local': self.is_local
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TrackRecord':
+        """Deserialise a stored record
+
+        Args:
+            data (dict): Fields as produced by to_dict
+
+        Returns:
+            TrackRecord: Record
+        """
+
+        return cls(uri=data['uri'],
+                   name=data['name'],
+                   artists=tuple(data.get('artists') or ()),
+                   album=data.get('album'),
+                   release_date=data.get('release_date') or '',
+                   track_number=data.get('track_number') or 0,
+                   added_at=data.get('added_at'),
+                   is_local=data.get('is_local', False))
+
+    @property
+    def object_type(self) -> str:
+        """Spotify object type from the URI, e.g. track"""
+        return self.uri.split(':')[1] if self.uri.count(':') >= 2 else None
+
+    @property
+    def object_id(self) -> str:
+        """Spotify object ID from the URI"""
+        return self.uri.split(':')[-1]
+
+    def __eq__(self, other):
+        if not isinstance(other, TrackRecord):
+            return NotImplemented
+        return all(getattr(self, i) == getattr(other, i) for i in self.__slots__)
+
+    def __repr__(self):
+        return f'TrackRecord({self.uri}, {self.name}, {", ".join(self.artists)})'
+
+
+def to_records(items: Iterable) -> List[TrackRecord]:
+    """Convert spotframework track objects to records, dropping items without a track
+
+    Args:
+        items (Iterable): Spotframework track objects
+
+    Returns:
+        List[TrackRecord]: Converted records
+    """
+
+    return [record for record in map(TrackRecord.from_spotframework, items) if record is not None]
@@ -1,7 +1,17 @@
 import logging
-from datetime import datetime
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, NamedTuple, Optional
+
+import fireo
 
 import music.db.database as database
+from music.cache import create_cache
+from music.rate_limit import RateLimiter, RateLimitedNetwork
+from music.model.data_version import bump_data_version
 from music.model.user import User
 from music.model.tag import Tag
 from music.notif.notifier import notify_user_tag_update
@@ -12,8 +22,60 @@ from spotfm.timer import time, seconds_to_time_str
 
 logger = logging.getLogger(__name__)
 
+TAG_RESOLVE_WORKERS = int(os.environ.get('TAG_RESOLVE_WORKERS', 8))
+"""Maximum number of tag artists, albums and tracks looked up at once
+"""
+
+TAG_WRITE_BATCH_SIZE = 500
+"""Maximum tags written per Firestore batch
+"""
+
+TAG_FULL_REFRESH_INTERVAL = timedelta(hours=int(os.environ.get('TAG_FULL_REFRESH_HOURS', 24)))
+"""Maximum time between full recounts of a tag, refreshes in between only add new scrobbles
+"""
+
+lastfm_limiter = RateLimiter(rate=float(os.environ.get('LASTFM_RATE_LIMIT', 5)))
+"""Last.fm calls per second shared by all tag updates in the process
+"""
+
+spotify_limiter = RateLimiter(rate=float(os.environ.get('SPOTIFY_RATE_LIMIT', 10)))
+"""Spotify calls per second shared by all tag updates in the process
+"""
+
+tag_entity_cache = create_cache(os.environ.get('TAG_ENTITY_CACHE_BACKEND', 'memory'),
+                                max_size=int(os.environ.get('TAG_ENTITY_CACHE_SIZE', 4096)),
+                                ttl=int(os.environ.get('TAG_ENTITY_CACHE_TTL', 900)),
+                                directory=os.path.join(tempfile.gettempdir(), 'mixonomer-tag-entities'))
+"""Looked up tag entries keyed by (Last.fm username, timed, type, artist, name), shared between a user's tags
+"""
+
+
+class EntryResult(NamedTuple):
+    """Looked up figures for one tag artist, album or track
+    """
+    scrobbles: int
+    time_ms: Optional[int] = None
+    album: Optional[str] = None
+    """Album of a looked up track, if known
+    """
 
-def update_tag(user: User, tag: Tag, spotnet=None, fmnet=None):
+
+def update_tag(user: User, tag: Tag, spotnet=None, fmnet=None, full: bool = False):
+    """Refresh a tag's scrobble counts
+
+    Between periodic full recounts only scrobbles since the last update are fetched and added to stored counts
+
+    Args:
+        user (User): Subject user
+        tag (Tag): User's subject tag
+        spotnet (optional): Spotframework network for timing objects. Defaults to None.
+        fmnet (optional): Fmframework network. Defaults to None.
+        full (bool, optional): Recount every entry from Last.fm, skipping incremental refresh and cached counts. Defaults to False.
+
+    Raises:
+        NameError: No user or tag found, or no Last.fm network available
+        AttributeError: User has no Last.fm username
+    """
 
     # PRE-RUN CHECKS
 
@@ -59,119 +121,412 @@ def update_tag(user: User, tag: Tag, spotnet=None, fmnet=None):
         else:
             logger.warning(f'timing objects requested but no spotify linked {username} / {tag_id}')
 
-    tag.count = 0
-    tag.total_time_ms = 0
+    compute_tag(user, tag, fmnet=fmnet, spotnet=spotnet, user_scrobbles=get_user_scrobbles(fmnet, username),
+                full=full)
 
-    artists = []
-    for artist in tag.artists:
-        try:
-            if tag.time_objects and user.spotify_linked:
-                total_ms, timed_tracks = time(spotnet=spotnet, fmnet=fmnet,
-                                              artist=artist['name'], username=user.lastfm_username,
-                                              return_tracks=True)
-                scrobbles = sum(i[0].user_scrobbles for i in timed_tracks)
+    tag.update()
 
-                artist['time_ms'] = total_ms
-                artist['time'] = seconds_to_time_str(milliseconds=total_ms)
-                tag.total_time_ms += total_ms
+    notify_user_tag_update(user=user, tag=tag)
 
-            else:
-                net_artist = fmnet.artist(name=artist['name'])
 
-                if net_artist is not None:
-                    scrobbles = net_artist.user_scrobbles
-                else:
-                    scrobbles = 0
+def compute_tag(user: User, tag: Tag, fmnet, spotnet=None, user_scrobbles: int = 0, full: bool = False) -> None:
+    """Refresh a tag's counts and proportion in place without writing it
 
-            artist['count'] = scrobbles
-            tag.count += scrobbles
-        except LastFMNetworkException:
-            logger.exception(f'error during artist retrieval {username} / {tag_id}')
+    Args:
+        user (User): Subject user
+        tag (Tag): User's subject tag
+        fmnet: Fmframework network
+        spotnet (optional): Spotframework network for timing objects. Defaults to None.
+        user_scrobbles (int, optional): User's total scrobble count, no proportion if 0. Defaults to 0.
+        full (bool, optional): Recount every entry from Last.fm, skipping incremental refresh and cached counts. Defaults to False.
+    """
 
-        artists.append(artist)
+    now = datetime.now(timezone.utc)
 
-    albums = []
-    for album in tag.albums:
-        try:
-            if tag.time_objects and user.spotify_linked:
-                total_ms, timed_tracks = time(spotnet=spotnet, fmnet=fmnet,
-                                              album=album['name'], artist=album['artist'],
-                                              username=user.lastfm_username, return_tracks=True)
-                scrobbles = sum(i[0].user_scrobbles for i in timed_tracks)
+    results = None
+    if not full and not needs_full_refresh(tag, now):
+        results = resolve_tag_deltas(tag, fmnet=fmnet, from_time=tag.last_updated, to_time=now)
 
-                album['time_ms'] = total_ms
-                album['time'] = seconds_to_time_str(milliseconds=total_ms)
-                tag.total_time_ms += total_ms
+    if results is None:
+        timed = bool(tag.time_objects and user.spotify_linked)
+        results = resolve_tag_entries(tag, fmnet=fmnet, spotnet=spotnet, lastfm_username=user.lastfm_username,
+                                      timed=timed, cached=not full)
+        tag.last_full_refresh = now
 
-            else:
-                net_album = fmnet.album(name=album['name'], artist=album['artist'])
+    aggregate_tag(tag, results)
 
-                if net_album is not None:
-                    scrobbles = net_album.user_scrobbles
-                else:
-                    scrobbles = 0
+    tag.total_time = seconds_to_time_str(milliseconds=tag.total_time_ms)
+
+    if user_scrobbles > 0:
+        tag.total_user_scrobbles = user_scrobbles
+        tag.proportion = (tag.count / user_scrobbles) * 100
+    else:
+        logger.warning(f'user scrobble count for {user.username} returned 0')
+        tag.total_user_scrobbles = 0
+        tag.proportion = 0
+
+    tag.last_updated = now
 
-            album['count'] = scrobbles
 
-            if album['artist'].lower() not in [i.lower() for i in [j['name'] for j in artists]]:
-                tag.count += scrobbles
-        except LastFMNetworkException:
-            logger.exception(f'error during album retrieval {username} / {tag_id}')
+def get_user_scrobbles(fmnet, username: str) -> int:
+    """Get a user's total scrobble count
 
-        albums.append(album)
+    Args:
+        fmnet: Fmframework network
+        username (str): Subject username for logging
+
+    Returns:
+        int: Scrobble count, 0 if it couldn't be retrieved
+    """
+
+    try:
+        return fmnet.user_scrobble_count()
+    except LastFMNetworkException:
+        logger.exception(f'error retrieving scrobble count {username}')
+        return 0
+
+
+def update_user_tags(user: User, spotnet=None, fmnet=None, full: bool = False) -> None:
+    """Refresh all of a user's tags in one go
+
+    The networks and the user's scrobble count are shared by every tag and the tags are written together in
+    batches. A tag that fails to refresh is logged and left as it was
+
+    Args:
+        user (User): Subject user
+        spotnet (optional): Spotframework network for timing objects. Defaults to None.
+        fmnet (optional): Fmframework network. Defaults to None.
+        full (bool, optional): Recount every entry from Last.fm. Defaults to False.
+
+    Raises:
+        NameError: No user found or no Last.fm network available
+        AttributeError: User has no Last.fm username
+    """
+
+    if isinstance(user, str):
+        username = user
+        user = User.collection.filter('username', '==', username.strip().lower()).get()
+    else:
+        username = user.username
+
+    if user is None:
+        logger.error(f'user {username} not found')
+        raise NameError(f'User {username} not found')
+
+    if user.lastfm_username is None or len(user.lastfm_username) == 0:
+        logger.error(f'{username} has no last.fm username')
+        raise AttributeError(f'{username} has no Last.fm username')
+
+    tags = list(Tag.collection.parent(user.key).fetch())
+
+    logger.info(f'updating {len(tags)} tags for {username}')
+
+    if len(tags) == 0:
+        return
+
+    if fmnet is None:
+        fmnet = database.get_authed_lastfm_network(user)
 
-    tracks = []
-    for track in tag.tracks:
+    if fmnet is None:
+        logger.error(f'no last.fm network returned for {username}')
+        raise NameError(f'No Last.fm network returned ({username})')
+
+    if any(i.time_objects for i in tags):
+        if user.spotify_linked:
+            if spotnet is None:
+                spotnet = database.get_authed_spotify_network(user)
+        else:
+            logger.warning(f'timing objects requested but no spotify linked {username}')
+
+    user_scrobbles = get_user_scrobbles(fmnet, username)
+
+    updated = []
+    for tag in tags:
         try:
-            if tag.time_objects and user.spotify_linked:
-                total_ms, timed_tracks = time(spotnet=spotnet, fmnet=fmnet,
-                                              track=track['name'], artist=track['artist'],
-                                              username=user.lastfm_username, return_tracks=True)
-                scrobbles = sum(i[0].user_scrobbles for i in timed_tracks)
+            compute_tag(user, tag, fmnet=fmnet, spotnet=spotnet, user_scrobbles=user_scrobbles, full=full)
+            updated.append(tag)
+        except Exception:
+            logger.exception(f'error updating {username} / {tag.tag_id}')
 
-                track['time_ms'] = total_ms
-                track['time'] = seconds_to_time_str(milliseconds=total_ms)
-                tag.total_time_ms += total_ms
+    for idx in range(0, len(updated), TAG_WRITE_BATCH_SIZE):
+        batch = fireo.batch()
+        for tag in updated[idx:idx + TAG_WRITE_BATCH_SIZE]:
+            tag.update(batch=batch)
+        batch.commit()
 
-            else:
-                net_track = fmnet.track(name=track['name'], artist=track['artist'])
+    if len(updated) > 0:
+        bump_data_version(user.key)
 
-                if net_track is not None:
-                    scrobbles = net_track.user_scrobbles
-                else:
-                    scrobbles = 0
+    for tag in updated:
+        notify_user_tag_update(user=user, tag=tag)
 
-            track['count'] = scrobbles
 
-            if track['artist'].lower() not in [i.lower() for i in [j['name'] for j in artists]]:
-                tag.count += scrobbles
-        except LastFMNetworkException:
-            logger.exception(f'error during track retrieval {username} / {tag_id}')
+def needs_full_refresh(tag: Tag, now: datetime) -> bool:
+    """Check whether a tag has to be recounted rather than have new scrobbles added to its stored counts
 
-        tracks.append(track)
+    Args:
+        tag (Tag): Subject tag
+        now (datetime): Time of the refresh
 
-    tag.tracks = tracks
-    tag.albums = albums
-    tag.artists = artists
+    Returns:
+        bool: Recount all entries
+    """
 
-    tag.total_time = seconds_to_time_str(milliseconds=tag.total_time_ms)
+    if tag.time_objects:  # listening time needs track durations from Spotify
+        return True
+
+    if any('count' not in i for i in chain(tag.artists, tag.albums, tag.tracks)):  # new or edited entries
+        return True
+
+    return tag.last_updated is None or tag.last_full_refresh is None \
+        or tag.last_full_refresh + TAG_FULL_REFRESH_INTERVAL < now
+
+
+def resolve_tag_deltas(tag: Tag, fmnet, from_time: datetime,
+                       to_time: datetime) -> Optional[Dict[str, List[Optional[EntryResult]]]]:
+    """Add scrobbles from the user's recent tracks to the stored counts of a tag's artists, albums and tracks
+
+    Scrobbles are matched case-insensitively, late scrobbles or Last.fm corrections drift until the next full recount
+
+    Args:
+        tag (Tag): Subject tag with counts from a previous refresh
+        fmnet: Last.fm network
+        from_time (datetime): Time of the previous refresh
+        to_time (datetime): Time of this refresh
+
+    Returns:
+        Optional[Dict[str, List[Optional[EntryResult]]]]: Results in the form of resolve_tag_entries, None if recent tracks couldn't be retrieved
+    """
 
     try:
-        user_scrobbles = fmnet.user_scrobble_count()
+        scrobbles = fmnet.recent_tracks(from_time=from_time, to_time=to_time) or []
     except LastFMNetworkException:
-        logger.exception(f'error retrieving scrobble count {username} / {tag_id}')
-        user_scrobbles = 0
+        logger.exception(f'error retrieving recent tracks, recounting {tag.username} / {tag.tag_id}')
+        return None
 
-    if user_scrobbles > 0:
-        tag.total_user_scrobbles = user_scrobbles
-        tag.proportion = (tag.count / user_scrobbles) * 100
+    try:
+        played = [((scrobble.track.artist.name or '').casefold(),
+                   scrobble.track.name.casefold(),
+                   (album.casefold() if (album := get_album_name(scrobble.track)) is not None else None))
+                  for scrobble in scrobbles]
+    except (AttributeError, TypeError):
+        logger.exception(f'error reading recent tracks, recounting {tag.username} / {tag.tag_id}')
+        return None
+
+    artist_deltas = {i['name'].casefold(): 0 for i in tag.artists}
+    album_deltas = {(i['artist'].casefold(), i['name'].casefold()): 0 for i in tag.albums}
+    track_deltas = {(i['artist'].casefold(), i['name'].casefold()): 0 for i in tag.tracks}
+
+    for artist, track, album in played:
+        if artist in artist_deltas:
+            artist_deltas[artist] += 1
+
+        if album is not None and (artist, album) in album_deltas:
+            album_deltas[(artist, album)] += 1
+
+        if (artist, track) in track_deltas:
+            track_deltas[(artist, track)] += 1
+
+    logger.info(f'{len(scrobbles)} new scrobbles for {tag.username} / {tag.tag_id}')
+
+    return {
+        'artist': [EntryResult(scrobbles=i['count'] + artist_deltas[i['name'].casefold()]) for i in tag.artists],
+        'album': [EntryResult(scrobbles=i['count'] + album_deltas[(i['artist'].casefold(), i['name'].casefold())])
+                  for i in tag.albums],
+        'track': [EntryResult(scrobbles=i['count'] + track_deltas[(i['artist'].casefold(), i['name'].casefold())],
+                              album=i.get('album'))
+                  for i in tag.tracks]
+    }
+
+
+def resolve_tag_entries(tag: Tag, fmnet, spotnet=None, lastfm_username: str = None,
+                        timed: bool = False, cached: bool = True) -> Dict[str, List[Optional[EntryResult]]]:
+    """Look up the scrobbles and optionally listening time of all of a tag's artists, albums and tracks concurrently
+
+    Calls to each service are rate limited, a failed lookup leaves only its own entry unresolved. Each distinct
+    entity is looked up once and the result kept in tag_entity_cache for the user's other tags
+
+    Args:
+        tag (Tag): Subject tag
+        fmnet: Last.fm network
+        spotnet (optional): Spotify network, required when timed. Defaults to None.
+        lastfm_username (str, optional): Last.fm username, required when timed. Defaults to None.
+        timed (bool, optional): Time entries using Spotify durations. Defaults to False.
+        cached (bool, optional): Allow results cached by an earlier tag update. Defaults to True.
+
+    Returns:
+        Dict[str, List[Optional[EntryResult]]]: Results in tag order for each of artist, album and track, None where the lookup failed
+    """
+
+    fmnet = RateLimitedNetwork(fmnet, lastfm_limiter)
+    if spotnet is not None:
+        spotnet = RateLimitedNetwork(spotnet, spotify_limiter)
+
+    entries = [('artist', tag.artists), ('album', tag.albums), ('track', tag.tracks)]
+    username = lastfm_username or tag.username
+
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=TAG_RESOLVE_WORKERS) as executor:
+        pending = {}
+        for kind, kind_entries in entries:
+            for entry in kind_entries:
+                key = get_entity_key(username, kind, entry, timed)
+
+                if key in resolved or key in pending:
+                    continue
+
+                if cached and (result := tag_entity_cache.get(key)) is not None:
+                    resolved[key] = result
+                else:
+                    pending[key] = executor.submit(resolve_entry, kind, entry, fmnet=fmnet, spotnet=spotnet,
+                                                   lastfm_username=lastfm_username, timed=timed)
+
+        for key, future in pending.items():
+            try:
+                resolved[key] = future.result()
+                tag_entity_cache.set(key, resolved[key])
+            except LastFMNetworkException:
+                logger.exception(f'error during {key[2]} retrieval {tag.username} / {tag.tag_id}')
+                resolved[key] = None
+
+    logger.debug(f'looked up {len(pending)} of {len(resolved)} entities for {tag.username} / {tag.tag_id}')
+
+    return {kind: [resolved[get_entity_key(username, kind, entry, timed)] for entry in kind_entries]
+            for kind, kind_entries in entries}
+
+
+def get_entity_key(username: str, kind: str, entry: dict, timed: bool = False) -> tuple:
+    """Get the tag_entity_cache key of a tag entry, case-insensitive as Last.fm is
+
+    Args:
+        username (str): Last.fm username the counts belong to
+        kind (str): artist, album or track
+        entry (dict): Tag entry
+        timed (bool, optional): Entry is timed. Defaults to False.
+
+    Returns:
+        tuple: (username, timed, kind, artist, name)
+    """
+
+    if kind == 'artist':
+        return username, timed, kind, entry['name'].casefold(), None
+
+    return username, timed, kind, entry['artist'].casefold(), entry['name'].casefold()
+
+
+def resolve_entry(kind: str, entry: dict, fmnet, spotnet=None, lastfm_username: str = None,
+                  timed: bool = False) -> EntryResult:
+    """Look up one tag artist, album or track
+
+    Args:
+        kind (str): artist, album or track
+        entry (dict): Tag entry with a name and, for albums and tracks, an artist
+        fmnet: Last.fm network
+        spotnet (optional): Spotify network, required when timed. Defaults to None.
+        lastfm_username (str, optional): Last.fm username, required when timed. Defaults to None.
+        timed (bool, optional): Time the entry using Spotify durations. Defaults to False.
+
+    Raises:
+        LastFMNetworkException: Last.fm lookup failed
+
+    Returns:
+        EntryResult: Scrobbles and listening time if timed
+    """
+
+    if kind == 'artist':
+        params = {'artist': entry['name']}
     else:
-        logger.warning(f'user scrobble count for {username} returned 0')
-        tag.total_user_scrobbles = 0
-        tag.proportion = 0
+        params = {kind: entry['name'], 'artist': entry['artist']}
 
-    tag.last_updated = datetime.utcnow()
+    if timed:
+        total_ms, timed_tracks = time(spotnet=spotnet, fmnet=fmnet, username=lastfm_username, return_tracks=True,
+                                      **params)
+        return EntryResult(scrobbles=sum(i[0].user_scrobbles for i in timed_tracks), time_ms=total_ms,
+                           album=get_album_name(timed_tracks[0][0]) if kind == 'track' and timed_tracks else None)
 
-    tag.update()
+    if kind == 'artist':
+        net_entry = fmnet.artist(name=entry['name'])
+    else:
+        net_entry = getattr(fmnet, kind)(name=entry['name'], artist=entry['artist'])
 
-    notify_user_tag_update(user=user, tag=tag)
+    if net_entry is None:
+        return EntryResult(scrobbles=0)
+
+    return EntryResult(scrobbles=net_entry.user_scrobbles,
+                       album=get_album_name(net_entry) if kind == 'track' else None)
+
+
+def get_album_name(track) -> Optional[str]:
+    """Get the album name of a Last.fm track if it was returned
+
+    Args:
+        track: fmframework track
+
+    Returns:
+        Optional[str]: Album name
+    """
+
+    name = getattr(getattr(track, 'album', None), 'name', None)
+    return name if isinstance(name, str) else None
+
+
+def aggregate_tag(tag: Tag, results: Dict[str, List[Optional[EntryResult]]]) -> None:
+    """Write looked up figures to a tag's entries and total them without counting a scrobble twice
+
+    Albums by a counted artist and tracks by a counted artist or on a counted album are already included, entries
+    whose lookup failed aren't counted so don't exclude others. Entries are merged in tag order so totals don't
+    depend on which lookups finished first
+
+    Args:
+        tag (Tag): Subject tag
+        results (Dict[str, List[Optional[EntryResult]]]): Results from resolve_tag_entries
+    """
+
+    tag.count = 0
+    tag.total_time_ms = 0
+
+    counted_artists = {artist['name'].casefold()
+                       for artist, result in zip(tag.artists, results['artist']) if result is not None}
+    counted_albums = {(album['artist'].casefold(), album['name'].casefold())
+                      for album, result in zip(tag.albums, results['album']) if result is not None}
+
+    for artist, result in zip(tag.artists, results['artist']):
+        if result is not None:
+            set_entry_result(tag, artist, result)
+            tag.count += result.scrobbles
+
+    for album, result in zip(tag.albums, results['album']):
+        if result is not None:
+            set_entry_result(tag, album, result)
+            if album['artist'].casefold() not in counted_artists:
+                tag.count += result.scrobbles
+
+    for track, result in zip(tag.tracks, results['track']):
+        if result is not None:
+            set_entry_result(tag, track, result)
+
+            artist = track['artist'].casefold()
+            if artist in counted_artists:
+                continue
+            if result.album is not None and (artist, result.album.casefold()) in counted_albums:
+                continue
+            tag.count += result.scrobbles
+
+
+def set_entry_result(tag: Tag, entry: dict, result: EntryResult) -> None:
+    """Write looked up figures to a tag entry, adding any listening time to the tag's total
+
+    Args:
+        tag (Tag): Subject tag
+        entry (dict): Tag entry
+        result (EntryResult): Entry figures
+    """
+
+    entry['count'] = result.scrobbles
+    if result.album is not None:
+        entry['album'] = result.album
+
+    if result.time_ms is not None:
+        entry['time_ms'] = result.time_ms
+        entry['time'] = seconds_to_time_str(milliseconds=result.time_ms)
+        tag.total_time_ms += result.time_ms
@@ -0,0 +1,312 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import ANY, Mock, patch
+
+from google.api_core.exceptions import Aborted
+
+import music.db.database as database
+from music.db.library import sync_library
+from music.db.listing import list_documents, parse_fields, get_public_fields, encode_cursor, decode_cursor
+
+from music.db.playlist_graph import set_node, flatten_parts, get_dependents, creates_cycle, write_playlist_node, \
+    delete_playlist_node, update_playlist_node, remove_playlist_node
+from music.model.playlist_graph import PlaylistGraph
+from music.model.user import User
+from music.tasks.track_record import TrackRecord
+
+
+def playlist_mock(playlist_id, name, parts, references):
+    playlist = Mock()
+    playlist.id = playlist_id
+    playlist.name = name
+    playlist.parts = parts
+    playlist.playlist_references = [Mock(id=i) for i in references]
+    return playlist
+
+
+class TestPlaylistGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = PlaylistGraph()
+        self.graph.names, self.graph.parts, self.graph.references = {}, {}, {}
+
+        for playlist in [
+            playlist_mock('a', 'parent', ['part 1'], ['b']),
+            playlist_mock('b', 'child', ['part 2'], ['c']),
+            playlist_mock('c', 'grandchild', ['part 3', 'part 1'], []),
+            playlist_mock('d', 'other parent', [], ['c']),
+        ]:
+            set_node(self.graph, playlist)
+
+        self.graph.dependents = {'a': [], 'b': ['a'], 'c': ['b', 'd'], 'd': []}
+
+    def test_flatten_parts(self):
+        self.assertEqual(flatten_parts(self.graph, 'a'), ['part 1', 'part 2', 'part 3'])
+        self.assertEqual(flatten_parts(self.graph, 'd'), ['part 1', 'part 3'])
+
+    def test_get_dependents(self):
+        self.assertEqual(sorted(get_dependents(self.graph, 'c')), ['a', 'b', 'd'])
+        self.assertEqual(get_dependents(self.graph, 'a'), [])
+
+    def test_creates_cycle(self):
+        self.assertTrue(creates_cycle(self.graph, 'c', ['a']))
+        self.assertTrue(creates_cycle(self.graph, 'a', ['a']))
+        self.assertTrue(creates_cycle(self.graph, 'c', ['d']))
+        self.assertFalse(creates_cycle(self.graph, 'a', ['d']))
+
+    @patch('music.db.playlist_graph.get_playlist_graph')
+    def test_node_written_in_transaction(self, get_graph):
+        self.graph.flattened_parts = {}
+        self.graph.save = Mock()
+        get_graph.return_value = self.graph
+        transaction = Mock()
+
+        affected = write_playlist_node.to_wrap(transaction, Mock(), playlist_mock('c', 'grandchild', ['part 4'], []))
+
+        get_graph.assert_called_once_with(ANY, transaction=transaction)
+        self.graph.save.assert_called_once_with(transaction=transaction)
+        self.assertEqual(sorted(affected), ['child', 'other parent', 'parent'])
+        self.assertEqual(self.graph.flattened_parts['a'], ['part 1', 'part 2', 'part 4'])
+
+    @patch('music.db.playlist_graph.get_playlist_graph')
+    def test_node_deleted_in_transaction(self, get_graph):
+        self.graph.flattened_parts = {}
+        self.graph.save = Mock()
+        get_graph.return_value = self.graph
+        transaction = Mock()
+
+        delete_playlist_node.to_wrap(transaction, Mock(), 'b')
+
+        self.graph.save.assert_called_once_with(transaction=transaction)
+        self.assertNotIn('b', self.graph.names)
+        self.assertEqual(self.graph.references['a'], [])
+        self.assertEqual(self.graph.flattened_parts['a'], ['part 1'])
+
+    @patch('music.db.playlist_graph.fireo', Mock())
+    @patch('music.db.playlist_graph.build_playlist_graph')
+    def test_rebuilt_on_failed_transaction(self, build_graph):
+        user = Mock()
+
+        with patch('music.db.playlist_graph.write_playlist_node', side_effect=Aborted('contention')):
+            self.assertEqual(update_playlist_node(user, playlist_mock('c', 'grandchild', [], [])), [])
+        with patch('music.db.playlist_graph.delete_playlist_node', side_effect=Aborted('contention')):
+            remove_playlist_node(user, 'c')
+
+        self.assertEqual(build_graph.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class FakeLibraryNetwork:
+    """Stand-in spotframework network serving a saved track library, newest first"""
+
+    def __init__(self, count, start):
+        self.tracks = [SimpleNamespace(track=SimpleNamespace(uri=f'spotify:track:{i}', name=f'track {i}', artists=[]),
+                                       added_at=start + timedelta(minutes=i))
+                       for i in reversed(range(count))]
+        self.requested = []
+
+    def saved_tracks(self, response_limit=None):
+        tracks = self.tracks if response_limit is None else self.tracks[:response_limit]
+        self.requested.append(len(tracks))
+        return tracks
+
+    def save(self, count):
+        start = self.tracks[0].added_at
+        offset = int(self.tracks[0].track.name.split()[1]) + 1
+        self.tracks = [SimpleNamespace(track=SimpleNamespace(uri=f'spotify:track:{i}', name=f'track {i}', artists=[]),
+                                       added_at=start + timedelta(minutes=i - offset + 1))
+                       for i in reversed(range(offset, offset + count))] + self.tracks
+
+
+@patch('music.db.library.release_sync_lease', Mock())
+@patch('music.db.library.store_library_records')
+@patch('music.db.library.load_library_records')
+@patch('music.db.library.acquire_sync_lease')
+class TestLibrarySync(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.now(timezone.utc)
+        self.network = FakeLibraryNetwork(500, self.now - timedelta(days=2))
+
+        stored = [TrackRecord.from_spotframework(i) for i in reversed(self.network.tracks)]
+        self.stored = [TrackRecord.from_dict(i.to_dict()) for i in stored]
+
+        self.index = Mock(newest_added_at=stored[-1].added_at, last_full_sync=self.now - timedelta(hours=1),
+                          last_synced=self.now - timedelta(hours=1), chunk_count=1)
+
+    def test_no_index_full_sync(self, get_index, load_records, store_records):
+        get_index.return_value = Mock(newest_added_at=None, last_full_sync=None, last_synced=None, chunk_count=0)
+
+        tracks = sync_library(self.network, Mock())
+
+        self.assertEqual([i.uri for i in tracks], [str(i.track.uri) for i in self.network.tracks])
+        self.assertEqual(self.network.requested, [500])
+        self.assertTrue(store_records.call_args.kwargs['full_sync'])
+        load_records.assert_not_called()
+
+    def test_stale_index_full_sync(self, get_index, load_records, store_records):
+        self.index.last_full_sync = self.now - timedelta(days=2)
+        get_index.return_value = self.index
+
+        sync_library(self.network, Mock())
+
+        self.assertEqual(self.network.requested, [500])
+        load_records.assert_not_called()
+
+    def test_unchanged_delta(self, get_index, load_records, store_records):
+        get_index.return_value = self.index
+        load_records.return_value = self.stored
+
+        tracks = sync_library(self.network, Mock())
+
+        self.assertEqual([i.uri for i in tracks], [str(i.track.uri) for i in self.network.tracks])
+        self.assertEqual(self.network.requested, [50])
+        store_records.assert_not_called()
+
+    def test_new_tracks_delta(self, get_index, load_records, store_records):
+        get_index.return_value = self.index
+        load_records.return_value = list(self.stored)
+        self.network.save(60)
+
+        tracks = sync_library(self.network, Mock())
+
+        self.assertEqual([i.uri for i in tracks], [str(i.track.uri) for i in self.network.tracks])
+        self.assertEqual(self.network.requested, [50, 200])
+        self.assertFalse(store_records.call_args.kwargs.get('full_sync', False))
+
+    def test_concurrent_syncs_page_once(self, get_index, load_records, store_records):
+        get_index.return_value = self.index
+        load_records.return_value = self.stored
+        user = Mock(username='test')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: sync_library(self.network, user), range(4)))
+
+        self.assertEqual(self.network.requested, [50])  # later syncs served from the index
+        self.assertEqual(get_index.call_count, 4)
+        for tracks in results:
+            self.assertEqual([i.uri for i in tracks], [str(i.track.uri) for i in self.network.tracks])
+
+
+class TestNetworkPool(unittest.TestCase):
+
+    def setUp(self):
+        database.network_pool.clear()
+
+        self.user = Mock(username='test', spotify_linked=True, refresh_token='refresh')
+
+    def pooled_network(self, user):
+        net = Mock()
+        net.user.refresh_token = user.refresh_token
+        net.user.last_refreshed = datetime.now(timezone.utc)
+        net.user.token_expiry = 3600
+        return net
+
+    @patch('music.db.database.create_spotify_network')
+    def test_network_reused(self, create_network):
+        create_network.side_effect = self.pooled_network
+
+        first = database.get_authed_spotify_network(self.user)
+        second = database.get_authed_spotify_network(self.user)
+
+        self.assertIs(first, second)
+        create_network.assert_called_once()
+        first.refresh_access_token.assert_not_called()
+
+    @patch('music.db.database.create_spotify_network')
+    def test_expired_token_refreshed_in_place(self, create_network):
+        create_network.side_effect = self.pooled_network
+
+        first = database.get_authed_spotify_network(self.user)
+        first.user.last_refreshed = datetime.now(timezone.utc) - timedelta(hours=2)
+        second = database.get_authed_spotify_network(self.user)
+
+        self.assertIs(first, second)
+        first.refresh_access_token.assert_called_once()
+
+    @patch('music.db.database.create_spotify_network')
+    def test_relinked_user_rebuilt(self, create_network):
+        create_network.side_effect = self.pooled_network
+
+        first = database.get_authed_spotify_network(self.user)
+        self.user.refresh_token = 'new refresh'
+        second = database.get_authed_spotify_network(self.user)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(create_network.call_count, 2)
+
+    def test_display_name_cached(self):
+        self.user.spotify_display_name = 'display name'
+        self.user.spotify_info_refreshed = datetime.now(timezone.utc)
+        net = Mock()
+
+        self.assertEqual(database.get_spotify_display_name(self.user, net), 'display name')
+        net.refresh_user_info.assert_not_called()
+
+    def test_stale_display_name_refreshed(self):
+        self.user.spotify_display_name = 'old name'
+        self.user.spotify_info_refreshed = datetime.now(timezone.utc) - timedelta(days=30)
+        net = Mock()
+        net.user.user.display_name = 'new name'
+
+        self.assertEqual(database.get_spotify_display_name(self.user, net), 'new name')
+        net.refresh_user_info.assert_called_once()
+        self.user.update.assert_called_once()
+
+
+class TestListing(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = Mock()
+        self.query = self.collection.order_by.return_value.order_by.return_value
+        for method in ['select', 'start_after', 'limit']:
+            getattr(self.query, method).return_value = self.query
+
+    @staticmethod
+    def snapshot(name, document_id):
+        snapshot = Mock(id=document_id)
+        snapshot.get.side_effect = lambda field: {'name': name}[field]
+        return snapshot
+
+    def test_public_fields_exclude_sensitive(self):
+        fields = get_public_fields(User)
+
+        self.assertIn('username', fields)
+        for field in ['id', 'password', 'access_token', 'refresh_token', 'token_expiry']:
+            self.assertNotIn(field, fields)
+
+    def test_parse_fields(self):
+        self.assertEqual(parse_fields('name, type,name', ['name', 'type']), ['name', 'type'])
+        self.assertIsNone(parse_fields(None, ['name']))
+        with self.assertRaises(ValueError):
+            parse_fields('name,password', ['name'])
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(['playlist', 'abc'])), ['playlist', 'abc'])
+        with self.assertRaises(ValueError):
+            decode_cursor('not a cursor')
+
+    def test_page_with_next_cursor(self):
+        self.query.stream.return_value = [self.snapshot(f'playlist {i}', f'id{i}') for i in range(3)]
+
+        documents, cursor = list_documents(self.collection, 'name', fields=['type'], limit=2)
+
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(decode_cursor(cursor), ['playlist 1', 'id1'])
+        self.query.select.assert_called_once_with(['type', 'name'])
+        self.query.limit.assert_called_once_with(3)
+
+    def test_last_page(self):
+        self.query.stream.return_value = [self.snapshot('playlist 2', 'id2')]
+
+        documents, cursor = list_documents(self.collection, 'name', limit=2,
+                                           cursor=encode_cursor(['playlist 1', 'id1']))
+
+        self.assertEqual(len(documents), 1)
+        self.assertIsNone(cursor)
+        self.query.start_after.assert_called_once_with({'name': 'playlist 1', '__name__': 'id1'})
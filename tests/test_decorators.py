@@ -1,11 +1,11 @@
 import os
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import flask
 
 from music.music import create_app
-from music.api.decorators import is_logged_in, admin_required, spotify_link_required, lastfm_username_required, check_dict, validate_json
+from music.api.decorators import is_logged_in, admin_required, spotify_link_required, lastfm_username_required, check_dict, validate_json, conditional_etag
 
 class TestDecorators(unittest.TestCase):
 
@@ -189,4 +189,48 @@ class TestDecorators(unittest.TestCase):
                 kwargs={}
             )
 
-            self.assertEqual(resp[1], 400)
\ No newline at end of file
+            self.assertEqual(resp[1], 400)
+
+    ### CONDITIONAL ETAG ###
+
+    @patch('music.api.decorators.get_data_version')
+    def test_conditional_etag_not_modified(self, get_version):
+        get_version.return_value = 3
+        func = Mock(side_effect=lambda **kwargs: (flask.jsonify({'a': 1}), 200))
+        wrapped = conditional_etag(func)
+
+        with self.app.test_request_context('/api/playlists'):
+            etag = wrapped(user=Mock(username='test')).get_etag()[0]
+
+        with self.app.test_request_context('/api/playlists', headers={'If-None-Match': f'"{etag}"'}):
+            resp = wrapped(user=Mock(username='test'))
+
+        self.assertEqual(resp.status_code, 304)
+        func.assert_called_once()
+
+    @patch('music.api.decorators.get_data_version')
+    def test_conditional_etag_changed_version(self, get_version):
+        get_version.return_value = 3
+        func = Mock(side_effect=lambda **kwargs: (flask.jsonify({'a': 1}), 200))
+        wrapped = conditional_etag(func)
+
+        with self.app.test_request_context('/api/playlists'):
+            etag = wrapped(user=Mock(username='test')).get_etag()[0]
+
+        get_version.return_value = 4
+        with self.app.test_request_context('/api/playlists', headers={'If-None-Match': f'"{etag}"'}):
+            resp = wrapped(user=Mock(username='test'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.get_etag()[0], etag)
+        self.assertEqual(func.call_count, 2)
+
+    @patch('music.api.decorators.get_data_version')
+    def test_conditional_etag_ignores_writes(self, get_version):
+        func = Mock(return_value=5)
+        wrapped = conditional_etag(func)
+
+        with self.app.test_request_context('/api/playlist', method='POST'):
+            self.assertEqual(wrapped(user=Mock(username='test')), 5)
+
+        get_version.assert_not_called()
@@ -1,6 +1,11 @@
+import copy
 import unittest
+from unittest.mock import Mock, patch
 
-from music.model.user import User
+import flask
+
+from music.model.playlist import Playlist
+from music.model.user import User, get_user, invalidate_user, user_cache
 
 class TestUser(unittest.TestCase):
 
@@ -56,4 +61,196 @@ class TestUser(unittest.TestCase):
         test_user = User.collection.filter('username', '==', "test").get()
 
         test_playlist = test_user.get_playlist("test_playlist_missing", raise_error=False)
-        self.assertIsNone(test_playlist)
\ No newline at end of file
+        self.assertIsNone(test_playlist)
+
+
+class TestUserCache(unittest.TestCase):
+
+    def setUp(self):
+        user_cache.clear()
+
+        self.app = flask.Flask(__name__)
+        self.user = User()
+        self.user.username = 'test'
+
+        self.collection = Mock()
+        self.collection.filter.return_value.get.return_value = self.user
+
+    def test_one_read_per_request(self):
+        with patch.object(User, 'collection', self.collection), self.app.app_context():
+            first = get_user('Test ')
+            second = get_user('test')
+
+        self.assertIs(first, second)
+        self.collection.filter.assert_called_once_with('username', '==', 'test')
+
+    def test_cached_between_requests(self):
+        with patch.object(User, 'collection', self.collection):
+            with self.app.app_context():
+                first = get_user('test')
+                first.locked = True  # unsaved edit
+            with self.app.app_context():
+                second = get_user('test')
+
+        self.assertIsNot(first, second)
+        self.assertFalse(second.locked)
+        self.collection.filter.assert_called_once()
+
+    def test_invalidated_on_write(self):
+        with patch.object(User, 'collection', self.collection):
+            with self.app.app_context():
+                get_user('test')
+            invalidate_user('test')
+            with self.app.app_context():
+                get_user('test')
+
+        self.assertEqual(self.collection.filter.call_count, 2)
+
+    @patch('music.model.user.bump_data_version')
+    @patch('fireo.models.Model.update')
+    def test_cached_copy_reloaded_before_write(self, model_update, bump):
+        self.user.apns_tokens = ['old']
+        stored = copy.deepcopy(self.user)
+        stored.apns_tokens = ['old', 'new']
+        self.collection.get.return_value = stored
+
+        with patch.object(User, 'collection', self.collection):
+            with self.app.app_context():
+                get_user('test')
+            with self.app.app_context():
+                cached = get_user('test')
+                cached.notify = True
+                cached.update()
+
+        self.assertEqual(cached.apns_tokens, ['old', 'new'])
+        self.assertTrue(cached.notify)
+        self.collection.get.assert_called_once()
+        model_update.assert_called_once()
+
+    @patch('music.model.user.bump_data_version')
+    @patch('fireo.models.Model.update')
+    def test_fresh_user_not_reloaded(self, model_update, bump):
+        with patch.object(User, 'collection', self.collection), self.app.app_context():
+            get_user('test').update()
+
+        self.collection.get.assert_not_called()
+
+
+class TestPlaylistNameLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.user = User()
+        self.user.username = 'test'
+        self.user.playlists_indexed = True
+
+    @staticmethod
+    def playlist_mock(name):
+        playlist = Mock()
+        playlist.name = name
+        playlist.name_lower = name.lower()
+        return playlist
+
+    @patch('music.model.user.Playlist')
+    def test_indexed_lookup(self, playlist_model):
+        query = playlist_model.collection.parent.return_value.filter
+        query.return_value.fetch.return_value = [self.playlist_mock('Test'), self.playlist_mock('test')]
+
+        self.assertEqual(self.user.get_playlist('test').name, 'test')
+        self.assertEqual(self.user.get_playlist('TEST').name, 'Test')
+        query.assert_called_with('name_lower', '==', 'test')
+        playlist_model.collection.parent.return_value.fetch.assert_not_called()
+
+    @patch('music.model.user.Playlist')
+    def test_batch_lookup_chunked(self, playlist_model):
+        names = [f'Playlist {i}' for i in range(45)]
+        query = playlist_model.collection.parent.return_value.filter
+        query.return_value.fetch.side_effect = [[self.playlist_mock(i) for i in names[:30]],
+                                                [self.playlist_mock(i) for i in names[30:44]]]
+
+        found = self.user.get_playlists_by_name(names)
+
+        self.assertEqual(query.call_count, 2)
+        self.assertEqual([i.name for i in found.values() if i is not None], names[:44])
+        self.assertIsNone(found['Playlist 44'])
+
+    @patch.object(User, 'update')
+    @patch('music.model.user.Playlist')
+    def test_unindexed_user_read_only(self, playlist_model, user_update):
+        self.user.playlists_indexed = False
+        legacy = self.playlist_mock('Legacy')
+        legacy.name_lower = None
+        playlist_model.collection.parent.return_value.fetch.return_value = [legacy, self.playlist_mock('Other')]
+
+        self.assertIs(self.user.get_playlist('legacy'), legacy)
+        self.assertEqual(self.user.get_playlists_by_name(['LEGACY', 'missing']), {'LEGACY': legacy, 'missing': None})
+        legacy.update.assert_not_called()
+        self.assertFalse(self.user.playlists_indexed)
+        user_update.assert_not_called()
+
+    @patch('music.model.user.fireo')
+    @patch.object(User, 'update')
+    @patch('music.model.user.Playlist')
+    def test_backfill_batched(self, playlist_model, user_update, fireo):
+        self.user.playlists_indexed = False
+        legacy = self.playlist_mock('Legacy')
+        legacy.name_lower = None
+        playlist_model.collection.parent.return_value.fetch.return_value = [legacy, self.playlist_mock('Indexed')]
+
+        self.assertEqual(self.user.index_playlists(), 1)
+        legacy.update.assert_called_once_with(batch=fireo.batch.return_value)
+        fireo.batch.return_value.commit.assert_called_once()
+        self.assertTrue(self.user.playlists_indexed)
+        user_update.assert_called_once()
+
+
+class TestPlaylistDataVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.playlist = Playlist(parent='users/test')
+        self.playlist.name = 'Test'
+
+    @patch('music.model.playlist.bump_data_version')
+    @patch('fireo.models.Model.update')
+    def test_bumped_on_update(self, model_update, bump):
+        self.playlist.update()
+
+        model_update.assert_called_once()
+        bump.assert_called_once_with(self.playlist.key)
+
+    @patch('music.model.playlist.bump_data_version')
+    @patch('fireo.models.Model.update')
+    def test_not_bumped_in_batch(self, model_update, bump):
+        self.playlist.update(batch=Mock())
+
+        model_update.assert_called_once()
+        bump.assert_not_called()
+
+
+class TestPlaylistReferences(unittest.TestCase):
+
+    def setUp(self):
+        self.playlist = Playlist()
+        self.playlist.name = 'parent'
+        self.playlist.type = 'default'
+        self.playlist.playlist_references = [Mock(id='a'), Mock(id='b'), Mock(id='deleted')]
+
+    @patch('music.model.playlist.db')
+    def test_names_provided(self, database):
+        serialised = self.playlist.to_dict(reference_names={'a': 'child a', 'b': 'child b'})
+
+        self.assertEqual(serialised['playlist_references'], ['child a', 'child b'])
+        database.conn.get_all.assert_not_called()
+
+    @patch('music.model.playlist.db')
+    def test_names_read_in_batch(self, database):
+        snapshots = []
+        for playlist_id, name in [('b', 'child b'), ('a', 'child a')]:
+            snapshot = Mock(id=playlist_id, exists=True)
+            snapshot.get.return_value = name
+            snapshots.append(snapshot)
+        database.conn.get_all.return_value = snapshots + [Mock(id='deleted', exists=False)]
+
+        serialised = self.playlist.to_dict()
+
+        self.assertEqual(serialised['playlist_references'], ['child a', 'child b'])
+        database.conn.get_all.assert_called_once()
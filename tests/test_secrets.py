@@ -0,0 +1,98 @@
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from music.secrets import SecretBackend, SecretCache, LocalBackend, get_secret_id
+
+SECRET_NAME = 'projects/test/secrets/jwt-secret/versions/latest'
+
+
+class CountingBackend(SecretBackend):
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.fail = False
+
+    def access(self, name):
+        self.requests += 1
+        time.sleep(self.latency)
+        if self.fail:
+            raise ConnectionError('backend unavailable')
+        return f'value {self.requests}'
+
+
+class TestSecretCache(unittest.TestCase):
+
+    def test_cached(self):
+        backend = CountingBackend()
+        cache = SecretCache(backend, ttl=60)
+
+        self.assertEqual(cache.get(SECRET_NAME), 'value 1')
+        self.assertEqual(cache.get(SECRET_NAME), 'value 1')
+        self.assertEqual(backend.requests, 1)
+
+    def test_single_flight(self):
+        backend = CountingBackend(latency=0.05)
+        cache = SecretCache(backend, ttl=60)
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            values = list(executor.map(lambda _: cache.get(SECRET_NAME), range(10)))
+
+        self.assertEqual(backend.requests, 1)
+        self.assertEqual(set(values), {'value 1'})
+
+    def test_background_refresh(self):
+        backend = CountingBackend()
+        cache = SecretCache(backend, ttl=0.2, refresh_ahead=0.25)
+
+        cache.get(SECRET_NAME)
+        time.sleep(0.1)
+
+        self.assertEqual(cache.get(SECRET_NAME), 'value 1')  # served while refreshing
+        time.sleep(0.05)
+        self.assertEqual(cache.get(SECRET_NAME), 'value 2')
+
+    def test_stale_served_on_error(self):
+        backend = CountingBackend()
+        cache = SecretCache(backend, ttl=0.05)
+
+        cache.get(SECRET_NAME)
+        time.sleep(0.1)
+        backend.fail = True
+
+        self.assertEqual(cache.get(SECRET_NAME), 'value 1')
+
+    def test_error_without_cached_raises(self):
+        backend = CountingBackend()
+        backend.fail = True
+
+        with self.assertRaises(ConnectionError):
+            SecretCache(backend).get(SECRET_NAME)
+
+
+class TestLocalBackend(unittest.TestCase):
+
+    def test_secret_id(self):
+        self.assertEqual(get_secret_id(SECRET_NAME), 'jwt-secret')
+
+    def test_environment(self):
+        os.environ['MIXONOMER_SECRET_JWT_SECRET'] = 'env value'
+        try:
+            self.assertEqual(LocalBackend().access(SECRET_NAME), 'env value')
+        finally:
+            del os.environ['MIXONOMER_SECRET_JWT_SECRET']
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'jwt-secret'), 'w') as f:
+                f.write('file value\n')
+
+            self.assertEqual(LocalBackend(directory).access(SECRET_NAME), 'file value')
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(KeyError):
+                LocalBackend(directory).access(SECRET_NAME)
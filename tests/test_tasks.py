@@ -1,8 +1,27 @@
+import threading
+import time
+import tracemalloc
 import unittest
-from unittest.mock import Mock
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+from uuid import uuid4
 
-from music.tasks.run_user_playlist import run_user_playlist
-from music.tasks.update_tag import update_tag
+from spotframework.net.network import SpotifyNetworkException
+
+from music.tasks.run_user_playlist import run_user_playlist, run_user_playlist_for_job, load_playlist_tracks, \
+    execute_playlist, get_source_fingerprint, write_playlist_tracks, written_track_cache, sort_tracks
+from music.tasks.update_tag import update_tag, update_user_tags, aggregate_tag, EntryResult, tag_entity_cache
+from music.tasks.playlist_diff import plan_playlist_diff
+from music.tasks.playlist_index import invalidate_playlist_index
+from music.tasks.pipeline import remove_local, added_after, deduplicate_by_name, sort_by_release_date
+from music.tasks.track_record import TrackRecord
+from music.tasks.run_playlists import run_in_dependency_order, run_job
+from music.rate_limit import RateLimiter
+from music.db.run_job import is_finished, get_run_job, get_ready_playlists, claim_ready_playlists, \
+    QUEUED, RUNNING, SUCCEEDED, FAILED, SKIPPED
+from music.cloud import start_run_job, run_job_playlist
+from music.cloud.tasks import update_all_user_tags
 
 class TestRunPlaylist(unittest.TestCase):
     
@@ -22,8 +41,574 @@ class TestRunPlaylist(unittest.TestCase):
         with self.assertRaises(NameError):
             run_user_playlist(user='test', playlist='test_uri')
 
+class FakeSpotifyNetwork:
+    """Stand-in spotframework network returning one track per part after a fixed latency"""
+
+    def __init__(self, part_names, latency=0.05, snapshot_id=None, tracks_per_part=1):
+        self.latency = latency
+        self.tracks_per_part = tracks_per_part
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.track_requests = 0
+        self.playlist_requests = 0
+        self.user_playlists = []
+        for name in part_names:
+            user_playlist = Mock()
+            user_playlist.name = name
+            user_playlist.uri = f'uri_{name}'
+            user_playlist.snapshot_id = snapshot_id
+            user_playlist.owner.display_name = 'test_user'
+            self.user_playlists.append(user_playlist)
+
+    def playlists(self):
+        self.playlist_requests += 1
+        return self.user_playlists
+
+    def get_request(self, url, params=None):
+        return {'total': len(self.user_playlists)}
+
+    def playlist_tracks(self, uri, reduced_mem=False):
+        with self.lock:
+            self.track_requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+        return [SimpleNamespace(track=SimpleNamespace(uri=f'spotify:track:{uri}', name=uri if i == 0 else f'{uri} {i}',
+                                                      artists=[]),
+                                added_at=None, is_local=False)
+                for i in range(self.tracks_per_part)]
+
+    def saved_tracks(self):
+        return []
+
+
+class TestLoadPlaylistTracks(unittest.TestCase):
+
+    def setUp(self):
+        self.part_names = [f'part_{i}' for i in range(20)]
+
+        self.playlist = Mock()
+        self.playlist.name = 'test_playlist'
+        self.playlist.add_last_month = False
+        self.playlist.add_this_month = False
+        self.playlist.include_library_tracks = False
+        self.playlist.include_spotify_owned = True
+
+        invalidate_playlist_index('test')
+
+    def test_order_stable(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0.01)
+
+        tracks = load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test', max_workers=8)
+
+        self.assertEqual([i.name for i in tracks], [f'uri_{i}' for i in self.part_names])
+
+    def test_fetch_concurrency_bounded(self):
+        sequential = FakeSpotifyNetwork(self.part_names, latency=0.01)
+        list(load_playlist_tracks(sequential, self.playlist, list(self.part_names), 'test', max_workers=1))
+
+        concurrent = FakeSpotifyNetwork(self.part_names, latency=0.01)
+        list(load_playlist_tracks(concurrent, self.playlist, list(self.part_names), 'test', max_workers=8))
+
+        self.assertEqual(sequential.peak_in_flight, 1)
+        self.assertGreater(concurrent.peak_in_flight, 1)
+        self.assertLessEqual(concurrent.peak_in_flight, 8)
+
+    def test_unchanged_snapshot_served_from_cache(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0, snapshot_id=str(uuid4()))
+
+        first = list(load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test'))
+        second = list(load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test'))
+
+        self.assertEqual(spotnet.track_requests, len(self.part_names))
+        self.assertEqual([i.name for i in first], [i.name for i in second])
+
+    def test_failed_parts_reported(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0)
+        fetch = spotnet.playlist_tracks
+
+        def playlist_tracks(uri, reduced_mem=False):
+            if uri == 'uri_part_3':
+                raise SpotifyNetworkException()
+            return fetch(uri, reduced_mem)
+
+        spotnet.playlist_tracks = playlist_tracks
+
+        self.playlist.include_library_tracks = True
+        failures = []
+        tracks = list(load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test', failures=failures))
+
+        self.assertEqual(len(tracks), len(self.part_names) - 1)
+        self.assertEqual(set(failures), {'part_3', 'library'})
+
+    def test_changed_snapshot_refetched(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0, snapshot_id=str(uuid4()))
+        list(load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test'))
+
+        for user_playlist in spotnet.user_playlists:
+            user_playlist.snapshot_id = str(uuid4())
+        invalidate_playlist_index('test')  # relisted after index expiry
+        list(load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test'))
+
+        self.assertEqual(spotnet.track_requests, 2 * len(self.part_names))
+
+    def test_playlists_listed_once(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0)
+
+        for _ in range(3):
+            load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test')
+
+        self.assertEqual(spotnet.playlist_requests, 1)
+
+    def test_playlist_total_change_relists(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0)
+        load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test')
+
+        spotnet.user_playlists.pop()
+        tracks = load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test')
+
+        self.assertEqual(spotnet.playlist_requests, 2)
+        self.assertEqual(len(list(tracks)), len(self.part_names) - 1)
+
+    def test_parts_fetched_as_consumed(self):
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0)
+
+        tracks = load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test', max_workers=2)
+        self.assertEqual(spotnet.track_requests, 0)
+
+        next(tracks)
+        self.assertLessEqual(spotnet.track_requests, 3)  # one fetch per worker plus one queued
+
+    @staticmethod
+    def peak_memory(consume):
+        tracemalloc.start()
+        consume()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    def test_streaming_memory_with_cache(self):
+        # cached parts and the sorted list hold every track either way, streaming only drops the concatenated copy
+        spotnet = FakeSpotifyNetwork(self.part_names, latency=0, tracks_per_part=1000, snapshot_id=str(uuid4()))
+        self.playlist.shuffle = False
+        self.playlist.type = 'default'
+
+        def load():
+            return load_playlist_tracks(spotnet, self.playlist, list(self.part_names), 'test', max_workers=2)
+
+        list(load())  # warm the cache as a refresh would
+
+        eager_peak = self.peak_memory(lambda: sort_tracks(self.playlist, list(load())))
+        streaming_peak = self.peak_memory(lambda: sort_tracks(self.playlist, load()))
+
+        self.assertEqual(spotnet.track_requests, len(self.part_names))
+        self.assertEqual(len(sort_tracks(self.playlist, load())), len(self.part_names) * 1000)
+        self.assertLess(streaming_peak, eager_peak * 1.1)
+
+
+class TestSourceFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.part_names = ['part_1', 'part_2']
+        self.spotnet = FakeSpotifyNetwork(self.part_names, snapshot_id='snapshot')
+        self.user_playlists = {i.name: i for i in self.spotnet.user_playlists}
+
+        self.playlist = Mock()
+        self.playlist.type = 'default'
+        self.playlist.shuffle = False
+        self.playlist.include_recommendations = False
+        self.playlist.include_library_tracks = False
+
+    def fingerprint(self):
+        return get_source_fingerprint(self.spotnet, self.playlist, self.part_names, self.user_playlists, 'test')
+
+    def test_stable(self):
+        self.assertIsNotNone(self.fingerprint())
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_snapshot_change(self):
+        before = self.fingerprint()
+        self.spotnet.user_playlists[0].snapshot_id = 'new snapshot'
+
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_config_change(self):
+        before = self.fingerprint()
+        self.playlist.day_boundary = 5
+
+        self.assertNotEqual(before, self.fingerprint())
+
+    def test_random_output_not_fingerprinted(self):
+        self.playlist.shuffle = True
+
+        self.assertIsNone(self.fingerprint())
+
+
+@patch('music.tasks.run_user_playlist.get_description', Mock(return_value='description'))
+@patch('music.tasks.run_user_playlist.write_playlist_tracks')
+class TestOutputFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.playlist = Mock()
+        self.playlist.name = 'test_playlist'
+        self.playlist.uri = 'spotify:playlist:output'
+        self.playlist.output_fingerprint = None
+        self.tracks = [TrackRecord('spotify:track:a', 'a', ('artist',))]
+
+        self.spotnet = Mock()
+        self.spotnet.get_request.return_value = {'snapshot_id': 'written'}
+
+    def execute(self, snapshot_id):
+        return execute_playlist(self.spotnet, self.playlist, [], 'test', self.tracks, snapshot_id=snapshot_id)
+
+    def test_unchanged_output_skipped(self, write_tracks):
+        self.assertTrue(self.execute(None))
+        self.assertTrue(self.execute('written'))
+
+        write_tracks.assert_called_once()
+
+    def test_edited_in_spotify_rewritten(self, write_tracks):
+        self.execute(None)
+        self.assertTrue(self.execute('edited'))
+
+        self.assertEqual(write_tracks.call_count, 2)
+
+    def test_unknown_snapshot_not_skipped(self, write_tracks):
+        self.spotnet.get_request.return_value = None
+        self.execute(None)
+
+        self.assertIsNone(self.playlist.output_fingerprint)
+        self.execute(None)
+        self.assertEqual(write_tracks.call_count, 2)
+
+
+class TestWritePlaylistTracks(unittest.TestCase):
+
+    def setUp(self):
+        written_track_cache.clear()
+
+        self.playlist = Mock()
+        self.playlist.name = 'test_playlist'
+        self.playlist.uri = 'spotify:playlist:output'
+        self.playlist.shuffle = False
+
+        self.written = [f'spotify:track:{i}' for i in range(300)]
+        self.target = self.written[1:] + ['spotify:track:new']
+        written_track_cache.set(('test', self.playlist.uri, 'written'), self.written)
+
+        self.spotnet = Mock()
+
+    def test_diffed_against_cached_write(self):
+        write_playlist_tracks(self.spotnet, self.playlist, 'test', self.target, snapshot_id='written')
+
+        self.spotnet.playlist_tracks.assert_not_called()
+        self.spotnet.replace_playlist_tracks.assert_not_called()
+        self.spotnet.remove_playlist_tracks.assert_called_once()
+        self.spotnet.add_playlist_tracks.assert_called_once()
+
+    def test_edited_playlist_replaced(self):
+        write_playlist_tracks(self.spotnet, self.playlist, 'test', self.target, snapshot_id='edited')
+
+        self.spotnet.playlist_tracks.assert_not_called()
+        self.spotnet.replace_playlist_tracks.assert_called_once()
+
+    def test_shuffled_replaced(self):
+        self.playlist.shuffle = True
+
+        write_playlist_tracks(self.spotnet, self.playlist, 'test', self.target, snapshot_id='written')
+
+        self.spotnet.playlist_tracks.assert_not_called()
+        self.spotnet.replace_playlist_tracks.assert_called_once()
+
+
+class TestPlaylistDiff(unittest.TestCase):
+
+    @staticmethod
+    def apply(current, operations):
+        working = list(current)
+        for operation in operations:
+            if operation[0] == 'remove':
+                working = [i for i in working if i not in operation[1]]
+            elif operation[0] == 'add':
+                working += operation[1]
+            else:
+                _, start, length, insert_before = operation
+                working = working[:insert_before] + working[start:start + length] \
+                    + working[insert_before:start] + working[start + length:]
+        return working
+
+    def test_unchanged(self):
+        current = [f'track_{i}' for i in range(500)]
+
+        self.assertEqual(plan_playlist_diff(current, list(current)), [])
+
+    def test_new_releases_and_expired(self):
+        current = [f'track_{i}' for i in range(5000)]
+        target = [f'new_{i}' for i in range(30)] + current[:-40]
+
+        operations = plan_playlist_diff(current, target)
+
+        self.assertEqual(len(operations), 3)
+        self.assertEqual(self.apply(current, operations), target)
+
+    def test_reordered(self):
+        current = [f'track_{i}' for i in range(1000)]
+        target = current[500:] + current[:500]
+
+        operations = plan_playlist_diff(current, target)
+
+        self.assertEqual(self.apply(current, operations), target)
+
+    def test_replace_cheaper(self):
+        current = [f'track_{i}' for i in range(50)]
+        target = [f'new_{i}' for i in range(50)]
+
+        self.assertIsNone(plan_playlist_diff(current, target))
+
+    def test_duplicates_replaced(self):
+        self.assertIsNone(plan_playlist_diff(['a', 'a', 'b'], ['a', 'b']))
+
+
+def pipeline_track(name, artist, added_at, is_local=False):
+    return TrackRecord(uri=f'spotify:track:{name}', name=name, artists=(artist,), added_at=added_at, is_local=is_local)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        now = datetime.now(timezone.utc)
+        self.boundary = now - timedelta(days=10)
+
+    def test_filters(self):
+        tracks = [pipeline_track('a', 'artist', self.boundary + timedelta(days=1)),
+                  pipeline_track('A', 'ARTIST', self.boundary + timedelta(days=1)),
+                  pipeline_track('b', 'artist', self.boundary - timedelta(days=1)),
+                  pipeline_track('c', 'artist', self.boundary + timedelta(days=1), is_local=True)]
+
+        self.assertEqual([i.name for i in deduplicate_by_name(added_after(remove_local(tracks), self.boundary))], ['a'])
+
+    def test_record_from_spotframework(self):
+        item = SimpleNamespace(track=SimpleNamespace(uri='spotify:track:abc', name='name', track_number=3,
+                                                     artists=[SimpleNamespace(name='artist')],
+                                                     album=SimpleNamespace(name='album', release_date='2020-01-01')),
+                               added_at=self.boundary, is_local=False)
+
+        record = TrackRecord.from_spotframework(item)
+
+        self.assertEqual(record, TrackRecord('spotify:track:abc', 'name', ('artist',), 'album', '2020-01-01', 3,
+                                             self.boundary))
+        self.assertEqual(record.object_type, 'track')
+        self.assertEqual(record.object_id, 'abc')
+        self.assertIsNone(TrackRecord.from_spotframework(SimpleNamespace(track=None, added_at=None)))
+
+    def test_sort_by_release_date(self):
+        tracks = [TrackRecord('spotify:track:1', 'old 2', ('artist',), 'old', '2019-01-01', 2),
+                  TrackRecord('spotify:track:2', 'new', ('artist',), 'new', '2021-05-01', 1),
+                  TrackRecord('spotify:track:3', 'old 1', ('artist',), 'old', '2019-01-01', 1)]
+
+        self.assertEqual([i.name for i in sort_by_release_date(tracks, reverse=True)], ['new', 'old 1', 'old 2'])
+
+
+class TestDependencyOrder(unittest.TestCase):
+
+    def test_sources_run_first(self):
+        references = {'parent': ['child 1', 'child 2'], 'child 1': ['grandchild'], 'child 2': [], 'grandchild': []}
+        finished = []
+
+        def run(node):
+            time.sleep(0.01)
+            finished.append(node)
+
+        run_in_dependency_order(references, run=run, max_workers=4)
+
+        self.assertEqual(len(finished), 4)
+        self.assertLess(finished.index('grandchild'), finished.index('child 1'))
+        self.assertLess(finished.index('child 1'), finished.index('parent'))
+        self.assertLess(finished.index('child 2'), finished.index('parent'))
+
+    def test_independent_run_concurrently(self):
+        references = {f'playlist {i}': [] for i in range(8)}
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'peak': 0}
+
+        def run(node):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['peak'] = max(in_flight['peak'], in_flight['now'])
+            time.sleep(0.02)
+            with lock:
+                in_flight['now'] -= 1
+
+        run_in_dependency_order(references, run=run, max_workers=4)
+
+        self.assertGreater(in_flight['peak'], 1)
+        self.assertLessEqual(in_flight['peak'], 4)
+
+    def test_cycle_still_runs(self):
+        finished = []
+
+        run_in_dependency_order({'a': ['b'], 'b': ['a'], 'c': []}, run=finished.append, max_workers=2)
+
+        self.assertEqual(sorted(finished), ['a', 'b', 'c'])
+
+
+class TestRunJob(unittest.TestCase):
+
+    def setUp(self):
+        self.user = SimpleNamespace(username='test', key='spotify_users/test')
+        self.playlist = SimpleNamespace(id='playlist', name='playlist')
+
+    def statuses(self, run):
+        with patch('music.tasks.run_user_playlist.set_run_job_status') as set_status, \
+                patch('music.tasks.run_user_playlist.run_user_playlist', side_effect=run):
+            try:
+                run_user_playlist_for_job(self.user, self.playlist, job_id='job')
+            except AttributeError:
+                pass
+
+        return [i.args[3] for i in set_status.call_args_list]
+
+    def test_success_reported(self):
+        self.assertEqual(self.statuses(run=None), [RUNNING, SUCCEEDED])
+
+    def test_failure_reported(self):
+        self.assertEqual(self.statuses(run=AttributeError('no uri')), [RUNNING, FAILED])
+
+    def test_no_job_not_reported(self):
+        with patch('music.tasks.run_user_playlist.set_run_job_status') as set_status, \
+                patch('music.tasks.run_user_playlist.run_user_playlist') as run:
+            run_user_playlist_for_job(self.user, self.playlist)
+
+        run.assert_called_once()
+        set_status.assert_not_called()
+
+    def test_finished(self):
+        now = datetime.utcnow()
+        self.assertTrue(is_finished(SimpleNamespace(playlists={'a': {'status': SUCCEEDED}, 'b': {'status': FAILED}},
+                                                    last_updated=now)))
+        self.assertFalse(is_finished(SimpleNamespace(playlists={'a': {'status': SUCCEEDED}, 'b': {'status': RUNNING}},
+                                                     last_updated=now)))
+
+    def test_stale_job_failed(self):
+        job = SimpleNamespace(playlists={'a': {'status': SUCCEEDED}, 'b': {'status': RUNNING}, 'c': {'status': QUEUED}},
+                              last_updated=datetime.now(timezone.utc) - timedelta(hours=1))
+
+        with patch('music.db.run_job.RunJob') as run_job_model, \
+                patch('music.db.run_job.fail_run_job') as fail_run_job:
+            run_job_model.collection.get.return_value = job
+
+            self.assertTrue(is_finished(job))
+            self.assertIs(get_run_job(self.user, 'job'), job)
+
+        fail_run_job.assert_called_once_with(self.user, 'job', ['b', 'c'])
+        self.assertEqual([i['status'] for i in job.playlists.values()], [SUCCEEDED, FAILED, FAILED])
+
+    def test_progressing_job_not_failed(self):
+        job = SimpleNamespace(playlists={'a': {'status': RUNNING}}, last_updated=datetime.now(timezone.utc))
+
+        with patch('music.db.run_job.RunJob') as run_job_model, \
+                patch('music.db.run_job.fail_run_job') as fail_run_job:
+            run_job_model.collection.get.return_value = job
+
+            self.assertFalse(is_finished(get_run_job(self.user, 'job')))
+
+        fail_run_job.assert_not_called()
+
+    def test_missing_playlists_failed(self):
+        job = SimpleNamespace(playlists={'present': {'name': 'present', 'status': QUEUED},
+                                         'deleted': {'name': 'deleted', 'status': QUEUED},
+                                         'done': {'name': 'done', 'status': SUCCEEDED}})
+        present = SimpleNamespace(id='present', name='present', playlist_references=[])
+
+        with patch('music.tasks.run_playlists.User') as user_model, \
+                patch('music.tasks.run_playlists.Playlist') as playlist_model, \
+                patch('music.tasks.run_playlists.get_run_job', return_value=job), \
+                patch('music.tasks.run_playlists.fail_run_job') as fail_run_job, \
+                patch('music.tasks.run_playlists.run_playlists') as run_playlists:
+            user = user_model.collection.filter.return_value.get.return_value
+            playlist_model.collection.parent.return_value.fetch.return_value = [present]
+
+            run_job('test', 'job')
+
+        fail_run_job.assert_called_once_with(user, 'job', {'deleted'})
+        self.assertEqual(list(run_playlists.call_args.args[1]), ['present'])
+
+    def test_start_failure_fails_job(self):
+        user = SimpleNamespace(username='test')
+        job = SimpleNamespace(id='job', playlists={'a': {'name': 'a', 'status': QUEUED},
+                                                   'b': {'name': 'b', 'status': SKIPPED}})
+
+        with patch('music.cloud.fireo'), \
+                patch('music.cloud.claim_ready_playlists', side_effect=RuntimeError('unavailable')), \
+                patch('music.cloud.fail_run_job') as fail_run_job:
+            with self.assertRaises(RuntimeError):
+                start_run_job(user, job)
+
+        fail_run_job.assert_called_once_with(user, 'job', ['a'])
+
+    @staticmethod
+    def job(statuses, references):
+        return SimpleNamespace(id='job', playlists={i: {'name': i, 'status': status} for i, status in statuses.items()},
+                               references=references)
+
+    def test_ready_after_references(self):
+        job = self.job({'parent': QUEUED, 'child': QUEUED, 'other': QUEUED},
+                       {'parent': ['child'], 'child': [], 'other': []})
+        self.assertEqual(get_ready_playlists(job), ['child', 'other'])
+
+        job.playlists['child']['status'] = FAILED
+        job.playlists['other']['status'] = RUNNING
+        self.assertEqual(get_ready_playlists(job), ['parent'])
+
+    def test_cycle_run_once_idle(self):
+        job = self.job({'a': QUEUED, 'b': QUEUED, 'c': RUNNING}, {'a': ['b'], 'b': ['a'], 'c': []})
+        self.assertEqual(get_ready_playlists(job), [])
+
+        job.playlists['c']['status'] = SUCCEEDED
+        self.assertEqual(get_ready_playlists(job), ['a', 'b'])
+
+    def test_claim_marks_running(self):
+        job = self.job({'parent': QUEUED, 'child': RUNNING}, {'parent': ['child'], 'child': []})
+        job.update = Mock()
+
+        with patch('music.db.run_job.RunJob') as run_job_model:
+            run_job_model.collection.get.return_value = job
+
+            ready = claim_ready_playlists.to_wrap('transaction', self.user, 'job', finished_id='child', status=FAILED)
+
+        self.assertEqual(ready, ['parent'])
+        self.assertEqual(job.playlists, {'parent': {'name': 'parent', 'status': RUNNING},
+                                         'child': {'name': 'child', 'status': FAILED}})
+        job.update.assert_called_once_with(transaction='transaction')
+
+    def test_finished_run_queues_dependents(self):
+        with patch('music.cloud.User') as user_model, \
+                patch('music.cloud.Playlist') as playlist_model, \
+                patch('music.cloud.Config') as config, \
+                patch('music.cloud.fireo'), \
+                patch('music.cloud.run_now', side_effect=RuntimeError('unavailable')), \
+                patch('music.cloud.claim_ready_playlists', side_effect=[['parent', 'other'], ['grandparent']]) as claim, \
+                patch('music.cloud.run_job_playlist_task', side_effect=[RuntimeError('unavailable'), None, None]) as task:
+            user = user_model.collection.filter.return_value.get.return_value
+            user.username = 'test'
+            config.collection.get.return_value = SimpleNamespace(playlist_cloud_operating_mode='task')
+
+            run_job_playlist('test', 'job', 'child')
+
+        playlist_model.collection.get.assert_called_once_with(f'{user.key}/playlists/child')
+        self.assertEqual([i.args[2:] + (i.kwargs['finished_id'], i.kwargs['status']) for i in claim.call_args_list],
+                         [('job', 'child', FAILED), ('job', 'parent', FAILED)])
+        self.assertEqual([i.kwargs['playlist_id'] for i in task.call_args_list], ['parent', 'other', 'grandparent'])
+
+
 class TestRunTag(unittest.TestCase):
-    
+
+    def setUp(self):
+        tag_entity_cache.clear()
+
     def test_run_unknown_name(self):
         with self.assertRaises(NameError):
             update_tag(user='unknown_name', tag='test_tag')
@@ -152,4 +737,322 @@ class TestRunTag(unittest.TestCase):
         self.assertEqual(tag_mock.count, 30)
         self.assertEqual(tag_mock.proportion, 300)
         self.assertEqual(len(tag_mock.tracks), 3)
-        self.assertEqual(dict_mock['count'], 10)
\ No newline at end of file
+        self.assertEqual(dict_mock['count'], 10)
+
+    def test_mocked_concurrent_lookups(self):
+        fmnet = Mock()
+        fmnet.user_scrobble_count.return_value = 100
+
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'peak': 0}
+
+        def artist(name):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['peak'] = max(in_flight['peak'], in_flight['now'])
+            time.sleep(0.02)
+            with lock:
+                in_flight['now'] -= 1
+            return Mock(user_scrobbles=int(name))
+
+        fmnet.artist.side_effect = artist
+
+        user_mock = Mock()
+        user_mock.lastfm_username = 'test_username'
+        user_mock.notify = False
+        user_mock.notify_tag_updates = False
+
+        tag_mock = Mock()
+        tag_mock.time_objects = False
+        tag_mock.artists = [{'name': str(i)} for i in range(8)]
+        tag_mock.albums = []
+        tag_mock.tracks = []
+
+        with patch('music.tasks.update_tag.lastfm_limiter', RateLimiter(rate=0)):
+            update_tag(user=user_mock, tag=tag_mock, spotnet=Mock(), fmnet=fmnet)
+
+        self.assertGreater(in_flight['peak'], 1)
+        self.assertEqual(fmnet.artist.call_count, 8)
+        self.assertEqual([i['count'] for i in tag_mock.artists], list(range(8)))
+        self.assertEqual(tag_mock.count, 28)
+
+
+class TestIncrementalTag(unittest.TestCase):
+
+    @staticmethod
+    def scrobble(name, artist, album):
+        track = SimpleNamespace(name=name, artist=SimpleNamespace(name=artist), album=SimpleNamespace(name=album))
+        return SimpleNamespace(track=track, time=None)
+
+    def setUp(self):
+        tag_entity_cache.clear()
+        self.now = datetime.now(timezone.utc)
+
+        self.tag = Mock()
+        self.tag.time_objects = False
+        self.tag.last_updated = self.now - timedelta(hours=1)
+        self.tag.last_full_refresh = self.now - timedelta(hours=1)
+        self.tag.artists = [{'name': 'Artist', 'count': 10}]
+        self.tag.albums = [{'name': 'Album', 'artist': 'Other', 'count': 5}]
+        self.tag.tracks = [{'name': 'Track', 'artist': 'Other', 'album': 'Album', 'count': 2},
+                           {'name': 'Single', 'artist': 'Other', 'count': 1}]
+
+        self.user = Mock()
+        self.user.lastfm_username = 'test_username'
+        self.user.notify = False
+        self.user.notify_tag_updates = False
+
+        self.fmnet = Mock()
+        self.fmnet.user_scrobble_count.return_value = 100
+        self.fmnet.recent_tracks.return_value = [self.scrobble('Song', 'ARTIST', 'Whatever'),
+                                                 self.scrobble('track', 'other', 'album'),
+                                                 self.scrobble('Single', 'Other', 'Single'),
+                                                 self.scrobble('Unrelated', 'Someone', 'Else')]
+
+    def test_new_scrobbles_added(self):
+        update_tag(user=self.user, tag=self.tag, fmnet=self.fmnet)
+
+        self.fmnet.artist.assert_not_called()
+        self.fmnet.album.assert_not_called()
+        self.fmnet.track.assert_not_called()
+        self.assertEqual(self.fmnet.recent_tracks.call_args.kwargs['from_time'], self.now - timedelta(hours=1))
+
+        self.assertEqual(self.tag.artists[0]['count'], 11)
+        self.assertEqual(self.tag.albums[0]['count'], 6)
+        self.assertEqual([i['count'] for i in self.tag.tracks], [3, 2])
+        self.assertEqual(self.tag.count, 11 + 6 + 2)  # track on the counted album isn't added again
+
+    def test_full_refresh_when_due(self):
+        self.tag.last_full_refresh = self.now - timedelta(days=2)
+        for method in ['artist', 'album', 'track']:
+            getattr(self.fmnet, method).return_value = Mock(user_scrobbles=1, album=None)
+
+        update_tag(user=self.user, tag=self.tag, fmnet=self.fmnet)
+
+        self.fmnet.recent_tracks.assert_not_called()
+        self.assertEqual(self.fmnet.artist.call_count, 1)
+        self.assertEqual(self.tag.artists[0]['count'], 1)
+
+    def test_full_refresh_for_new_entries(self):
+        self.tag.artists.append({'name': 'New'})
+        for method in ['artist', 'album', 'track']:
+            getattr(self.fmnet, method).return_value = Mock(user_scrobbles=1, album=None)
+
+        update_tag(user=self.user, tag=self.tag, fmnet=self.fmnet)
+
+        self.fmnet.recent_tracks.assert_not_called()
+        self.assertEqual(self.fmnet.artist.call_count, 2)
+
+    def test_full_refresh_for_unreadable_scrobbles(self):
+        self.fmnet.recent_tracks.return_value = [SimpleNamespace(name='Track', artist=None)]
+        for method in ['artist', 'album', 'track']:
+            getattr(self.fmnet, method).return_value = Mock(user_scrobbles=1, album=None)
+
+        update_tag(user=self.user, tag=self.tag, fmnet=self.fmnet)
+
+        self.fmnet.recent_tracks.assert_called_once()
+        self.assertEqual(self.fmnet.artist.call_count, 1)
+        self.assertEqual(self.tag.artists[0]['count'], 1)
+
+
+class TestTagEntityCache(unittest.TestCase):
+
+    def setUp(self):
+        tag_entity_cache.clear()
+
+        self.user = Mock()
+        self.user.lastfm_username = 'test_username'
+        self.user.notify = False
+        self.user.notify_tag_updates = False
+
+        self.fmnet = Mock()
+        self.fmnet.user_scrobble_count.return_value = 100
+        self.fmnet.artist.return_value = Mock(user_scrobbles=10)
+
+    def tag(self, *artists):
+        tag = Mock()
+        tag.time_objects = False
+        tag.artists = [{'name': i} for i in artists]
+        tag.albums = []
+        tag.tracks = []
+        return tag
+
+    def test_shared_between_tags(self):
+        first, second = self.tag('Shared', 'First'), self.tag('shared', 'Second', 'SHARED')
+
+        update_tag(user=self.user, tag=first, fmnet=self.fmnet)
+        update_tag(user=self.user, tag=second, fmnet=self.fmnet)
+
+        self.assertEqual(self.fmnet.artist.call_count, 3)
+        self.assertEqual([i['count'] for i in second.artists], [10, 10, 10])
+
+    def test_forced_refresh_skips_cache(self):
+        update_tag(user=self.user, tag=self.tag('Artist'), fmnet=self.fmnet)
+        update_tag(user=self.user, tag=self.tag('Artist'), fmnet=self.fmnet, full=True)
+
+        self.assertEqual(self.fmnet.artist.call_count, 2)
+
+
+class TestUserTags(unittest.TestCase):
+
+    def setUp(self):
+        tag_entity_cache.clear()
+
+        self.user = Mock()
+        self.user.username = 'test'
+        self.user.key = 'spotify_users/test'
+        self.user.lastfm_username = 'test_username'
+        self.user.notify_tag_updates = False
+
+        self.fmnet = Mock()
+        self.fmnet.user_scrobble_count.return_value = 100
+        self.fmnet.artist.return_value = Mock(user_scrobbles=10)
+
+    @staticmethod
+    def tag(tag_id, *artists):
+        tag = Mock()
+        tag.tag_id = tag_id
+        tag.time_objects = False
+        tag.artists = [{'name': i} for i in artists]
+        tag.albums = []
+        tag.tracks = []
+        return tag
+
+    def test_tags_written_together(self):
+        tags = [self.tag('first', 'Shared'), self.tag('second', 'Shared', 'Other')]
+        broken = self.tag('broken')
+        broken.artists = None
+
+        with patch('music.tasks.update_tag.Tag') as tag_model, \
+                patch('music.tasks.update_tag.fireo') as fireo, \
+                patch('music.tasks.update_tag.bump_data_version') as bump:
+            tag_model.collection.parent.return_value.fetch.return_value = tags + [broken]
+
+            update_user_tags(user=self.user, fmnet=self.fmnet)
+
+        self.fmnet.user_scrobble_count.assert_called_once()
+        self.assertEqual(self.fmnet.artist.call_count, 2)
+
+        batch = fireo.batch.return_value
+        for tag in tags:
+            tag.update.assert_called_once_with(batch=batch)
+        broken.update.assert_not_called()
+        batch.commit.assert_called_once()
+        bump.assert_called_once_with(self.user.key)
+
+        self.assertEqual([i.count for i in tags], [10, 20])
+        self.assertEqual(tags[1].proportion, 20)
+
+    def test_nothing_updated_not_bumped(self):
+        broken = self.tag('broken')
+        broken.artists = None
+
+        with patch('music.tasks.update_tag.Tag') as tag_model, \
+                patch('music.tasks.update_tag.fireo'), \
+                patch('music.tasks.update_tag.bump_data_version') as bump:
+            tag_model.collection.parent.return_value.fetch.return_value = [broken]
+
+            update_user_tags(user=self.user, fmnet=self.fmnet)
+
+        bump.assert_not_called()
+
+    @patch('music.cloud.tasks.tasker')
+    @patch('music.cloud.tasks.Tag')
+    @patch('music.cloud.tasks.User')
+    def test_users_without_tags_skipped(self, user_model, tag_model, tasker):
+        users = [Mock(username='tagged', key='spotify_users/tagged', lastfm_username='tagged', locked=False),
+                 Mock(username='untagged', key='spotify_users/untagged', lastfm_username='untagged', locked=False),
+                 Mock(username='no_lastfm', key='spotify_users/no_lastfm', lastfm_username=None, locked=False)]
+        user_model.collection.fetch.return_value = users
+        tag_model.collection.parent.side_effect = \
+            lambda key: Mock(fetch=Mock(return_value=[Mock()] if key == 'spotify_users/tagged' else []))
+
+        update_all_user_tags()
+
+        tasker.create_task.assert_called_once()
+        self.assertEqual(tasker.create_task.call_args.kwargs['task']['app_engine_http_request']['body'],
+                         b'{"username": "tagged"}')
+
+
+class TestTagAggregation(unittest.TestCase):
+
+    def test_overlap_not_double_counted(self):
+        tag = SimpleNamespace(artists=[{'name': 'Artist'}, {'name': 'Failed'}],
+                              albums=[{'name': 'Album', 'artist': 'ARTIST'},
+                                      {'name': 'Album', 'artist': 'Other'},
+                                      {'name': 'Album', 'artist': 'Failed'}],
+                              tracks=[{'name': 'Track', 'artist': 'artist'},
+                                      {'name': 'Track', 'artist': 'other'},
+                                      {'name': 'Track', 'artist': 'other'}])
+        results = {'artist': [EntryResult(100), None],
+                   'album': [EntryResult(50), EntryResult(20), EntryResult(5)],
+                   'track': [EntryResult(10), EntryResult(8, album='ALBUM'), EntryResult(3, album='Single')]}
+
+        aggregate_tag(tag, results)
+
+        self.assertEqual(tag.count, 100 + 20 + 5 + 3)
+        self.assertEqual([i.get('count') for i in tag.artists], [100, None])
+        self.assertEqual([i['count'] for i in tag.tracks], [10, 8, 3])
+
+    def test_large_tag_matches_list_membership(self):
+        artists = [{'name': f'Artist {i}'} for i in range(1000)]
+        albums = [{'name': f'Album {i}', 'artist': f'artist {i % 2000}'} for i in range(2000)]
+        tracks = [{'name': f'Track {i}', 'artist': f'ARTIST {i % 3000}'} for i in range(2000)]
+        results = {'artist': [EntryResult(1)] * len(artists),
+                   'album': [EntryResult(1)] * len(albums),
+                   'track': [EntryResult(1)] * len(tracks)}
+
+        # previous approach, artist names compared case-insensitively for every album and track
+        artist_names = [i['name'].lower() for i in artists]
+        expected = len(artists) + sum(1 for i in albums + tracks if i['artist'].lower() not in artist_names)
+
+        tag = SimpleNamespace(artists=artists, albums=albums, tracks=tracks)
+        aggregate_tag(tag, results)
+
+        self.assertEqual(tag.count, expected)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0  # rates below are powers of two so the fake clock stays exact
+        self.sleeps = []
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        patcher = patch('music.rate_limit.time', SimpleNamespace(monotonic=lambda: self.now, sleep=sleep))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_limited(self):
+        limiter = RateLimiter(rate=16, burst=2)
+
+        for _ in range(2):
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(sum(self.sleeps), 3 / 16)
+        self.assertEqual(limiter.tokens, 0)
+
+    def test_refilled_while_idle(self):
+        limiter = RateLimiter(rate=16, burst=2)
+
+        for _ in range(2):
+            limiter.acquire()
+        self.now += 1  # idle refills no more than the burst
+
+        for _ in range(3):
+            limiter.acquire()
+        self.assertEqual(sum(self.sleeps), 1 / 16)
+
+    def test_unlimited(self):
+        limiter = RateLimiter(rate=0)
+
+        for _ in range(1000):
+            limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+